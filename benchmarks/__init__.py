@@ -0,0 +1,2 @@
+"""Local harness for measuring collector throughput without the twitter
+api or a mongo server."""
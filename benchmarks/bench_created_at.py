@@ -0,0 +1,65 @@
+"""Benchmark created_at parsing over the created_at strings of a set of
+stub pages (statuses, nested statuses and users).
+
+    python -m benchmarks.bench_created_at --pages 50
+"""
+
+import timeit
+import argparse
+from datetime import datetime
+from tweet_collector.config import created_at_to_ts, parse_created_at, \
+    CREATED_AT_DATETIME_FORMAT
+from tweet_collector.tweet_collector import flatten_page
+from .stub_server import make_status, FIRST_TWEET_ID, ID_STEP
+
+
+def page_created_at(num_pages):
+    """created_at strings in the order the db modules parse them"""
+    strings = []
+    for page in range(num_pages):
+        statuses = [make_status(FIRST_TWEET_ID + (page * 100 + seq) * ID_STEP)
+                    for seq in range(100)]
+        tweets, retweets = flatten_page(statuses)
+        for status, user in tweets + retweets:
+            strings += [status["created_at"], user["created_at"]]
+    return strings
+
+
+def run(num_pages=20, repeat=5):
+    """returns {name: best seconds per parse}"""
+    strings = page_created_at(num_pages)
+
+    def strptime():
+        for created_at in strings:
+            datetime.strptime(created_at, CREATED_AT_DATETIME_FORMAT)
+
+    def fixed_offsets():
+        for created_at in strings:
+            parse_created_at(created_at)
+
+    def cached():
+        created_at_to_ts.cache_clear()
+        for created_at in strings:
+            created_at_to_ts(created_at)
+
+    return {name: min(timeit.repeat(func, number=1, repeat=repeat)) /
+            len(strings)
+            for name, func in [("strptime", strptime),
+                               ("fixed_offsets", fixed_offsets),
+                               ("cached", cached)]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = run(args.pages, args.repeat)
+    for name, seconds in results.items():
+        print(f"{name:>14}: {seconds * 1e9:.0f} ns/parse "
+              f"({results['strptime'] / seconds:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Compare pages/sec of the threaded, pipelined and async collector engines
+against the local stub api.
+
+    python -m benchmarks.bench_engines --tweets 20000 --latency 0.02
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+import tempfile
+from .stub_server import StubSearchApi, FIRST_TWEET_ID, ID_STEP
+from .memory_db import MemoryDb
+
+
+def write_auth_file(directory, num_tokens):
+    auth_file = os.path.join(directory, "auth.json")
+    with open(auth_file, "w") as fp:
+        json.dump({f"app{idx}": {"token_type": "bearer",
+                                 "access_token": f"token{idx}"}
+                   for idx in range(num_tokens)}, fp)
+    return auth_file
+
+
+def gap_ranges(num_tweets, num_ranges):
+    """split the stub's id space into num_ranges unfinished meta ranges"""
+    bounds = [FIRST_TWEET_ID + num_tweets * ID_STEP * idx // num_ranges
+              for idx in range(num_ranges + 1)]
+    return [[hi, lo - 1] for lo, hi in zip(bounds, bounds[1:])]
+
+
+def run_engine(engine, api_url, auth_file, collect_ids):
+    """run one engine to completion and return (seconds, pages, tweets)"""
+    db = MemoryDb(collect_ids)
+    logger = logging.getLogger(f"bench.{engine}")
+    start = time.perf_counter()
+    if engine == "async":
+        from tweet_collector.async_collector import AsyncTweetCollector
+        collector = AsyncTweetCollector(db, "stub", auth_file=auth_file,
+                                        logger=logger, api_url=api_url)
+        collector.run()
+    else:
+        from tweet_collector.tweet_collector import TweetCollector
+        pipeline_depth = 4 if engine == "pipelined" else 0
+        collector = TweetCollector(db, "stub", auth_file=auth_file,
+                                   logger=logger, api_url=api_url,
+                                   pipeline_depth=pipeline_depth)
+        collector.start_collector()
+        collector.executor.shutdown(wait=True)
+    elapsed = time.perf_counter() - start
+    return elapsed, collector.tweets_collected, db
+
+
+def compare_engines(num_tweets=5000, latency=0.01, num_tokens=4,
+                    num_ranges=4, engines=("threaded", "pipelined", "async")):
+    """returns {engine: {"seconds", "pages", "pages_per_sec", "tweets"}}"""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        auth_file = write_auth_file(directory, num_tokens)
+        for engine in engines:
+            with StubSearchApi(num_tweets=num_tweets, latency=latency) as api:
+                elapsed, tweets, db = run_engine(
+                    engine, api.url, auth_file,
+                    gap_ranges(num_tweets, num_ranges))
+                pages = api.search_requests
+            results[engine] = {
+                "seconds": elapsed,
+                "pages": pages,
+                "pages_per_sec": pages / elapsed,
+                "tweets": tweets,
+                "stored": len(db.tweets),
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tweets", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--tokens", type=int, default=4)
+    parser.add_argument("--ranges", type=int, default=4)
+    args = parser.parse_args()
+
+    results = compare_engines(args.tweets, args.latency, args.tokens,
+                              args.ranges)
+    for engine, result in results.items():
+        print(f"{engine:>10}: {result['pages']} pages in "
+              f"{result['seconds']:.2f}s "
+              f"({result['pages_per_sec']:.1f} pages/sec, "
+              f"{result['tweets']} tweets)")
+
+
+if __name__ == "__main__":
+    main()
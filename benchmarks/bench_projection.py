@@ -0,0 +1,88 @@
+"""Micro-benchmark of the compiled projectors against the per key delete
+loops MongoCollector used before tweet_collector.db.projection.
+
+    python -m benchmarks.bench_projection --pages 50
+"""
+
+import copy
+import timeit
+import argparse
+from tweet_collector.config import COLLECT_TWEET_ATTRS, REQUIRED_TWEET_ATTRS, \
+    REQUIRED_USER_ATTRS
+from tweet_collector.db.projection import project_tweet
+from tweet_collector.tweet_collector import flatten_page
+from .stub_server import make_status, FIRST_TWEET_ID, ID_STEP
+
+
+def legacy_project(tweet_attrs, user_attrs):
+    """validation and key deletion as done by DbInterface.insert_tweet and
+    MongoCollector.insert_tweet / insert_user before projection.py"""
+    missing_tweet_attrs = [key for key in REQUIRED_TWEET_ATTRS
+                           if key not in tweet_attrs.keys()
+                           or tweet_attrs[key] is None]
+    missing_user_attrs = [key for key in REQUIRED_USER_ATTRS
+                          if key not in user_attrs.keys()
+                          or user_attrs[key] is None]
+    if missing_user_attrs or missing_tweet_attrs:
+        raise KeyError("Missing attributes")
+
+    del_keys = [key for key, val in tweet_attrs.items() if key not in
+                COLLECT_TWEET_ATTRS or val is None]
+    for key in del_keys:
+        del tweet_attrs[key]
+
+    del_keys = [key for key, val in user_attrs.items() if key not in
+                REQUIRED_USER_ATTRS or val is None]
+    for key in del_keys:
+        del user_attrs[key]
+    return tweet_attrs, user_attrs
+
+
+def make_pages(num_pages):
+    pages = []
+    for page in range(num_pages):
+        statuses = [make_status(FIRST_TWEET_ID + (page * 100 + seq) * ID_STEP)
+                    for seq in range(100)]
+        pages.append(flatten_page(statuses)[0])
+    return pages
+
+
+def run(num_pages=20, repeat=5):
+    """returns {name: best seconds per page}"""
+    pages = make_pages(num_pages)
+
+    def legacy():
+        # the legacy loops mutate their input, so time them on copies
+        for page in copy.deepcopy(pages):
+            for tweet_attrs, user_attrs in page:
+                legacy_project(tweet_attrs, user_attrs)
+
+    def legacy_copy_only():
+        copy.deepcopy(pages)
+
+    def compiled():
+        for page in pages:
+            for tweet_attrs, user_attrs in page:
+                project_tweet(tweet_attrs, user_attrs)
+
+    legacy_time = min(timeit.repeat(legacy, number=1, repeat=repeat)) - \
+        min(timeit.repeat(legacy_copy_only, number=1, repeat=repeat))
+    compiled_time = min(timeit.repeat(compiled, number=1, repeat=repeat))
+    return {"legacy": legacy_time / num_pages,
+            "compiled": compiled_time / num_pages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = run(args.pages, args.repeat)
+    for name, seconds in results.items():
+        print(f"{name:>10}: {seconds * 1e6:.1f} us/page")
+    print(f"{'speedup':>10}: {results['legacy'] / results['compiled']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Status corpora for the benchmarks.
+
+A corpus is a gzip compressed file of api statuses, one json object per
+line. It is either synthetic (make_status: about a third retweets, a tenth
+quotes and a tenth with a place) or imported from recorded
+search/tweets.json responses, and is served by StubSearchApi(statuses=...).
+
+    python -m benchmarks.corpus synth corpus.jsonl.gz --tweets 20000
+    python -m benchmarks.corpus import corpus.jsonl.gz response1.json ...
+    python -m benchmarks.corpus mix corpus.jsonl.gz
+"""
+
+import gzip
+import json
+import argparse
+from .stub_server import make_status, FIRST_TWEET_ID, ID_STEP
+
+
+def synthetic_statuses(num_tweets):
+    """newest first, like a search response"""
+    return [make_status(FIRST_TWEET_ID + seq * ID_STEP)
+            for seq in reversed(range(num_tweets))]
+
+
+def import_responses(paths):
+    """statuses of recorded search/tweets.json responses, newest first and
+    without duplicates"""
+    statuses = {}
+    for path in paths:
+        with open(path, "rb") as fp:
+            for status in json.load(fp)["statuses"]:
+                statuses[status["id"]] = status
+    return [statuses[status_id] for status_id in sorted(statuses,
+                                                        reverse=True)]
+
+
+def write_corpus(path, statuses):
+    with gzip.open(path, "wt", encoding="utf-8") as fp:
+        for status in statuses:
+            fp.write(json.dumps(status) + "\n")
+
+
+def read_corpus(path):
+    with gzip.open(path, "rt", encoding="utf-8") as fp:
+        return [json.loads(line) for line in fp]
+
+
+def pages(statuses, page_size=100):
+    return [statuses[start:start + page_size]
+            for start in range(0, len(statuses), page_size)]
+
+
+def mix(statuses):
+    """fraction of retweets, quotes and statuses with a place"""
+    num_statuses = len(statuses) or 1
+    return {
+        "retweets": sum("retweeted_status" in status
+                        for status in statuses) / num_statuses,
+        "quotes": sum("quoted_status" in status
+                      for status in statuses) / num_statuses,
+        "places": sum(bool(status.get("place"))
+                      for status in statuses) / num_statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    synth = commands.add_parser("synth")
+    synth.add_argument("corpus")
+    synth.add_argument("--tweets", type=int, default=20000)
+    recorded = commands.add_parser("import")
+    recorded.add_argument("corpus")
+    recorded.add_argument("responses", nargs="+")
+    show_mix = commands.add_parser("mix")
+    show_mix.add_argument("corpus")
+    args = parser.parse_args()
+
+    if args.command == "synth":
+        write_corpus(args.corpus, synthetic_statuses(args.tweets))
+    elif args.command == "import":
+        write_corpus(args.corpus, import_responses(args.responses))
+    statuses = read_corpus(args.corpus)
+    print(f"{len(statuses)} statuses: " +
+          ", ".join(f"{share * 100:.1f}% {kind}"
+                    for kind, share in mix(statuses).items()))
+
+
+if __name__ == "__main__":
+    main()
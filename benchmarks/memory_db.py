@@ -0,0 +1,87 @@
+"""In-memory DbInterface used to take the database out of collector
+benchmarks."""
+
+import sys
+import threading
+from datetime import datetime
+from tweet_collector.db.DbInterface import DbInterface
+from tweet_collector.db.projection import project_tweet, project_user_attrs, \
+    project_retweet_attrs
+
+
+class MemoryDb(DbInterface):
+    def __init__(self, collect_ids=None):
+        self.tweets = {}
+        self.users = {}
+        self.places = {}
+        self.retweets = {}
+        self.meta = {}
+        self.query_states = {}
+        self.lock = threading.Lock()
+        for next_max_id, since_id in collect_ids or []:
+            self.save_collector_state(next_max_id, since_id, False)
+
+    def get_max_tweet_id(self):
+        with self.lock:
+            return max(self.tweets) if self.tweets else 0
+
+    def get_min_tweet_id(self):
+        with self.lock:
+            return min(self.tweets) if self.tweets else sys.maxsize
+
+    def save_collector_state(self, next_max_id, since_id, done, query=None):
+        with self.lock:
+            self.meta[(query, since_id)] = {
+                "next_max_id": next_max_id,
+                "since_id": since_id,
+                "query": query,
+                "timestamp": datetime.now().timestamp(),
+                "done": done
+            }
+
+    def load_collector_state(self, query=None):
+        with self.lock:
+            return [[state["next_max_id"], state["since_id"]]
+                    for since_id, state in sorted(
+                        (since_id, state)
+                        for (state_query, since_id), state
+                        in self.meta.items() if state_query == query)
+                    if not state["done"]]
+
+    def load_query_state(self, query):
+        with self.lock:
+            return dict(self.query_states.get(query, {}))
+
+    def save_query_state(self, query, state):
+        with self.lock:
+            self.query_states[query] = dict(state)
+
+    def insert_tweet(self, tweet_attrs, user_attrs):
+        tweet, user = project_tweet(tweet_attrs, user_attrs)
+        place = tweet.pop("place", None)
+        with self.lock:
+            self.tweets.setdefault(tweet["id"], tweet)
+            self.users[user["id"]] = user
+            if place:
+                self.places.setdefault(place["id"], place)
+
+    def insert_retweet(self, retweet, user):
+        record = project_retweet_attrs(retweet)
+        record["tweet_id"] = retweet["retweeted_status"]["id"]
+        with self.lock:
+            self.retweets.setdefault(record["id"], record)
+            self.users[user["id"]] = project_user_attrs(user)
+
+    def estimate_tweet_count(self):
+        with self.lock:
+            return len(self.tweets) + len(self.retweets)
+
+    def iter_tweet_ids(self):
+        with self.lock:
+            return iter(list(self.tweets) + list(self.retweets))
+
+    def get_stored_tweet_ids(self, ids):
+        with self.lock:
+            return {tweet_id for tweet_id in ids
+                    if tweet_id in self.tweets or tweet_id in self.retweets}
+
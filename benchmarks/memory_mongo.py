@@ -0,0 +1,53 @@
+"""MongoCollector writing to in-memory collections, which takes the mongo
+server out of its benchmarks. Needs pymongo, unlike memory_db."""
+
+from pymongo.errors import DuplicateKeyError
+from tweet_collector.db.mongo import MongoCollector
+from tweet_collector.db.cache import UserCache, PlaceCache
+
+
+class MemoryCollection(object):
+    """The pymongo collection calls MongoCollector writes with, keeping
+    documents by id. Bulk writes take the ops of MemoryMongoCollector."""
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+
+    def insert_one(self, doc):
+        if doc["id"] in self.docs:
+            raise DuplicateKeyError("duplicate id")
+        self.docs[doc["id"]] = doc
+
+    def bulk_write(self, ops, ordered=True):
+        for kind, doc in ops:
+            stored = self.docs.get(doc["id"])
+            if stored is None or (kind == "upsert" and
+                                  stored["last_tweet_ts"] <
+                                  doc["last_tweet_ts"]):
+                self.docs[doc["id"]] = doc
+
+
+class MemoryMongoCollector(MongoCollector):
+    """Builds its bulk write ops as (kind, document) pairs for
+    MemoryCollection instead of pymongo ops"""
+
+    def __init__(self):
+        self.user_cache = UserCache()
+        self.user_buffer = None
+        self.place_cache = PlaceCache(lambda: [])
+        for name in ("tweets", "users", "places", "meta", "retweets"):
+            setattr(self, name, MemoryCollection(name))
+
+    @staticmethod
+    def insert_op(doc):
+        return ("insert", doc)
+
+    @staticmethod
+    def retweet_upsert(record):
+        return ("insert", record)
+
+    @staticmethod
+    def user_upsert(user):
+        """guarded on last_tweet_ts like MongoCollector.user_upsert"""
+        return ("upsert", user)
@@ -0,0 +1,227 @@
+"""A local stand-in for the twitter search api.
+
+Serves search/tweets.json pages from a synthetic, descending id space, or
+from a corpus of statuses (see corpus.py), and answers
+application/rate_limit_status.json. Responses carry the
+x-rate-limit headers the collectors read."""
+
+import json
+import time
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from tweet_collector.snowflake import id_to_datetime, ms_to_id_span
+
+# ids are snowflakes so they behave like real tweet ids; consecutive stub
+# statuses are 50ms apart
+FIRST_TWEET_ID = 1050000000000000000
+ID_STEP = ms_to_id_span(50)
+
+CREATED_AT_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"
+
+
+def make_user(user_id):
+    return {
+        "id": user_id,
+        "screen_name": f"user{user_id}",
+        "name": f"User {user_id}",
+        "location": "Somewhere",
+        "profile_image_url_https": "https://example.com/img.png",
+        "followers_count": user_id * 3,
+        "created_at": "Wed Oct 10 20:19:24 +0000 2012",
+        "friends_count": user_id * 2,
+        "statuses_count": user_id * 5,
+        "description": "a synthetic user",
+        "verified": False,
+        "entities": {"url": {"urls": []}},
+    }
+
+
+def make_place(place_id):
+    return {
+        "id": f"place{place_id}",
+        "url": "https://api.twitter.com/1.1/geo/id/place.json",
+        "place_type": "city",
+        "name": f"City {place_id}",
+        "full_name": f"City {place_id}, ST",
+        "country_code": "US",
+        "country": "United States",
+        "contained_within": [],
+        "bounding_box": {
+            "type": "Polygon",
+            "coordinates": [[[-1.0 - place_id, 1.0], [-1.0 - place_id, 2.0],
+                             [-2.0 - place_id, 2.0], [-2.0 - place_id, 1.0]]]
+        },
+        "attributes": {}
+    }
+
+
+def make_status(tweet_id, num_users=500, num_places=20, nested=True):
+    """Build a deterministic status. Roughly a third are retweets, a tenth
+    quote another status and a tenth carry a place."""
+    seq = (tweet_id - FIRST_TWEET_ID) // ID_STEP
+    created_at = id_to_datetime(tweet_id)
+    status = {
+        "id": tweet_id,
+        "id_str": str(tweet_id),
+        "created_at": created_at.strftime(CREATED_AT_FORMAT),
+        "full_text": f"synthetic status {seq} " + "lorem ipsum " * 8,
+        "truncated": False,
+        "display_text_range": [0, 120],
+        "entities": {"hashtags": [], "symbols": [], "user_mentions": [],
+                     "urls": []},
+        "metadata": {"iso_language_code": "en", "result_type": "recent"},
+        "source": "<a href=\"https://example.com\">stub</a>",
+        "in_reply_to_status_id": None,
+        "user": make_user(seq % num_users + 1),
+        "geo": None,
+        "coordinates": None,
+        "place": make_place(seq % num_places) if seq % 10 == 3 else None,
+        "is_quote_status": False,
+        "retweet_count": seq % 7,
+        "favorite_count": seq % 11,
+        "lang": "en",
+    }
+    # nested originals are older statuses outside the served id space
+    if nested and seq % 3 == 0:
+        original = make_status(tweet_id - FIRST_TWEET_ID // 2,
+                               num_users, num_places, nested=False)
+        status["retweeted_status"] = original
+    elif nested and seq % 10 == 1:
+        quoted = make_status(tweet_id - FIRST_TWEET_ID // 2 + 1,
+                             num_users, num_places, nested=False)
+        status["is_quote_status"] = True
+        status["quoted_status"] = quoted
+    return status
+
+
+class StubSearchApi(object):
+    """Serve num_tweets statuses on a local port.
+
+    Args:
+        num_tweets: size of the id space served
+        latency: seconds to sleep before answering each search request
+        error_rate: every n-th search request answers 503 (0 disables)
+        rate_limit: calls each token may make per window; later calls
+            answer 429
+        statuses: serve these statuses instead of num_tweets synthetic ones
+    """
+
+    def __init__(self, num_tweets=10000, latency=0.0, error_rate=0,
+                 rate_limit=100000, port=0, statuses=None):
+        if statuses is None:
+            self.statuses = None
+            self.ids = [FIRST_TWEET_ID + i * ID_STEP
+                        for i in range(num_tweets)]
+        else:
+            self.statuses = {status["id"]: status for status in statuses}
+            self.ids = sorted(self.statuses)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.reset_ts = int(time.time()) + 900
+        self.remaining = {}
+        self.search_requests = 0
+        self.lock = threading.Lock()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                api.handle(self)
+
+            def log_message(self, format, *args):
+                return
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/1.1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handle(self, request):
+        parsed = urlparse(request.path)
+        query = {key: val[0] for key, val in parse_qs(parsed.query).items()}
+        token = request.headers.get("Authorization", "")
+
+        if parsed.path.endswith("/application/rate_limit_status.json"):
+            with self.lock:
+                remaining = self.remaining.get(token, self.rate_limit)
+            body = {"resources": {"search": {"/search/tweets": {
+                "limit": self.rate_limit, "remaining": remaining,
+                "reset": self.reset_ts}}}}
+            return self.respond(request, 200, body, token)
+
+        if not parsed.path.endswith("/search/tweets.json"):
+            return self.respond(request, 404, {"errors": []}, token)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.search_requests += 1
+            request_num = self.search_requests
+            exhausted = self.remaining.get(token, self.rate_limit) == 0
+            self.remaining[token] = \
+                max(self.remaining.get(token, self.rate_limit) - 1, 0)
+
+        if exhausted:
+            return self.respond(request, 429, {"errors": []}, token)
+
+        if self.error_rate and request_num % self.error_rate == 0:
+            return self.respond(request, 503, {"errors": []}, token)
+
+        max_id = int(query.get("max_id", 2 ** 63 - 1))
+        since_id = int(query.get("since_id", 0))
+        count = int(query.get("count", 15))
+
+        # ids are ascending; take the newest count ids in (since_id, max_id]
+        hi = bisect.bisect_right(self.ids, max_id)
+        lo = max(bisect.bisect_right(self.ids, since_id), hi - count)
+        statuses = [self.status(tweet_id)
+                    for tweet_id in reversed(self.ids[lo:hi])]
+        body = {"statuses": statuses,
+                "search_metadata": {"count": count, "max_id": max_id,
+                                    "since_id": since_id}}
+        return self.respond(request, 200, body, token)
+
+    def status(self, tweet_id):
+        if self.statuses is None:
+            return make_status(tweet_id)
+        return self.statuses[tweet_id]
+
+    def respond(self, request, status, body, token):
+        payload = json.dumps(body).encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(payload)))
+        with self.lock:
+            remaining = self.remaining.get(token, self.rate_limit)
+        request.send_header("x-rate-limit-limit", str(self.rate_limit))
+        request.send_header("x-rate-limit-remaining", str(remaining))
+        request.send_header("x-rate-limit-reset", str(self.reset_ts))
+        request.end_headers()
+        request.wfile.write(payload)
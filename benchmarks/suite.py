@@ -0,0 +1,221 @@
+"""End to end benchmark suite.
+
+    python -m benchmarks.suite --tweets 20000 --save baseline.json
+    python -m benchmarks.suite --tweets 20000 --baseline baseline.json
+
+Every benchmark runs in a forked process, so its peak RSS is its own, and
+reports pages/sec, tweets/sec (statuses, retweets and nested statuses
+included), p50 / p99 page latency and peak RSS:
+
+    collector     TweetCollector.start_collector against StubSearchApi,
+                  answering every 50th search with a 503, into MemoryDb
+    insert_tweet  MongoCollector.insert_tweet and insert_retweet for each
+                  status of a page, into in memory collections or the
+                  server given by --mongo-host
+    created_at    created_at_to_ts for the created_at strings of a page,
+                  starting with an empty cache
+
+Pages come from a corpus file (--corpus, see corpus.py) or are synthetic.
+With --baseline the run fails when a benchmark's tweets/sec falls more than
+--tolerance below the baseline.
+"""
+
+import sys
+import math
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from functools import partial
+from tweet_collector.config import created_at_to_ts
+from tweet_collector.transport import Transport
+from tweet_collector.tweet_collector import TweetCollector, flatten_page
+from .bench_engines import write_auth_file
+from .corpus import synthetic_statuses, read_corpus, pages
+from .memory_db import MemoryDb
+from .stub_server import StubSearchApi
+
+logger = logging.getLogger("bench.suite")
+
+# every n-th search request answers 503
+ERROR_RATE = 50
+
+
+def percentile(values, pct):
+    """nearest rank percentile"""
+    values = sorted(values)
+    return values[max(math.ceil(len(values) * pct / 100) - 1, 0)]
+
+
+def summarize(page_seconds, num_statuses, elapsed):
+    return {
+        "pages": len(page_seconds),
+        "pages_per_sec": len(page_seconds) / elapsed,
+        "tweets_per_sec": num_statuses / elapsed,
+        "p50_ms": percentile(page_seconds, 50) * 1000,
+        "p99_ms": percentile(page_seconds, 99) * 1000,
+    }
+
+
+def bench_collector(statuses, latency=0.0, num_tokens=2):
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(statuses=statuses, latency=latency,
+                          error_rate=ERROR_RATE) as api:
+        db = MemoryDb()
+        collector = TweetCollector(db, "stub",
+                                   auth_file=write_auth_file(directory,
+                                                             num_tokens),
+                                   logger=logger, api_url=api.url,
+                                   transport=Transport(backoff_base=0.01))
+        # the loop of start_collector, timed per page
+        page_seconds = []
+        start = last = time.perf_counter()
+        for _ in collector.iter_pages():
+            now = time.perf_counter()
+            page_seconds.append(now - last)
+            last = now
+        collector.executor.shutdown(wait=True)
+        elapsed = time.perf_counter() - start
+    return summarize(page_seconds, len(db.tweets) + len(db.retweets),
+                     elapsed)
+
+
+def bench_insert_tweet(statuses, mongo_host=None):
+    if mongo_host:
+        from pymongo import MongoClient
+        from tweet_collector.db.mongo import MongoCollector
+        db_name = "tweet_collector_bench"
+        # before setup, which checks the indexes once per process
+        MongoClient(mongo_host).drop_database(db_name)
+        collector = MongoCollector(mongo_host, db_name,
+                                   user_flush_interval=0)
+    else:
+        # needs pymongo, unlike the other benchmarks
+        from .memory_mongo import MemoryMongoCollector
+        collector = MemoryMongoCollector()
+
+    flattened = [flatten_page(page) for page in pages(statuses)]
+    page_seconds = []
+    num_statuses = 0
+    for page_tweets, page_retweets in flattened:
+        start = time.perf_counter()
+        for tweet_attrs, user_attrs in page_tweets:
+            collector.insert_tweet(tweet_attrs, user_attrs)
+        for retweet, user in page_retweets:
+            collector.insert_retweet(retweet, user)
+        page_seconds.append(time.perf_counter() - start)
+        num_statuses += len(page_tweets) + len(page_retweets)
+
+    if mongo_host:
+        collector.mongo.drop_database(db_name)
+    return summarize(page_seconds, num_statuses, sum(page_seconds))
+
+
+def bench_created_at(statuses):
+    page_strings = []
+    for page in pages(statuses):
+        page_tweets, page_retweets = flatten_page(page)
+        page_strings.append([created_at
+                             for status, user in page_tweets + page_retweets
+                             for created_at in (status["created_at"],
+                                                user["created_at"])])
+
+    created_at_to_ts.cache_clear()
+    page_seconds = []
+    for strings in page_strings:
+        start = time.perf_counter()
+        for created_at in strings:
+            created_at_to_ts(created_at)
+        page_seconds.append(time.perf_counter() - start)
+    return summarize(page_seconds, sum(map(len, page_strings)),
+                     sum(page_seconds))
+
+
+def run_isolated(name, bench, load_statuses):
+    """run bench(statuses) in a forked process; returns its results with
+    the peak RSS of the process"""
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+
+    def target():
+        result = bench(load_statuses())
+        # kilobytes on linux
+        result["peak_rss_mb"] = \
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        sender.send(result)
+
+    process = context.Process(target=target)
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        raise RuntimeError(f"benchmark {name} failed")
+    finally:
+        process.join()
+    return result
+
+
+def run_suite(num_tweets=20000, corpus=None, latency=0.0, mongo_host=None):
+    """returns {benchmark: results}"""
+    if corpus:
+        load_statuses = partial(read_corpus, corpus)
+    else:
+        load_statuses = partial(synthetic_statuses, num_tweets)
+    benches = {
+        "collector": partial(bench_collector, latency=latency),
+        "insert_tweet": partial(bench_insert_tweet, mongo_host=mongo_host),
+        "created_at": bench_created_at,
+    }
+    return {name: run_isolated(name, bench, load_statuses)
+            for name, bench in benches.items()}
+
+
+def regressions(results, baseline, tolerance=0.2):
+    """names of the benchmarks whose tweets/sec fell more than tolerance
+    below the baseline"""
+    return [name for name, result in results.items()
+            if name in baseline and result["tweets_per_sec"] <
+            baseline[name]["tweets_per_sec"] * (1 - tolerance)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--tweets", type=int, default=20000,
+                        help="synthetic statuses, without --corpus")
+    parser.add_argument("--corpus", help="corpus file to serve")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds the stub api waits per search")
+    parser.add_argument("--mongo-host",
+                        help="benchmark insert_tweet against this server")
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run_suite(args.tweets, args.corpus, args.latency,
+                        args.mongo_host)
+    for name, result in results.items():
+        print(f"{name:>12}: {result['pages_per_sec']:10.1f} pages/sec "
+              f"{result['tweets_per_sec']:12.1f} tweets/sec  "
+              f"p50 {result['p50_ms']:8.3f} ms  "
+              f"p99 {result['p99_ms']:8.3f} ms  "
+              f"peak rss {result['peak_rss_mb']:.0f} MB")
+
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            failed = regressions(results, json.load(fp), args.tolerance)
+        if failed:
+            print(f"Slower than the baseline: {', '.join(failed)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,5 +10,10 @@ setup(
     packages=find_packages(exclude=["tests"]),
     install_requires=[
         'pymongo'
-    ]
+    ],
+    extras_require={
+        'async': ['aiohttp'],
+        'fast': ['orjson'],
+        'parquet': ['pyarrow']
+    }
 )
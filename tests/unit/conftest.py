@@ -0,0 +1,26 @@
+import os
+import pytest
+
+# mongo server of the server backed tests, which are skipped without one
+MONGO_TEST_HOST = os.environ.get("MONGO_TEST_HOST", "localhost:27017")
+MONGO_TEST_DB = "tweet_collector_test"
+
+
+@pytest.fixture
+def mongo_host():
+    """MONGO_TEST_HOST with an empty MONGO_TEST_DB database"""
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+    from tweet_collector.db import mongo
+    client = MongoClient(MONGO_TEST_HOST, serverSelectionTimeoutMS=500)
+    try:
+        client.server_info()
+    except PyMongoError:
+        client.close()
+        pytest.skip(f"no mongo server at {MONGO_TEST_HOST}")
+    client.drop_database(MONGO_TEST_DB)
+    # the indexes of the dropped database are created again
+    mongo._ensured_indexes.clear()
+    yield MONGO_TEST_HOST
+    client.drop_database(MONGO_TEST_DB)
+    client.close()
@@ -0,0 +1,120 @@
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from benchmarks.bench_engines import compare_engines
+
+
+def test_async_engine_matches_threaded_engine():
+    results = compare_engines(num_tweets=600, latency=0.005, num_tokens=2,
+                              num_ranges=3, engines=("threaded", "async"))
+    threaded, async_ = results["threaded"], results["async"]
+
+    # both engines see every served status exactly once
+    assert threaded["stored"] == async_["stored"] > 600
+    assert async_["tweets"] == threaded["tweets"]
+    assert async_["pages_per_sec"] > 0
+
+
+def test_async_failed_write_skips_the_range_state():
+    import tempfile
+    from benchmarks.bench_engines import write_auth_file
+    from benchmarks.memory_db import MemoryDb
+    from benchmarks.stub_server import StubSearchApi
+    from tweet_collector.async_collector import AsyncTweetCollector
+
+    class FailingDb(MemoryDb):
+        def insert_tweets_batch(self, tweets, retweets):
+            raise IOError("write failed")
+
+    db = FailingDb()
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=3000) as api:
+        collector = AsyncTweetCollector(
+            db, "stub", auth_file=write_auth_file(directory, 1),
+            api_url=api.url)
+        with pytest.raises(IOError):
+            collector.run()
+
+    # the range is neither marked done nor moved past the unwritten pages
+    assert db.meta == {}
+    # and stops fetching instead of running to its end
+    assert api.search_requests < 10
+
+
+def make_collector(directory, num_tokens):
+    from benchmarks.bench_engines import write_auth_file
+    from benchmarks.memory_db import MemoryDb
+    from tweet_collector.async_collector import AsyncTweetCollector
+
+    return AsyncTweetCollector(
+        MemoryDb(), "stub", auth_file=write_auth_file(directory, num_tokens))
+
+
+def test_reset_tokens_get_their_limit_back_without_polling():
+    import time
+    import asyncio
+    import tempfile
+    from unittest import mock
+
+    with tempfile.TemporaryDirectory() as directory:
+        collector = make_collector(directory, 2)
+    collector.token_limit = [180, 180]
+    collector.token_reset_ts = [time.time() - 1, time.time() + 900]
+    with mock.patch.object(collector, "get_current_rate_limits") as poll:
+        assert asyncio.run(collector.acquire_token()) == 0
+    poll.assert_not_called()
+    assert collector.token_limit_remaining == [179, 0]
+
+
+def test_tokens_without_rate_limit_headers_are_polled():
+    import time
+    import asyncio
+    import tempfile
+    from unittest import mock
+
+    with tempfile.TemporaryDirectory() as directory:
+        collector = make_collector(directory, 1)
+    collector.token_reset_ts = [time.time() - 1]
+
+    async def poll():
+        collector.token_limit_remaining = [180]
+
+    with mock.patch.object(collector, "get_current_rate_limits",
+                           side_effect=poll) as polled:
+        assert asyncio.run(collector.acquire_token()) == 0
+    assert polled.call_count == 1
+
+
+def test_async_ranges_checkpoint_while_collecting():
+    import tempfile
+    from benchmarks.bench_engines import write_auth_file
+    from benchmarks.memory_db import MemoryDb
+    from benchmarks.stub_server import StubSearchApi
+    from tweet_collector.async_collector import AsyncTweetCollector
+
+    class RecordingDb(MemoryDb):
+        def __init__(self):
+            super().__init__()
+            self.states = []
+
+        def save_collector_state(self, next_max_id, since_id, done,
+                                 query=None):
+            self.states.append((next_max_id, done, len(self.tweets) +
+                                len(self.retweets)))
+            super().save_collector_state(next_max_id, since_id, done, query)
+
+    db = RecordingDb()
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=1000) as api:
+        collector = AsyncTweetCollector(
+            db, "stub", auth_file=write_auth_file(directory, 1),
+            api_url=api.url, checkpoint_pages=2)
+        collector.run()
+
+    # checkpoints are saved once the pages before them are stored
+    checkpoints = [(next_max_id, stored) for next_max_id, done, stored
+                   in db.states if not done]
+    # the first one comes after two full pages
+    assert checkpoints and checkpoints[0][1] >= 200
+    assert db.states[-1][1]
@@ -0,0 +1,78 @@
+import sys
+import tempfile
+import pytest
+from benchmarks.stub_server import make_status, FIRST_TWEET_ID, ID_STEP
+from tweet_collector.db import get_backend
+from tweet_collector.db.segments import SegmentCollector
+from tweet_collector.db.sqlite import SqliteCollector
+from tweet_collector.tweet_collector import flatten_page
+
+
+def make_page(first_seq, num_statuses=50):
+    return flatten_page([make_status(FIRST_TWEET_ID + seq * ID_STEP)
+                         for seq in range(first_seq,
+                                          first_seq + num_statuses)])
+
+
+@pytest.fixture(params=["sqlite", "segments"])
+def backend(request):
+    with tempfile.TemporaryDirectory() as directory:
+        yield get_backend(request.param), directory
+
+
+def test_registry():
+    assert get_backend("sqlite") is SqliteCollector
+    assert get_backend("segments") is SegmentCollector
+    assert get_backend("nope") is None
+
+
+def test_pages_and_state_round_trip(backend):
+    backend_class, directory = backend
+    db = backend_class(directory, "test")
+    assert db.get_max_tweet_id() == 0
+    assert db.get_min_tweet_id() == sys.maxsize
+
+    page_tweets, page_retweets = make_page(0)
+    db.insert_tweets_batch(page_tweets, page_retweets)
+    db.insert_tweets_batch(page_tweets, page_retweets)
+    db.flush()
+
+    tweet_ids = {tweet["id"] for tweet, _ in page_tweets}
+    retweet_ids = {retweet["id"] for retweet, _ in page_retweets}
+    assert db.get_max_tweet_id() == max(tweet_ids)
+    assert sorted(db.iter_tweet_ids()) == sorted(tweet_ids | retweet_ids)
+    assert db.get_stored_tweet_ids([min(tweet_ids), 1]) == {min(tweet_ids)}
+
+    db.save_collector_state(100, 10, False)
+    db.save_collector_state(200, 20, False, query="cats")
+    db.save_collector_state(50, 10, False)
+    db.save_collector_state(300, 30, True)
+    db.save_query_state("cats", {"max_id": 5})
+    assert db.load_collector_state() == [[50, 10]]
+    assert db.load_collector_state(query="cats") == [[200, 20]]
+
+    # everything is read back after reopening
+    if hasattr(db, "close"):
+        db.close()
+    db = backend_class(directory, "test")
+    assert db.load_collector_state() == [[50, 10]]
+    assert db.load_query_state("cats") == {"max_id": 5}
+    assert db.estimate_tweet_count() == len(tweet_ids) + len(retweet_ids)
+    assert db.get_stored_tweet_ids(tweet_ids) == tweet_ids
+
+
+def test_segments_rotate_and_recover_open_segments():
+    with tempfile.TemporaryDirectory() as directory:
+        db = SegmentCollector(directory, "test", max_segment_bytes=4096)
+        stored = set()
+        for first_seq in range(0, 200, 50):
+            page_tweets, page_retweets = make_page(first_seq)
+            db.insert_tweets_batch(page_tweets, page_retweets)
+            stored |= {tweet["id"] for tweet, _ in page_tweets}
+        assert len(db.tweets.segments) > 1
+
+        # a crash leaves the open segment without its index
+        db.flush()
+        reopened = SegmentCollector(directory, "test")
+        assert set(reopened.tweets.iter_ids()) == stored
+        assert reopened.get_max_tweet_id() == max(stored)
@@ -0,0 +1,56 @@
+import os
+import json
+import tempfile
+import requests
+from benchmarks.corpus import synthetic_statuses, import_responses, \
+    write_corpus, read_corpus, mix
+from benchmarks.stub_server import StubSearchApi
+from benchmarks.suite import run_suite, regressions, percentile
+
+
+def test_corpus_round_trip_and_mix():
+    statuses = synthetic_statuses(300)
+    share = mix(statuses)
+    assert 0.3 < share["retweets"] < 0.4
+    assert 0.05 < share["quotes"] < 0.15
+    assert 0.05 < share["places"] < 0.15
+
+    with tempfile.TemporaryDirectory() as directory:
+        response_path = os.path.join(directory, "response.json")
+        with open(response_path, "w") as fp:
+            json.dump({"statuses": statuses[100:] + statuses[:150]}, fp)
+        corpus_path = os.path.join(directory, "corpus.jsonl.gz")
+        write_corpus(corpus_path, import_responses([response_path]))
+        assert read_corpus(corpus_path) == statuses
+
+
+def test_stub_serves_a_corpus():
+    statuses = synthetic_statuses(250)[::2]
+    with StubSearchApi(statuses=statuses) as api:
+        res = requests.get(f"{api.url}/search/tweets.json",
+                           params={"count": 100,
+                                   "max_id": statuses[10]["id"]})
+    assert res.headers["x-rate-limit-remaining"]
+    assert res.json()["statuses"] == statuses[10:110]
+
+
+def test_suite_reports_and_detects_regressions():
+    results = run_suite(num_tweets=500)
+    assert set(results) == {"collector", "insert_tweet", "created_at"}
+    for result in results.values():
+        assert result["pages"] >= 5
+        assert result["tweets_per_sec"] > 0
+        assert result["p99_ms"] >= result["p50_ms"]
+        assert result["peak_rss_mb"] > 0
+
+    faster = {name: {"tweets_per_sec": result["tweets_per_sec"] * 2}
+              for name, result in results.items()}
+    assert regressions(results, results) == []
+    assert sorted(regressions(results, faster)) == sorted(results)
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([3.0], 99) == 3.0
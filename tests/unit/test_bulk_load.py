@@ -0,0 +1,185 @@
+from types import SimpleNamespace
+from benchmarks.stub_server import make_status, FIRST_TWEET_ID, ID_STEP
+from tweet_collector.db import mongo
+from tweet_collector.db.mongo import MongoCollector, ensure_indexes, \
+    merge_pipeline, INDEXES, DATA_COLLECTIONS, STAGING_SUFFIX
+from tweet_collector.db.cache import UserCache, PlaceCache
+from tweet_collector.tweet_collector import flatten_page
+from conftest import MONGO_TEST_DB
+
+
+class IndexedCollection(object):
+    """The index and collection management calls of a pymongo collection"""
+
+    def __init__(self, db, name):
+        self.db = db
+        self.database = SimpleNamespace(name=db.name)
+        self.name = name
+        self.indexes = {}
+        self.num_docs = 0
+        self.created = []
+        self.pipelines = []
+
+    def index_information(self):
+        return {"_id_": {"key": [("_id", 1)]}, **self.indexes} \
+            if self.num_docs or self.indexes else {}
+
+    def create_indexes(self, indexes):
+        for index in indexes:
+            self.created.append(index.document["name"])
+            self.indexes[index.document["name"]] = index.document
+
+    def drop_index(self, name):
+        del self.indexes[name]
+
+    def estimated_document_count(self):
+        return self.num_docs
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+
+    def rename(self, name, dropTarget=False):
+        assert dropTarget
+        target = self.db[name]
+        target.indexes, target.num_docs = self.indexes, self.num_docs
+        self.indexes, self.num_docs = {}, 0
+
+    def drop(self):
+        self.indexes, self.num_docs = {}, 0
+
+
+class FakeDatabase(object):
+    def __init__(self, name):
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = IndexedCollection(self, name)
+        return self.collections[name]
+
+
+def make_collector(db, bulk_load):
+    """MongoCollector on a fake database, set up like __init__ does"""
+    collector = MongoCollector.__new__(MongoCollector)
+    collector.user_cache = UserCache()
+    collector.user_buffer = None
+    collector.host = "fake"
+    collector.db = db
+    collector.live = {name: db[name] for name in DATA_COLLECTIONS}
+    collector.staging = {name: db[name + STAGING_SUFFIX]
+                         for name in DATA_COLLECTIONS}
+    collector.meta = db["meta"]
+    collector.bulk_load = bulk_load
+    collector.write_to(collector.staging if bulk_load else collector.live)
+    collector.place_cache = PlaceCache(lambda: [])
+    collector.setup()
+    return collector
+
+
+def index_names(name):
+    return [index.document["name"] for index in INDEXES[name]]
+
+
+def setup_function():
+    mongo._ensured_indexes.clear()
+
+
+def test_ensure_indexes_creates_missing_indexes_once():
+    collection = FakeDatabase("db")["tweets"]
+    collection.create_indexes(INDEXES["tweets"][:2])
+    collection.indexes["legacy_1"] = {}
+    collection.created = []
+
+    ensure_indexes(collection, INDEXES["tweets"], "host", drop=["legacy_1"])
+    assert collection.created == index_names("tweets")[2:]
+    assert "legacy_1" not in collection.indexes
+
+    collection.indexes = {}
+    ensure_indexes(collection, INDEXES["tweets"], "host")
+    assert collection.indexes == {}
+
+
+def test_bulk_load_writes_to_staging_with_id_indexes():
+    db = FakeDatabase("db")
+    collector = make_collector(db, bulk_load=True)
+
+    assert collector.tweets is db["tweets_staging"]
+    for name in DATA_COLLECTIONS:
+        assert db[name + STAGING_SUFFIX].created == index_names(name)[:1]
+        assert db[name].created == []
+    assert db["meta"].created == index_names("meta")
+
+
+def test_finish_bulk_load_renames_into_empty_collections():
+    db = FakeDatabase("db")
+    collector = make_collector(db, bulk_load=True)
+    db["tweets_staging"].num_docs = 10
+
+    collector.finish_bulk_load()
+
+    assert db["tweets"].num_docs == 10
+    assert list(db["tweets"].indexes) == index_names("tweets")
+    assert db["tweets"].pipelines == []
+    assert db["tweets_staging"].num_docs == 0
+    # empty staging collections leave fully indexed live collections
+    assert list(db["users"].indexes) == index_names("users")
+    assert not collector.bulk_load
+    assert collector.tweets is db["tweets"]
+
+
+def test_finish_bulk_load_merges_into_stored_collections():
+    db = FakeDatabase("db")
+    make_collector(db, bulk_load=False)
+    db["users"].num_docs = 5
+    mongo._ensured_indexes.clear()
+
+    collector = make_collector(db, bulk_load=True)
+    db["users_staging"].num_docs = 10
+    db["users"].created = []
+    collector.finish_bulk_load()
+
+    assert db["users_staging"].pipelines == [merge_pipeline("users",
+                                                            "users")]
+    # the live indexes are kept through the merge
+    assert list(db["users"].indexes) == index_names("users")
+    assert db["users"].created == []
+    assert db["users_staging"].num_docs == 0
+
+
+def test_merge_pipeline_keeps_stored_documents():
+    tweets = merge_pipeline("tweets", "tweets")
+    assert tweets[-1]["$merge"]["on"] == "id"
+    assert tweets[-1]["$merge"]["whenMatched"] == "keepExisting"
+    # retweet ids are not uniquely indexed; stored ones are filtered out
+    retweets = merge_pipeline("retweets", "retweets")
+    assert retweets[0]["$lookup"]["from"] == "retweets"
+    assert retweets[-1]["$merge"]["on"] == "_id"
+
+
+def insert_statuses(collector, seqs):
+    collector.insert_tweets_batch(*flatten_page(
+        [make_status(FIRST_TWEET_ID + seq * ID_STEP) for seq in seqs]))
+
+
+def test_merge_staging_keeps_live_indexes_on_a_server(mongo_host):
+    live = MongoCollector(mongo_host, MONGO_TEST_DB, user_flush_interval=0)
+    insert_statuses(live, range(0, 60))
+    mongo._ensured_indexes.clear()
+
+    bulk = MongoCollector(mongo_host, MONGO_TEST_DB, user_flush_interval=0,
+                          bulk_load=True)
+    insert_statuses(bulk, range(40, 100))
+    bulk.finish_bulk_load()
+
+    page_tweets, _ = flatten_page(
+        [make_status(FIRST_TWEET_ID + seq * ID_STEP) for seq in range(100)])
+    tweets = bulk.db["tweets"]
+    assert sorted(tweets.distinct("id")) == \
+        sorted({tweet["id"] for tweet, _ in page_tweets})
+    for name in DATA_COLLECTIONS:
+        assert set(index_names(name)) <= \
+            set(bulk.db[name].index_information())
+        assert name + STAGING_SUFFIX not in bulk.db.list_collection_names()
+    live.close()
+    bulk.close()
@@ -0,0 +1,111 @@
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.bench_engines import write_auth_file
+from benchmarks.memory_db import MemoryDb
+from benchmarks.stub_server import StubSearchApi
+from tweet_collector.checkpoint import RangeCheckpoint, merge_ranges
+from tweet_collector.pipeline import PagePipeline, WriteQueue
+from tweet_collector.tweet_collector import TweetCollector
+
+
+def test_merge_ranges_joins_overlapping_and_adjacent_ranges():
+    merged, groups = merge_ranges([[50, 40], [30, 20], [20, 10], [25, 15],
+                                   [100, 60]])
+    assert merged == [[30, 10], [50, 40], [100, 60]]
+    assert groups[0] == [[20, 10], [25, 15], [30, 20]]
+
+
+def test_load_merged_collector_state_compacts_meta():
+    db = MemoryDb([[30, 20], [20, 10], [100, 60]])
+    assert db.load_merged_collector_state() == [[30, 10], [100, 60]]
+    assert db.load_collector_state() == [[30, 10], [100, 60]]
+
+
+def test_checkpoint_waits_for_queued_writes():
+    db = MemoryDb()
+    checkpoint = RangeCheckpoint(db, 10, pages=2)
+    release = threading.Event()
+    with ThreadPoolExecutor() as executor:
+        write_queue = WriteQueue(executor, depth=4)
+        write_queue.submit(release.wait)
+        checkpoint.page_queued(500, write_queue)
+        checkpoint.page_queued(400, write_queue)
+        assert db.load_collector_state() == []
+
+        release.set()
+        write_queue.drain()
+    assert db.load_collector_state() == [[400, 10]]
+
+    # an older checkpoint finishing late does not move the state back
+    checkpoint.save(450)
+    checkpoint.close()
+    checkpoint.save(300)
+    assert db.load_collector_state() == [[400, 10]]
+
+
+def test_collector_checkpoints_while_collecting():
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=1000) as api:
+        db = MemoryDb()
+        collector = TweetCollector(db, "stub",
+                                   auth_file=write_auth_file(directory, 1),
+                                   api_url=api.url, checkpoint_pages=2)
+        pages = collector.iter_pages()
+        for _ in range(5):
+            next(pages)
+        # drain waits for the checkpoints saved from the write callbacks
+        collector.write_queue.drain()
+
+        # the progress is saved before the range ends, as a crash would
+        # leave it
+        [[next_max_id, since_id]] = db.load_collector_state()
+        assert since_id == 0 and next_max_id < sys.maxsize
+        assert min(db.tweets) <= next_max_id
+        pages.close()
+        collector.executor.shutdown(wait=True)
+
+
+class RecordingDb(MemoryDb):
+    """keeps every collector state saved"""
+
+    def __init__(self):
+        super().__init__()
+        self.states = []
+
+    def save_collector_state(self, next_max_id, since_id, done, query=None):
+        self.states.append((next_max_id, done))
+        super().save_collector_state(next_max_id, since_id, done, query)
+
+
+def test_pipeline_checkpoints_once_pages_are_written():
+    db = MemoryDb()
+    checkpoint = RangeCheckpoint(db, 10, pages=1)
+    release = threading.Event()
+    pipeline = PagePipeline(list, lambda page: release.wait(), depth=2,
+                            writers=2).start()
+    pipeline.put([1])
+    checkpoint.page_queued(500, pipeline)
+    assert db.load_collector_state() == []
+
+    release.set()
+    pipeline.close()
+    assert db.load_collector_state() == [[500, 10]]
+
+
+def test_pipeline_collector_checkpoints_while_collecting():
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=1000) as api:
+        db = RecordingDb()
+        collector = TweetCollector(db, "stub",
+                                   auth_file=write_auth_file(directory, 1),
+                                   api_url=api.url, checkpoint_pages=2,
+                                   pipeline_depth=2)
+        collector.start_collector()
+        collector.executor.shutdown(wait=True)
+
+    checkpoints = [next_max_id for next_max_id, done in db.states
+                   if not done]
+    assert checkpoints and checkpoints == sorted(checkpoints, reverse=True)
+    assert db.states[-1][1]
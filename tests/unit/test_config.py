@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+import pytest
+from tweet_collector.config import created_at_to_ts, parse_created_at, \
+    CREATED_AT_DATETIME_FORMAT
+
+
+def test_parse_created_at_matches_strptime():
+    start = datetime(2018, 1, 1, 0, 0, 0)
+    for hours in range(0, 24 * 365, 37):
+        created_at = (start + timedelta(hours=hours, seconds=hours % 60)) \
+            .strftime("%a %b %d %H:%M:%S +0000 %Y")
+        assert parse_created_at(created_at) == \
+            datetime.strptime(created_at, CREATED_AT_DATETIME_FORMAT)
+
+
+@pytest.mark.parametrize("created_at", [
+    "Wed Oct 10 20:19:24 -0530 2018",
+    "Wed Oct 10 20:19:24 +0130 2018",
+])
+def test_parse_created_at_offsets(created_at):
+    parsed = parse_created_at(created_at)
+    assert parsed == datetime.strptime(created_at, CREATED_AT_DATETIME_FORMAT)
+    assert parsed.utcoffset() == \
+        datetime.strptime(created_at, CREATED_AT_DATETIME_FORMAT).utcoffset()
+
+
+def test_parse_created_at_falls_back_to_strptime():
+    assert parse_created_at("Wed Oct 1 20:19:24 +0000 2018") == \
+        datetime.strptime("Wed Oct 1 20:19:24 +0000 2018",
+                          CREATED_AT_DATETIME_FORMAT)
+    with pytest.raises(ValueError):
+        parse_created_at("Wed Foo 10 20:19:24 +0000 2018")
+
+
+def test_created_at_to_ts_is_cached():
+    created_at = "Thu Oct 11 20:19:24 +0000 2018"
+    assert created_at_to_ts(created_at) is created_at_to_ts(created_at)
@@ -0,0 +1,192 @@
+import time
+import pytest
+from pymongo import InsertOne, UpdateOne
+from tweet_collector.db.mongo import MongoCollector
+from tweet_collector.db.cache import UserCache, UserWriteBuffer, PlaceCache
+
+
+CREATED_AT = "Wed Oct 10 20:19:24 +0000 2018"
+SNOWFLAKE_ID = 1050000000000000000
+
+
+class FakeCollection(object):
+    name = "fake"
+
+    def __init__(self):
+        self.bulk_ops = []
+
+    def bulk_write(self, ops, ordered=True):
+        assert not ordered
+        self.bulk_ops.append(ops)
+
+
+def make_collector(user_buffer=None):
+    """MongoCollector with fake collections and no mongo connection"""
+    collector = MongoCollector.__new__(MongoCollector)
+    collector.user_cache = UserCache()
+    collector.user_buffer = user_buffer
+    collector.place_cache = PlaceCache(lambda: ["stored"])
+    collector.tweets = FakeCollection()
+    collector.users = FakeCollection()
+    collector.places = FakeCollection()
+    collector.retweets = FakeCollection()
+    return collector
+
+
+def make_user(user_id):
+    return {"id": user_id, "screen_name": f"user{user_id}", "name": "name",
+            "location": "here", "profile_image_url_https": "https://img",
+            "followers_count": 1, "created_at": CREATED_AT,
+            "friends_count": 1, "statuses_count": 1, "description": "desc",
+            "unused": "dropped"}
+
+
+def make_tweet(tweet_id, user_id, place=None):
+    return {"id": tweet_id, "created_at": CREATED_AT, "full_text": "text",
+            "user": make_user(user_id), "place": place, "lang": "en"}
+
+
+def test_insert_tweets_batch_one_bulk_write_per_collection():
+    collector = make_collector()
+    place = {"id": "p1", "bounding_box": {
+        "type": "Polygon",
+        "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0]]]}}
+    tweets = [make_tweet(2, 10, place), make_tweet(1, 10), make_tweet(3, 11)]
+    tweets = [(tweet, tweet["user"]) for tweet in tweets]
+
+    retweet = make_tweet(4, 12)
+    retweet["retweeted_status"] = {"id": 1}
+
+    collector.insert_tweets_batch(tweets, [(retweet, retweet["user"])])
+
+    tweet_ops, = collector.tweets.bulk_ops
+    assert len(tweet_ops) == 3
+    assert all(isinstance(op, InsertOne) for op in tweet_ops)
+
+    # one upsert per user, guarded on last_tweet_ts
+    user_ops, = collector.users.bulk_ops
+    assert len(user_ops) == 3
+    assert all(isinstance(op, UpdateOne) for op in user_ops)
+
+    place_ops, = collector.places.bulk_ops
+    assert len(place_ops) == 1
+
+    retweet_ops, = collector.retweets.bulk_ops
+    assert len(retweet_ops) == 1
+    assert tweet_ops[0]._doc["place_id"] == "p1"
+    assert "place" not in tweet_ops[0]._doc
+    assert all("unused" not in op._doc["$set"] for op in user_ops)
+    # retweets are upserted on id, so a replayed page adds no copies
+    assert retweet_ops[0]._filter == {"id": 4}
+    assert set(retweet_ops[0]._doc["$setOnInsert"]) == {
+        "id", "user_id", "tweet_id", "created_at", "timestamp"}
+
+
+def test_insert_tweets_batch_skips_empty_collections():
+    collector = make_collector()
+    collector.insert_tweets_batch([], [])
+    assert not collector.tweets.bulk_ops
+    assert not collector.users.bulk_ops
+
+
+def test_normalize_tweet_validates_and_projects():
+    collector = make_collector()
+    tweet = make_tweet(1, 10)
+    record, user, place = collector.normalize_tweet(tweet, tweet["user"])
+
+    assert place is None
+    assert set(record) == {"id", "created_at", "full_text", "timestamp",
+                           "user_id"}
+    assert "unused" not in user and user["last_tweet_id"] == 1
+    # the api dicts are left untouched
+    assert "lang" in tweet
+
+    del tweet["full_text"]
+    with pytest.raises(KeyError):
+        collector.normalize_tweet(tweet, tweet["user"])
+
+
+def test_user_writes_skip_stale_and_coalesce():
+    collector = make_collector(UserWriteBuffer(flush_interval=60))
+    # snowflake ids 1 ms apart, so the timestamps follow the ids
+    ids = [SNOWFLAKE_ID + (seq << 22) for seq in (3, 2, 4)]
+    pages = [[make_tweet(tweet_id, 10)] for tweet_id in ids]
+    for page in pages:
+        collector.insert_tweets_batch(
+            [(tweet, tweet["user"]) for tweet in page], [])
+
+    # the newest version of the user is buffered
+    assert not collector.users.bulk_ops
+
+    collector.flush()
+    user_ops, = collector.users.bulk_ops
+    assert len(user_ops) == 1
+    assert user_ops[0]._doc["$set"]["last_tweet_id"] == ids[2]
+
+    # once written, older tweets of the user cannot win
+    collector.insert_tweets_batch([(pages[0][0], pages[0][0]["user"])], [])
+    collector.flush()
+    assert collector.user_cache.hits == 1
+    assert len(collector.users.bulk_ops) == 1
+
+
+def test_failed_user_writes_are_not_cached():
+    class FailingCollection(FakeCollection):
+        def bulk_write(self, ops, ordered=True):
+            raise IOError("write failed")
+
+    collector = make_collector(UserWriteBuffer(flush_interval=60))
+    collector.users = FailingCollection()
+    tweet = make_tweet(SNOWFLAKE_ID, 10)
+    collector.insert_tweets_batch([(tweet, tweet["user"])], [])
+    with pytest.raises(IOError):
+        collector.flush()
+
+    # the user stays buffered and can still win
+    assert collector.user_buffer.pending
+    assert collector.user_cache.wins(10, 0)
+
+
+def test_buffered_users_are_flushed_by_a_timer():
+    collector = make_collector(UserWriteBuffer(flush_interval=0.01))
+    tweet = make_tweet(SNOWFLAKE_ID, 10)
+    collector.insert_tweets_batch([(tweet, tweet["user"])], [])
+    deadline = time.monotonic() + 5
+    while not collector.users.bulk_ops and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert collector.users.bulk_ops
+
+
+def make_place(place_id, coordinates):
+    return {"id": place_id, "bounding_box": {"type": "Polygon",
+                                             "coordinates": [coordinates]}}
+
+
+def test_known_places_are_not_written_again():
+    collector = make_collector()
+    box = [[-74.1, 40.5], [-74.1, 40.9], [-73.7, 40.9], [-73.7, 40.5]]
+    for place_id in ["p1", "p1", "stored"]:
+        tweet = make_tweet(1, 10, make_place(place_id, list(box)))
+        collector.insert_tweets_batch([(tweet, tweet["user"])], [])
+
+    place_ops, = collector.places.bulk_ops
+    assert len(place_ops) == 1
+    assert place_ops[0]._doc["bounding_box"]["coordinates"] == \
+        [box + [box[0]]]
+
+
+def test_degenerate_bounding_box_becomes_point():
+    collector = make_collector()
+    place = collector.normalize_place(
+        make_place("p", [[2, 3], [2, 3], [2, 3], [2, 3]]))
+    assert place["bounding_box"] == {"type": "Point", "coordinates": [2, 3]}
+
+
+def test_insert_tweet_ignores_duplicates():
+    from benchmarks.memory_mongo import MemoryMongoCollector
+    collector = MemoryMongoCollector()
+    tweet = make_tweet(SNOWFLAKE_ID, 10)
+    collector.insert_tweet(dict(tweet), tweet["user"])
+    collector.insert_tweet(dict(tweet), tweet["user"])
+    assert list(collector.tweets.docs) == [SNOWFLAKE_ID]
+    assert list(collector.users.docs) == [10]
@@ -0,0 +1,29 @@
+import json
+from benchmarks.stub_server import make_status, FIRST_TWEET_ID, ID_STEP
+from tweet_collector.config import REQUIRED_USER_ATTRS
+from tweet_collector.decode import decode_search
+
+
+def test_decode_search_projects_nested_statuses():
+    # seq 0 is a retweet, seq 1 quotes another status
+    statuses = [make_status(FIRST_TWEET_ID + seq * ID_STEP) for seq in (0, 1)]
+    content = json.dumps({"statuses": statuses,
+                          "search_metadata": {"count": 2}}).encode("utf-8")
+
+    decoded, metadata = decode_search(content, project=True)
+
+    assert metadata == {"count": 2}
+    retweet, quote = decoded
+    assert "entities" not in retweet
+    assert retweet["retweeted_status"]["id"] == \
+        statuses[0]["retweeted_status"]["id"]
+    assert "entities" not in retweet["retweeted_status"]
+    assert quote["quoted_status"]["full_text"] == \
+        statuses[1]["quoted_status"]["full_text"]
+    assert set(quote["user"]) == set(REQUIRED_USER_ATTRS)
+
+
+def test_decode_search_without_projection_keeps_statuses():
+    status = make_status(FIRST_TWEET_ID + 2 * ID_STEP)
+    decoded, _ = decode_search(json.dumps({"statuses": [status]}))
+    assert decoded == [status]
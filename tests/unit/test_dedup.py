@@ -0,0 +1,100 @@
+import os
+import tempfile
+from benchmarks.memory_db import MemoryDb
+from tweet_collector.dedup import BloomFilter, SeenIds
+from tweet_collector.tweet_collector import flatten_page
+
+FIRST_ID = 1050000000000000000
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    ids = [FIRST_ID + i * 4194304 for i in range(1000)]
+    for tweet_id in ids:
+        bloom.add(tweet_id)
+    assert all(tweet_id in bloom for tweet_id in ids)
+
+    false_positives = sum(FIRST_ID + i * 4194304 + 1 in bloom
+                          for i in range(1000))
+    assert false_positives < 50
+
+
+def test_bloom_filter_save_and_load():
+    bloom = BloomFilter(100)
+    bloom.add(FIRST_ID)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "seen.bloom")
+        bloom.save(path)
+        loaded = BloomFilter.load(path)
+    assert FIRST_ID in loaded
+    assert (loaded.num_bits, loaded.num_hashes, loaded.count) == \
+        (bloom.num_bits, bloom.num_hashes, 1)
+
+
+def test_seen_ids_skips_only_stored_statuses():
+    db = MemoryDb()
+    db.tweets[FIRST_ID] = {"id": FIRST_ID}
+    db.retweets[FIRST_ID + 1] = {"id": FIRST_ID + 1}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "seen.bloom")
+        seen_ids = SeenIds(db, path, min_capacity=100)
+        seen_ids.save()
+
+        # a positive that is not stored is confirmed with the db and kept
+        seen_ids.add([FIRST_ID + 2])
+        page_tweets = [({"id": FIRST_ID}, {}), ({"id": FIRST_ID + 2}, {})]
+        page_retweets = [({"id": FIRST_ID + 1}, {}),
+                         ({"id": FIRST_ID + 3}, {})]
+        page_tweets, page_retweets = seen_ids.filter_page(page_tweets,
+                                                          page_retweets)
+        assert [tweet["id"] for tweet, _ in page_tweets] == [FIRST_ID + 2]
+        assert [retweet["id"] for retweet, _ in page_retweets] == \
+            [FIRST_ID + 3]
+        assert seen_ids.skipped == 2
+
+        # warm loaded from the saved file instead of the db
+        assert FIRST_ID in SeenIds(MemoryDb(), path).bloom
+
+
+def test_stored_statuses_are_dropped_before_flattening():
+    db = MemoryDb()
+    db.retweets[FIRST_ID + 1] = {"id": FIRST_ID + 1}
+    db.tweets[FIRST_ID] = {"id": FIRST_ID}
+    original = {"id": FIRST_ID, "user": {"id": 1}}
+    statuses = [{"id": FIRST_ID + 1, "user": {"id": 2},
+                 "retweeted_status": original},
+                {"id": FIRST_ID + 2, "user": {"id": 3},
+                 "quoted_status": original}]
+
+    seen_ids = SeenIds(db, min_capacity=100)
+    left, stored = seen_ids.filter_statuses(statuses)
+    # the stored retweet is not flattened, the stored original it shares
+    # with a new status is dropped afterwards
+    assert left == statuses[1:]
+    assert stored == {FIRST_ID, FIRST_ID + 1}
+    page_tweets, page_retweets = seen_ids.filter_page(
+        *flatten_page(left), stored)
+    assert [tweet["id"] for tweet, _ in page_tweets] == [FIRST_ID + 2]
+    assert page_retweets == []
+    assert seen_ids.skipped == 2
+
+
+def test_seen_ids_rebuilds_an_overfull_filter():
+    db = MemoryDb()
+    for seq in range(50):
+        db.tweets[FIRST_ID + seq] = {"id": FIRST_ID + seq}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "seen.bloom")
+        BloomFilter(10).save(path)
+        seen_ids = SeenIds(db, path, min_capacity=10)
+        # rebuilt from the db, sized for twice the stored ids
+        assert seen_ids.bloom.capacity == 100
+        assert FIRST_ID + 49 in seen_ids.bloom
+
+        seen_ids.add(range(FIRST_ID + 50, FIRST_ID + 160))
+        for seq in range(50, 160):
+            db.tweets[FIRST_ID + seq] = {"id": FIRST_ID + seq}
+        seen_ids.save()
+        assert BloomFilter.load(path).capacity == 320
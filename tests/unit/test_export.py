@@ -0,0 +1,137 @@
+import os
+import gzip
+import json
+import tempfile
+from functools import partial
+import pytest
+from click.testing import CliRunner
+from benchmarks.stub_server import make_status, FIRST_TWEET_ID, ID_STEP
+from tweet_collector.cli.cli import cli
+from tweet_collector.db.segments import SegmentCollector
+from tweet_collector.db.sqlite import SqliteCollector
+from tweet_collector.export import export, shard_ranges, export_max_id, \
+    load_watermark, exportable
+from tweet_collector.tweet_collector import flatten_page
+
+
+@pytest.fixture
+def directory():
+    with tempfile.TemporaryDirectory() as directory:
+        yield directory
+
+
+def add_page(db, first_seq, num_statuses=50):
+    page_tweets, page_retweets = flatten_page(
+        [make_status(FIRST_TWEET_ID + seq * ID_STEP)
+         for seq in range(first_seq, first_seq + num_statuses)])
+    db.insert_tweets_batch(page_tweets, page_retweets)
+
+
+def read_export(export_dir):
+    tweets = []
+    for name in sorted(os.listdir(export_dir)):
+        if name.endswith(".jsonl.gz"):
+            with gzip.open(os.path.join(export_dir, name), "rt") as fp:
+                tweets.extend(json.loads(line) for line in fp)
+    return tweets
+
+
+def test_shard_ranges_cover_the_range():
+    assert shard_ranges(0, 10, 3) == [(0, 4), (4, 8), (8, 10)]
+    assert shard_ranges(5, 6, 4) == [(5, 6)]
+
+
+def test_iter_tweet_batches_joins_users_and_places(directory):
+    db = SqliteCollector(directory, "test")
+    add_page(db, 0)
+    batches = list(db.iter_tweet_batches(batch_size=7))
+
+    tweets = [tweet for batch in batches for tweet in batch]
+    assert all(len(batch) <= 7 for batch in batches)
+    tweet_ids = [tweet["id"] for tweet in tweets]
+    assert tweet_ids == sorted(set(tweet_ids))
+    assert len(tweet_ids) == db.query("SELECT count(*) FROM tweets")[0][0]
+    assert all(tweet["user"]["id"] == tweet["user_id"] for tweet in tweets)
+    placed = [tweet for tweet in tweets if tweet.get("place_id")]
+    assert placed and all(tweet["place"]["id"] == tweet["place_id"]
+                          for tweet in placed)
+
+
+def test_export_is_incremental_and_bounded_by_open_ranges(directory):
+    db_dir = os.path.join(directory, "db")
+    export_dir = os.path.join(directory, "export")
+    db = SqliteCollector(db_dir, "test")
+    db_factory = partial(SqliteCollector, db_dir, "test")
+    add_page(db, 0)
+    first_ids = sorted(tweet["id"] for batch in db.iter_tweet_batches()
+                       for tweet in batch)
+
+    assert export(db_factory, export_dir, shards=3, batch_size=10) == \
+        len(first_ids)
+    assert sorted(tweet["id"] for tweet in read_export(export_dir)) == \
+        first_ids
+    assert load_watermark(export_dir) == first_ids[-1]
+
+    # an unfinished range holds back the tweets above its since_id
+    add_page(db, 100)
+    newer_ids = sorted(tweet["id"] for batch in
+                       db.iter_tweet_batches(first_ids[-1]) for tweet in batch)
+    since_id = newer_ids[len(newer_ids) // 2]
+    db.save_collector_state(newer_ids[-1], since_id, False)
+    assert export_max_id(db) == since_id
+
+    export(db_factory, export_dir, shards=2)
+    assert load_watermark(export_dir) == since_id
+    db.save_collector_state(newer_ids[-1], since_id, True)
+    export(db_factory, export_dir, shards=2)
+
+    assert sorted(tweet["id"] for tweet in read_export(export_dir)) == \
+        first_ids + newer_ids
+    assert export(db_factory, export_dir) == 0
+
+
+def test_unfinished_shard_files_are_replaced(directory):
+    db_dir = os.path.join(directory, "db")
+    export_dir = os.path.join(directory, "export")
+    db = SqliteCollector(db_dir, "test")
+    add_page(db, 0)
+    os.makedirs(export_dir)
+    stale = os.path.join(export_dir, "tweets-5-10.jsonl.gz.tmp")
+    open(stale, "w").close()
+
+    export(partial(SqliteCollector, db_dir, "test"), export_dir, shards=1)
+    assert not os.path.exists(stale)
+
+
+class ClosingCollector(SqliteCollector):
+    opened = []
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.closed = False
+        self.opened.append(self)
+
+    def close(self):
+        self.closed = True
+        super().close()
+
+
+def test_export_closes_its_connections(directory):
+    db_dir = os.path.join(directory, "db")
+    db = SqliteCollector(db_dir, "test")
+    add_page(db, 0)
+
+    ClosingCollector.opened = []
+    assert export(partial(ClosingCollector, db_dir, "test"),
+                  os.path.join(directory, "export"), shards=1)
+    assert len(ClosingCollector.opened) == 2
+    assert all(opened.closed for opened in ClosingCollector.opened)
+
+
+def test_export_needs_a_module_that_reads_tweets(directory):
+    assert exportable(SqliteCollector)
+    assert not exportable(SegmentCollector)
+    result = CliRunner().invoke(cli, ["export", "segments", directory,
+                                      "test", directory])
+    assert result.exit_code == 2
+    assert "segments cannot be exported" in result.output
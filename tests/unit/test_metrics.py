@@ -0,0 +1,89 @@
+import os
+import time
+import signal
+import tempfile
+import requests
+from benchmarks.bench_engines import write_auth_file
+from benchmarks.memory_db import MemoryDb
+from benchmarks.stub_server import StubSearchApi
+from tweet_collector.metrics import Registry, MetricsServer, REGISTRY, \
+    STAGE_SECONDS, GET_TWEETS_SECONDS, TOKEN_LIMIT_REMAINING
+from tweet_collector.profiler import install_profiler_signal
+from tweet_collector.tweet_collector import TweetCollector
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    pages = registry.counter("pages_total", "Pages")
+    latency = registry.histogram("latency_seconds", "Latency",
+                                 buckets=(0.1, 1))
+    depth = registry.gauge("depth", "Depth")
+    pages.inc(2, token="0")
+    latency.observe(0.05, stage="http")
+    latency.observe(0.5, stage="http")
+    depth.set_function(lambda: 3)
+
+    text = registry.render()
+    assert '# TYPE pages_total counter' in text
+    assert 'pages_total{token="0"} 2' in text
+    assert 'latency_seconds_bucket{stage="http",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{stage="http",le="+Inf"} 2' in text
+    assert 'latency_seconds_count{stage="http"} 2' in text
+    assert 'depth 3' in text
+    assert "p99<=1000ms" in registry.summary()
+
+    with MetricsServer(registry, 0) as server:
+        res = requests.get(f"http://127.0.0.1:{server.port}/metrics")
+    assert res.text == registry.render()
+
+
+def test_summary_skips_series_never_observed():
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency",
+                                 buckets=(0.1, 1))
+    latency.labels(op="insert_tweet")
+    assert registry.summary() == ""
+
+    latency.observe(0.5, op="write")
+    assert registry.summary().startswith('latency_seconds{op="write"} n=1')
+
+
+def test_collector_stages_are_measured():
+    get_tweets = GET_TWEETS_SECONDS.count()
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=300) as api:
+        collector = TweetCollector(MemoryDb(), "stub",
+                                   auth_file=write_auth_file(directory, 2),
+                                   api_url=api.url)
+        collector.start_collector()
+        collector.executor.shutdown(wait=True)
+        pages = api.search_requests
+
+    assert GET_TWEETS_SECONDS.count() - get_tweets == pages
+    for stage in ("http", "decode", "normalize", "write"):
+        assert STAGE_SECONDS.count(stage=stage) > 0
+    assert 'tweet_collector_token_limit_remaining{token="1"}' in \
+        TOKEN_LIMIT_REMAINING.render()
+    assert "tweet_collector_write_queue_depth 0" in REGISTRY.render()
+
+
+def test_profiler_toggles_on_signal():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "profile")
+        previous = signal.getsignal(signal.SIGUSR2)
+        profiler = install_profiler_signal(path, interval=0.001)
+        try:
+            os.kill(os.getpid(), signal.SIGUSR2)
+            deadline = time.monotonic() + 0.2
+            while time.monotonic() < deadline:
+                sum(range(1000))
+            os.kill(os.getpid(), signal.SIGUSR2)
+        finally:
+            signal.signal(signal.SIGUSR2, previous)
+
+        assert not profiler.running
+        [written] = os.listdir(directory)
+        with open(os.path.join(directory, written)) as fp:
+            lines = fp.read().splitlines()
+    assert any("test_profiler_toggles_on_signal" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
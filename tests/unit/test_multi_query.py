@@ -0,0 +1,61 @@
+import os
+import tempfile
+import pytest
+from benchmarks.bench_engines import write_auth_file
+from benchmarks.memory_db import MemoryDb
+from benchmarks.stub_server import StubSearchApi
+from tweet_collector.multi_query import MultiQueryCollector, read_queries
+
+
+def test_read_queries():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "queries.txt")
+        with open(path, "w") as fp:
+            fp.write("# tracked\nbig cats\t3\n\nsmall dogs\n")
+        assert read_queries(path) == [("big cats", 3.0), ("small dogs", 1.0)]
+
+
+def test_queries_share_tokens_and_keep_their_own_state():
+    num_tweets = 300
+    db = MemoryDb()
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=num_tweets) as api:
+        collector = MultiQueryCollector(db, [("cats", 2), "dogs"],
+                                        auth_file=write_auth_file(directory,
+                                                                  2),
+                                        api_url=api.url)
+        collector.start_collector()
+
+    # both queries ran to the end of their most recent range over one pool
+    assert collector.collectors[0].token_pool is \
+        collector.collectors[1].token_pool
+    assert collector.collectors[0].write_queue is \
+        collector.collectors[1].write_queue is collector.write_queue
+    assert {query for query, _ in db.meta} == {"cats", "dogs"}
+    assert all(state["done"] for state in db.meta.values())
+    for query in ("cats", "dogs"):
+        state = db.load_query_state(query)
+        assert state["max_id"] == api.ids[-1]
+        assert 0 <= state["rate"] < 100
+    assert set(api.ids) <= set(db.tweets) | set(db.retweets)
+
+
+def test_a_failed_write_of_one_query_stops_every_query_state():
+    db = MemoryDb()
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=1000) as api:
+        collector = MultiQueryCollector(db, ["cats", "dogs"],
+                                        auth_file=write_auth_file(directory,
+                                                                  2),
+                                        api_url=api.url)
+
+        def fail(tweets):
+            raise IOError("write failed")
+        collector.collectors[1].insert_page = fail
+
+        # the error of a dogs page is raised while fetching cats pages
+        with pytest.raises(IOError):
+            collector.start_collector()
+
+    assert not [query for query, _ in db.meta if query == "dogs"]
+    assert "max_id" not in db.load_query_state("dogs")
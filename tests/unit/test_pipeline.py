@@ -0,0 +1,57 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from tweet_collector.pipeline import PagePipeline, WriteQueue
+
+
+def test_pages_flow_through_stages():
+    written = []
+    pipeline = PagePipeline(lambda page: [x * 2 for x in page],
+                            written.append, depth=1, writers=1).start()
+    for page in ([1], [2], [3]):
+        pipeline.put(page)
+    pipeline.close()
+    assert written == [[2], [4], [6]]
+
+
+def test_write_errors_are_raised_on_close():
+    def write(page):
+        raise ValueError("db down")
+
+    pipeline = PagePipeline(list, write, depth=1).start()
+    pipeline.put([1])
+    with pytest.raises(ValueError):
+        pipeline.close()
+
+
+def test_write_queue_bounds_writes_in_flight():
+    release = threading.Event()
+    in_flight = []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        write_queue = WriteQueue(executor, depth=2)
+        for page in range(2):
+            write_queue.submit(lambda page: (in_flight.append(page),
+                                             release.wait()), page)
+
+        # a third submit blocks until a write finishes
+        blocked = threading.Thread(target=write_queue.submit,
+                                   args=(in_flight.append, 2))
+        blocked.start()
+        blocked.join(0.2)
+        assert blocked.is_alive() and sorted(in_flight) == [0, 1]
+
+        release.set()
+        blocked.join()
+        write_queue.drain()
+    assert sorted(in_flight) == [0, 1, 2] and len(write_queue) == 0
+
+
+def test_write_queue_raises_write_errors():
+    def write(page):
+        raise ValueError("db down")
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        write_queue = WriteQueue(executor, depth=1)
+        write_queue.submit(write, [1])
+        with pytest.raises(ValueError):
+            write_queue.drain()
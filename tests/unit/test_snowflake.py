@@ -0,0 +1,37 @@
+from datetime import datetime, timezone
+from benchmarks.stub_server import make_status, FIRST_TWEET_ID, ID_STEP
+from tweet_collector.config import created_at_to_ts
+from tweet_collector.snowflake import id_to_datetime, datetime_to_id, \
+    time_window_to_ids, status_timestamp
+
+
+def test_id_time_round_trip():
+    # 1050000000000000000 was created 2018-10-10 12:28:02.713 utc
+    assert id_to_datetime(1050000000000000000) == \
+        datetime(2018, 10, 10, 12, 28, 2, 713000, timezone.utc)
+    dt = datetime(2019, 5, 1, 12, 30, tzinfo=timezone.utc)
+    assert id_to_datetime(datetime_to_id(dt)) == dt
+    assert datetime_to_id(dt.replace(tzinfo=None)) == datetime_to_id(dt)
+
+
+def test_time_window_to_ids_bounds_ids_in_window():
+    since = datetime(2019, 5, 1, tzinfo=timezone.utc)
+    until = datetime(2019, 5, 2, tzinfo=timezone.utc)
+    since_id, max_id = time_window_to_ids(since, until)
+
+    # since_id is exclusive, max_id inclusive
+    assert id_to_datetime(since_id + 1) == since
+    assert id_to_datetime(max_id) < until <= id_to_datetime(max_id + 1)
+    assert time_window_to_ids() == (None, None)
+
+
+def test_status_timestamp_matches_created_at():
+    for seq in range(0, 500, 7):
+        status = make_status(FIRST_TWEET_ID + seq * ID_STEP)
+        assert status_timestamp(status).replace(microsecond=0) == \
+            created_at_to_ts(status["created_at"])
+
+
+def test_status_timestamp_parses_pre_snowflake_ids():
+    status = {"id": 20, "created_at": "Tue Mar 21 20:50:14 +0000 2006"}
+    assert status_timestamp(status) == created_at_to_ts(status["created_at"])
@@ -0,0 +1,183 @@
+import os
+import time
+import threading
+import tempfile
+from unittest import mock
+from benchmarks.stub_server import make_status, FIRST_TWEET_ID, ID_STEP
+from tweet_collector import spool
+from tweet_collector.db.sqlite import SqliteCollector
+from tweet_collector.spool import Spool, SpoolDb, drain
+from tweet_collector.tweet_collector import flatten_page
+from conftest import MONGO_TEST_DB
+
+
+def make_page(first_seq, num_statuses=20):
+    return flatten_page([make_status(FIRST_TWEET_ID + seq * ID_STEP)
+                         for seq in range(first_seq,
+                                          first_seq + num_statuses)])
+
+
+class FlakyDb(SqliteCollector):
+    """fails the first writes like a database in a maintenance window"""
+
+    def __init__(self, address, db_name, failures):
+        super().__init__(address, db_name)
+        self.failures = failures
+        self.calls = []
+
+    def insert_tweets_batch(self, tweets, retweets):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("database unavailable")
+        self.calls.append("page")
+        super().insert_tweets_batch(tweets, retweets)
+
+    def save_collector_state(self, next_max_id, since_id, done, query=None):
+        self.calls.append("state")
+        super().save_collector_state(next_max_id, since_id, done, query)
+
+
+def test_spool_rotates_and_skips_partial_lines():
+    with tempfile.TemporaryDirectory() as directory:
+        log = Spool(directory, max_segment_bytes=50)
+        for idx in range(5):
+            log.append({"op": "state", "idx": idx})
+        assert len(log.segments()) > 1
+
+        with open(log.path(log.seq), "ab") as fp:
+            fp.write(b'{"op": "st')
+        entries, position = log.read((1, 0))
+        assert [entry["idx"] for entry in entries] == list(range(5))
+
+        log.remove_before(position[0])
+        assert log.segments() == [position[0]]
+        assert log.read(position)[0] == []
+
+
+def test_rotated_segments_are_synced_before_a_later_state():
+    with tempfile.TemporaryDirectory() as directory:
+        log = Spool(directory, max_segment_bytes=50)
+        synced = []
+        real_fsync = os.fsync
+
+        def fsync(fd):
+            if not os.path.isdir(f"/proc/self/fd/{fd}"):
+                synced.append(os.path.basename(os.readlink(
+                    f"/proc/self/fd/{fd}")))
+            real_fsync(fd)
+
+        with mock.patch.object(spool.os, "fsync", fsync):
+            for idx in range(5):
+                log.append({"op": "page", "idx": idx})
+            log.append({"op": "state"}, sync=True)
+        segments = log.segments()
+        assert len(segments) > 1
+        assert set(synced) == {os.path.basename(log.path(seq))
+                               for seq in segments}
+        log.close()
+
+
+def test_drainer_retries_until_the_database_is_back():
+    with tempfile.TemporaryDirectory() as directory, \
+            mock.patch.object(spool.time, "sleep"):
+        db = FlakyDb(directory, "test", failures=2)
+        spool_db = SpoolDb(db, os.path.join(directory, "spool"),
+                           drain=False)
+        statuses = 0
+        for first_seq in (0, 20):
+            page_tweets, page_retweets = make_page(first_seq)
+            statuses += len(page_tweets) + len(page_retweets)
+            spool_db.insert_tweets_batch(page_tweets, page_retweets)
+        spool_db.save_collector_state(100, 10, False)
+        # drained once everything is spooled, so the pages are read together
+        spool_db.drainer = spool.Drainer(db, spool_db.spool).start()
+        spool_db.close()
+
+        assert db.estimate_tweet_count() == statuses
+        assert db.load_collector_state() == [[100, 10]]
+        # pages spooled together are written in one batch, before the state
+        assert db.calls == ["page", "state"]
+
+
+class SlowDb(SqliteCollector):
+    """blocks writes until released"""
+
+    def __init__(self, address, db_name):
+        super().__init__(address, db_name)
+        self.released = threading.Event()
+
+    def insert_tweets_batch(self, tweets, retweets):
+        self.released.wait(5)
+
+
+def test_drainer_skips_a_corrupt_entry():
+    with tempfile.TemporaryDirectory() as directory:
+        spool_dir = os.path.join(directory, "spool")
+        spool_db = SpoolDb(SqliteCollector(directory, "test"), spool_dir,
+                           drain=False)
+        spool_db.save_collector_state(100, 10, False)
+        with open(spool_db.spool.path(spool_db.spool.seq), "ab") as fp:
+            fp.write(b'{"op": "st\n')
+        spool_db.save_collector_state(200, 150, False)
+        spool_db.close()
+
+        db = SqliteCollector(directory, "test")
+        drain(db, spool_dir)
+        assert db.load_collector_state() == [[100, 10], [200, 150]]
+
+
+def test_stop_returns_at_the_deadline_of_a_slow_database():
+    with tempfile.TemporaryDirectory() as directory:
+        spool_db = SpoolDb(SlowDb(directory, "test"),
+                           os.path.join(directory, "spool"))
+        page_tweets, page_retweets = make_page(0)
+        spool_db.insert_tweets_batch(page_tweets, page_retweets)
+        time.sleep(0.1)
+
+        start = time.monotonic()
+        spool_db.close(timeout=0.5)
+        assert time.monotonic() - start < 2
+        spool_db.db.released.set()
+        spool_db.drainer.thread.join()
+
+
+def test_drain_a_leftover_spool():
+    with tempfile.TemporaryDirectory() as directory:
+        spool_dir = os.path.join(directory, "spool")
+        spool_db = SpoolDb(SqliteCollector(directory, "test"), spool_dir,
+                           drain=False)
+        page_tweets, page_retweets = make_page(0)
+        spool_db.insert_tweets_batch(page_tweets, page_retweets)
+        spool_db.close()
+
+        db = SqliteCollector(directory, "test")
+        assert db.estimate_tweet_count() == 0
+        assert drain(db, spool_dir) == len(page_tweets) + len(page_retweets)
+        assert db.estimate_tweet_count() == len(page_tweets) + \
+            len(page_retweets)
+        # replaying a drained spool writes nothing
+        assert drain(db, spool_dir) == 0
+
+
+def test_replaying_a_batch_into_mongo_adds_no_copies(mongo_host):
+    from tweet_collector.db.mongo import MongoCollector
+    db = MongoCollector(mongo_host, MONGO_TEST_DB, user_flush_interval=0)
+    page_tweets, page_retweets = make_page(0)
+    assert page_retweets
+    with tempfile.TemporaryDirectory() as directory:
+        log = Spool(directory)
+        log.append({"op": "page", "tweets": page_tweets,
+                    "retweets": page_retweets})
+        entries, _ = log.read((log.seq, 0))
+        # a crash before the position is saved replays the batch
+        drainer = spool.Drainer(db, log)
+        drainer.apply(entries)
+        drainer.apply(entries)
+        log.close()
+
+    for collection, records in ((db.tweets, page_tweets),
+                                (db.retweets, page_retweets)):
+        ids = [doc["id"] for doc in collection.find({}, {"id": 1})]
+        assert sorted(ids) == sorted({record["id"]
+                                      for record, _ in records})
+    db.close()
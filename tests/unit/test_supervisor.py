@@ -0,0 +1,132 @@
+import os
+import sys
+import tempfile
+from functools import partial
+from benchmarks.bench_engines import write_auth_file, gap_ranges
+from benchmarks.memory_db import MemoryDb
+from benchmarks.stub_server import StubSearchApi, FIRST_TWEET_ID, ID_STEP
+from tweet_collector import supervisor as supervisor_module
+from tweet_collector.db.sqlite import SqliteCollector
+from tweet_collector.supervisor import Supervisor, shard
+
+
+def test_shard_deals_round_robin():
+    assert shard([1, 2, 3, 4, 5], 2) == [[1, 3, 5], [2, 4]]
+
+
+def test_plan_splits_and_records_ranges():
+    db = MemoryDb([[sys.maxsize, 10 ** 18], [2 ** 59 + 4000 * ID_STEP,
+                                             2 ** 59]])
+    with tempfile.TemporaryDirectory() as directory:
+        supervisor = Supervisor(MemoryDb, "q", 2,
+                                auth_file=write_auth_file(directory, 2),
+                                split_ms=(ID_STEP >> 22) * 1000)
+    sub_ranges = supervisor.plan(db)
+
+    assert sub_ranges == sorted(sub_ranges, reverse=True)
+    assert all(next_max_id < sys.maxsize for next_max_id, _ in sub_ranges)
+    assert sorted(sub_ranges, key=lambda r: r[1]) == \
+        db.load_collector_state()
+    assert [[2 ** 59 + 1000 * ID_STEP, 2 ** 59]] == \
+        [r for r in sub_ranges if r[1] == 2 ** 59]
+
+
+def make_db(directory, num_tweets, db_class=SqliteCollector):
+    """a database file shared by the processes, with the stub's id space
+    left to collect"""
+    db_dir = os.path.join(directory, "db")
+    db = db_class(db_dir, "test")
+    for next_max_id, since_id in gap_ranges(num_tweets, 2):
+        db.save_collector_state(next_max_id, since_id, False)
+    db.close()
+    return partial(db_class, db_dir, "test")
+
+
+def stored_ids(db):
+    return {tweet_id for table in ("tweets", "retweets")
+            for (tweet_id,) in db.query(f"SELECT id FROM {table}")}
+
+
+def stub_ids(num_tweets):
+    return {FIRST_TWEET_ID + seq * ID_STEP for seq in range(num_tweets)}
+
+
+def test_workers_collect_their_shares():
+    num_tweets = 400
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=num_tweets) as api:
+        db_factory = make_db(directory, num_tweets)
+        supervisor = Supervisor(db_factory, "stub", 2,
+                                auth_file=write_auth_file(directory, 2),
+                                api_url=api.url)
+        assert supervisor.run()
+
+        db = db_factory()
+        assert stored_ids(db) >= stub_ids(num_tweets)
+        assert db.load_collector_state() == []
+        db.close()
+
+
+class CrashingCollector(SqliteCollector):
+    """exits the first worker process that writes a page after one of its
+    checkpoints is saved"""
+
+    def __init__(self, address, db_name):
+        super().__init__(address, db_name)
+        self.crash_file = os.path.join(address, "crashed")
+        self.checkpoints = 0
+
+    def save_collector_state(self, next_max_id, since_id, done, query=None):
+        super().save_collector_state(next_max_id, since_id, done, query)
+        self.checkpoints += not done
+
+    def insert_tweets_batch(self, tweets, retweets):
+        if self.checkpoints:
+            try:
+                os.close(os.open(self.crash_file,
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                pass
+            else:
+                os._exit(1)
+        super().insert_tweets_batch(tweets, retweets)
+
+
+class RecordingSupervisor(Supervisor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.started = []
+
+    def start_worker(self, worker, collect_ids):
+        self.started.append((worker, collect_ids))
+        super().start_worker(worker, collect_ids)
+
+
+def test_crashed_worker_resumes_from_its_meta_ranges(monkeypatch):
+    monkeypatch.setattr(supervisor_module, "RESTART_DELAY", 0)
+    num_tweets = 1000
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=num_tweets) as api:
+        db_factory = make_db(directory, num_tweets, CrashingCollector)
+        supervisor = RecordingSupervisor(
+            db_factory, "stub", 2, auth_file=write_auth_file(directory, 2),
+            api_url=api.url, checkpoint_pages=1,
+            split_ms=(ID_STEP >> 22) * 200)
+        assert supervisor.run()
+
+        planned = {since_id: next_max_id for worker, collect_ids
+                   in supervisor.started[:2]
+                   for next_max_id, since_id in collect_ids}
+        (worker, resumed), = supervisor.started[2:]
+        # the restart takes over the unfinished ranges of the crashed
+        # worker, at the checkpoints saved before the crash
+        assert resumed
+        assert {since_id for _, since_id in resumed} <= \
+            supervisor.since_ids[worker]
+        assert any(next_max_id < planned[since_id]
+                   for next_max_id, since_id in resumed)
+
+        db = db_factory()
+        assert stored_ids(db) >= stub_ids(num_tweets)
+        assert db.load_collector_state() == []
+        db.close()
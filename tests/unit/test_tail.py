@@ -0,0 +1,67 @@
+import tempfile
+from benchmarks.bench_engines import write_auth_file
+from benchmarks.memory_db import MemoryDb
+from benchmarks.stub_server import StubSearchApi, FIRST_TWEET_ID, ID_STEP
+from tweet_collector.snowflake import ms_to_id
+from tweet_collector.tail import ArrivalRate
+from tweet_collector.tweet_collector import TweetCollector
+
+NOW_MS = 1600000000000
+
+
+def test_interval_targets_a_full_page():
+    arrival_rate = ArrivalRate(target=90, min_interval=5, max_interval=900)
+    assert arrival_rate.next_interval() == 5
+
+    # 90 tweets arrived in the 30 s since the newest collected tweet
+    arrival_rate.observe(90, ms_to_id(NOW_MS - 30000), now_ms=NOW_MS)
+    assert arrival_rate.rate == 3
+    assert arrival_rate.next_interval() == 30
+
+    arrival_rate.observe(0, ms_to_id(NOW_MS - 30000), now_ms=NOW_MS)
+    assert abs(arrival_rate.next_interval() - 90 / (3 * 0.7)) < 1e-9
+
+    assert ArrivalRate(rate=0, max_interval=900).next_interval() == 900
+    assert ArrivalRate(rate=1000, min_interval=5).next_interval() == 5
+
+
+def test_tail_pass_ends_on_empty_page():
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=250) as api:
+        db = MemoryDb()
+        collector = TweetCollector(db, "stub", api_url=api.url,
+                                   auth_file=write_auth_file(directory, 1))
+        collector.start_collector()
+        requests = api.search_requests
+        meta = dict(db.meta)
+
+        assert list(collector.tail_pass()) == [0]
+    assert api.search_requests == requests + 1
+    assert db.meta == meta
+    assert collector.arrival_rate.rate == 0
+
+
+def test_tail_pass_continues_after_short_page():
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=250) as api:
+        db = MemoryDb()
+        collector = TweetCollector(db, "stub", api_url=api.url,
+                                   auth_file=write_auth_file(directory, 1))
+        collector.start_collector()
+        api.ids += [FIRST_TWEET_ID + seq * ID_STEP for seq in range(250, 500)]
+
+        # the api answers the first page of the pass with a short page
+        fetch_page = collector.fetch_page
+        short_pages = [30]
+
+        def fetch_short_page(url, token):
+            tweets, limit_remaining, limit_reset = fetch_page(url, token)
+            if short_pages:
+                tweets = tweets[:short_pages.pop()]
+            return tweets, limit_remaining, limit_reset
+        collector.fetch_page = fetch_short_page
+
+        num_tweets = list(collector.tail_pass())
+    assert num_tweets[0] == 30 and num_tweets[-1] == 0
+    assert sum(num_tweets) == 250
+    assert set(api.ids) <= set(db.tweets) | set(db.retweets)
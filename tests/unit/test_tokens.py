@@ -0,0 +1,46 @@
+from datetime import datetime
+from tweet_collector.tokens import TokenPool
+
+
+def make_pool(reset_ts, remaining, limits=None):
+    calls = []
+
+    def refresh():
+        calls.append(1)
+        return reset_ts, remaining, limits or [180] * len(reset_ts)
+
+    return TokenPool(refresh), calls
+
+
+def test_acquire_uses_token_with_most_calls_left():
+    future = datetime.now().timestamp() + 900
+    pool, calls = make_pool([future] * 3, [1, 5, 3])
+
+    assert [pool.acquire() for _ in range(4)] == [1, 1, 1, 2]
+    assert calls == [1]
+
+
+def test_headers_feed_the_pool_without_refresh():
+    future = datetime.now().timestamp() + 900
+    pool, calls = make_pool([future] * 2, [2, 2])
+
+    pool.update(0, 10, future)
+    assert pool.acquire() == 0
+    assert calls == [1]
+
+
+def test_spent_token_restored_after_reset():
+    past = datetime.now().timestamp() - 1
+    pool, calls = make_pool([past, past], [0, 0], [3, 3])
+
+    assert pool.acquire() in (0, 1)
+    assert len(calls) == 1
+
+
+def test_missing_headers_reload_limits():
+    future = datetime.now().timestamp() + 900
+    pool, calls = make_pool([future] * 2, [5, 5])
+
+    pool.update(0, None, None)
+    pool.acquire()
+    assert len(calls) == 2
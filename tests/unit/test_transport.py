@@ -0,0 +1,52 @@
+import pytest
+import requests
+from benchmarks.stub_server import StubSearchApi
+from tweet_collector.transport import Transport
+
+
+def test_retries_overloaded_responses():
+    transport = Transport(backoff_base=0.001)
+    with StubSearchApi(num_tweets=10, error_rate=2) as api:
+        url = f"{api.url}/search/tweets.json?q=stub&count=5"
+        responses = [transport.get(url) for _ in range(3)]
+
+    assert [res.status_code for res in responses] == [200, 200, 200]
+    assert api.search_requests == 5
+
+
+def test_returns_last_response_after_max_retries():
+    transport = Transport(backoff_base=0.001, max_retries=2)
+    with StubSearchApi(num_tweets=10, error_rate=1) as api:
+        res = transport.get(f"{api.url}/search/tweets.json?q=stub")
+
+    assert res.status_code == 503
+    assert api.search_requests == 3
+
+
+def test_backoff_is_capped():
+    transport = Transport(backoff_base=1, backoff_max=5)
+    assert all(0 <= transport.backoff(attempt) <= 5 for attempt in range(20))
+
+
+def test_rate_limited_responses_are_returned():
+    transport = Transport(backoff_base=0.001)
+    with StubSearchApi(num_tweets=10, rate_limit=1) as api:
+        url = f"{api.url}/search/tweets.json?q=stub"
+        responses = [transport.get(url) for _ in range(2)]
+
+    assert [res.status_code for res in responses] == [200, 429]
+    assert api.search_requests == 2
+
+
+def test_post_is_not_retried(monkeypatch):
+    transport = Transport(backoff_base=0.001)
+    calls = []
+
+    def request(method, url, **kwargs):
+        calls.append(method)
+        raise requests.exceptions.ConnectionError("refused")
+
+    monkeypatch.setattr(transport.session, "request", request)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        transport.post("http://127.0.0.1:1/oauth2/token")
+    assert calls == ["POST"]
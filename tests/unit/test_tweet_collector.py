@@ -0,0 +1,203 @@
+import sys
+import tempfile
+import pytest
+from benchmarks.bench_engines import write_auth_file, gap_ranges
+from benchmarks.memory_db import MemoryDb
+from benchmarks.stub_server import StubSearchApi, ID_STEP
+from tweet_collector.tweet_collector import TweetCollector, split_range, \
+    flatten_page
+
+
+def test_split_range_covers_range_without_overlap():
+    since_id = 1000
+    next_max_id = since_id + (5 << 22) + 7
+    ranges = split_range(next_max_id, since_id, split_ms=2)
+
+    assert ranges[0][0] == next_max_id
+    assert ranges[-1][1] == since_id
+    for (_, lower), (upper, _) in zip(ranges, ranges[1:]):
+        assert lower == upper
+    assert all(hi - lo <= 2 << 22 for hi, lo in ranges)
+
+
+def test_split_range_limits_splits_and_open_ranges():
+    assert len(split_range(2 ** 60, 0, split_ms=1, max_splits=8)) == 8
+    assert split_range(sys.maxsize, 5) == [[sys.maxsize, 5]]
+
+
+def test_flatten_page_emits_each_status_once():
+    def status(status_id, user_id, **refs):
+        return {"id": status_id, "user": {"id": user_id, "seq": status_id},
+                **refs}
+
+    original = status(1, 10)
+    quoting = [status(2, 20, quoted_status=original),
+               status(3, 20, quoted_status=original)]
+    retweet = status(4, 30, retweeted_status=quoting[0])
+    page_tweets, page_retweets = flatten_page(quoting + [retweet, original])
+
+    assert [tweet["id"] for tweet, _ in page_tweets] == [1, 2, 3]
+    assert [retweet["id"] for retweet, _ in page_retweets] == [4]
+    tweets = {tweet["id"]: tweet for tweet, _ in page_tweets}
+    assert tweets[1]["is_quoted"] and tweets[2]["is_retweeted"]
+    assert tweets[3]["quoted_id"] == 1
+
+    # api dicts are left untouched and a user's statuses share the newest
+    # user dict on the page
+    assert "is_quoted" not in original and "quoted_id" not in quoting[0]
+    assert [user["seq"] for _, user in page_tweets] == [1, 3, 3]
+
+
+def test_backfill_collects_all_gap_ranges():
+    num_tweets = 800
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=num_tweets) as api:
+        auth_file = write_auth_file(directory, 3)
+        db = MemoryDb(gap_ranges(num_tweets, 2))
+        collector = TweetCollector(db, "stub", auth_file=auth_file,
+                                   api_url=api.url, backfill_workers=4,
+                                   backfill_split_ms=(ID_STEP >> 22) * 150)
+        collector.start_collector()
+        collector.executor.shutdown(wait=True)
+
+    # retweeted originals are older than the served ids
+    stored = [tweet_id for tweet_id in list(db.tweets) + list(db.retweets)
+              if tweet_id >= api.ids[0]]
+    assert sorted(stored) == api.ids
+    assert db.load_collector_state() == []
+
+
+def test_pipelined_collection_matches_sequential():
+    num_tweets = 500
+    stored = {}
+    for pipeline_depth in (0, 2):
+        with tempfile.TemporaryDirectory() as directory, \
+                StubSearchApi(num_tweets=num_tweets) as api:
+            auth_file = write_auth_file(directory, 1)
+            db = MemoryDb()
+            collector = TweetCollector(db, "stub", auth_file=auth_file,
+                                       api_url=api.url,
+                                       pipeline_depth=pipeline_depth)
+            collector.start_collector()
+            collector.executor.shutdown(wait=True)
+        stored[pipeline_depth] = (set(db.tweets), set(db.retweets))
+
+    assert stored[0] == stored[2]
+    assert db.load_collector_state() == []
+
+
+def test_collect_range_keeps_a_failed_page_in_its_state():
+    class FailingDb(MemoryDb):
+        def insert_tweets_batch(self, tweets, retweets):
+            raise IOError("write failed")
+
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=300) as api:
+        db = FailingDb()
+        collector = TweetCollector(db, "stub",
+                                   auth_file=write_auth_file(directory, 1),
+                                   api_url=api.url)
+        next_max_id = api.ids[-1] + 1
+        try:
+            collector.collect_range(next_max_id, 0)
+        except IOError:
+            pass
+        collector.executor.shutdown(wait=True)
+
+    assert db.load_collector_state() == [[next_max_id, 0]]
+
+
+def test_collect_range_ends_at_its_since_id():
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=300) as api:
+        db = MemoryDb()
+        collector = TweetCollector(db, "stub",
+                                   auth_file=write_auth_file(directory, 1),
+                                   api_url=api.url)
+        # the range holds exactly two full pages
+        since_id = api.ids[100] - 1
+        collector.collect_range(api.ids[-1], since_id)
+        collector.executor.shutdown(wait=True)
+
+    assert api.search_requests == 2
+    assert db.load_collector_state() == []
+
+
+class FirstWriteFailsDb(MemoryDb):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def insert_tweets_batch(self, tweets, retweets):
+        self.writes += 1
+        if self.writes == 1:
+            raise IOError("write failed")
+        super().insert_tweets_batch(tweets, retweets)
+
+
+def test_failed_page_write_is_not_saved_past():
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=1000) as api:
+        db = FirstWriteFailsDb()
+        collector = TweetCollector(db, "stub",
+                                   auth_file=write_auth_file(directory, 1),
+                                   api_url=api.url, checkpoint_pages=1)
+        pages = collector.iter_pages()
+        # fetching goes on until a later submit raises the write error
+        with pytest.raises(IOError):
+            for _ in pages:
+                pass
+        collector.executor.shutdown(wait=True)
+        assert api.search_requests > 1
+
+    assert db.meta == {}
+
+
+def test_write_error_raised_by_an_earlier_drain_skips_the_save():
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=1000) as api:
+        db = FirstWriteFailsDb()
+        collector = TweetCollector(db, "stub",
+                                   auth_file=write_auth_file(directory, 1),
+                                   api_url=api.url)
+        pages = collector.iter_pages()
+        next(pages)
+        # as before_token_sleep does while the range is collected
+        with pytest.raises(IOError):
+            collector.write_queue.drain()
+        next(pages)
+        pages.close()
+        collector.executor.shutdown(wait=True)
+
+    assert db.meta == {}
+
+
+def test_pipeline_is_closed_when_draining_fails(monkeypatch):
+    import tweet_collector.tweet_collector as module
+    pipelines = []
+
+    class RecordedPipeline(module.PagePipeline):
+        def start(self):
+            pipelines.append(self)
+            return super().start()
+
+    monkeypatch.setattr(module, "PagePipeline", RecordedPipeline)
+    with tempfile.TemporaryDirectory() as directory, \
+            StubSearchApi(num_tweets=300) as api:
+        db = MemoryDb()
+        collector = TweetCollector(db, "stub",
+                                   auth_file=write_auth_file(directory, 1),
+                                   api_url=api.url, pipeline_depth=2)
+
+        def drain():
+            raise IOError("write failed")
+
+        collector.write_queue.drain = drain
+        with pytest.raises(IOError):
+            collector.start_collector()
+        collector.executor.shutdown(wait=True)
+
+    assert pipelines
+    assert not any(thread.is_alive() for pipeline in pipelines
+                   for thread in pipeline.threads)
+    assert db.meta == {}
@@ -0,0 +1,318 @@
+"""asyncio collector engine.
+
+Pages are fetched with a single pooled aiohttp session. Every id range from
+the meta collection gets its own coroutine so ranges are collected
+concurrently across the available tokens. Pages are written with
+DbInterface.insert_tweets_batch in a thread pool while the next pages are
+fetched; at most write_queue_size writes are in flight. A range saves its
+state only once its pending writes are done, and not at all after a write
+fails, which also stops the range. Checkpoints (see checkpoint.py) save
+its progress every few pages or seconds once the pages before them are
+written. Token budgets follow the x-rate-limit response headers, and
+rate_limit_status is only polled for tokens whose headers are missing.
+Overloaded responses are retried with the backoff of the shared
+Transport."""
+
+import sys
+import asyncio
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import aiohttp
+from tweet_collector.auth import DEFAULT_AUTH_FILE, get_auth_header, get_tokens
+from tweet_collector.tweet_collector import API_URL, MAX_EMPTY_PAGES, \
+    null_logger, flatten_page
+from tweet_collector.checkpoint import RangeCheckpoint, CHECKPOINT_PAGES, \
+    CHECKPOINT_SECONDS
+from tweet_collector.decode import decode_search
+from tweet_collector.dedup import SeenIds
+from tweet_collector.snowflake import time_window_to_ids
+from tweet_collector.transport import get_transport
+from tweet_collector.tokens import RATE_LIMITED_STATUS
+
+# seconds between rate_limit_status polls while it still reports a token
+# exhausted past its reset
+RESET_POLL_SECONDS = 5
+
+
+class AsyncTweetCollector(object):
+    def __init__(self, db_obj, q, auth_file=DEFAULT_AUTH_FILE,
+                 logger=null_logger, api_url=API_URL, max_connections=10,
+                 write_queue_size=10, writers=2, project_statuses=True,
+                 transport=None, since=None, until=None, dedup=False,
+                 dedup_file=None, checkpoint_pages=CHECKPOINT_PAGES,
+                 checkpoint_seconds=CHECKPOINT_SECONDS, **kwargs):
+
+        self.tokens = get_tokens(auth_file=auth_file)
+        if not self.tokens:
+            raise ValueError("twitter api tokens not set. Use cli tool "
+                             "to set tokens")
+
+        self.db = db_obj
+        self.logger = logger
+        self.api_url = api_url
+        self.max_connections = max_connections
+        self.write_queue_size = write_queue_size
+        self.writers = writers
+        self.project_statuses = project_statuses
+        # retry policy shared with the threaded engine
+        self.transport = transport or get_transport()
+        self.seen_ids = SeenIds(db_obj, dedup_file) if dedup else None
+        self.checkpoint_pages = checkpoint_pages
+        self.checkpoint_seconds = checkpoint_seconds
+
+        used_search_params = ["geocode", "lang", "locale", "result_type"]
+        del_keys = [key for key in kwargs if key not in used_search_params]
+        if del_keys:
+            self.logger.log(logging.INFO,
+                            f"Unused parameters passed to collector:"
+                            f" {del_keys}")
+        self.params = {key: val for key, val in kwargs.items()
+                       if key in used_search_params}
+        self.params.update({"q": q, "count": 100, "tweet_mode": "extended"})
+
+        # collect gaps from the meta collection and the most recent tweets,
+        # bounded by an optional [since, until) window
+        window_since_id, window_max_id = time_window_to_ids(since, until)
+        self.collect_ids = sorted(self.db.load_merged_collector_state())
+        self.collect_ids.append([
+            window_max_id or sys.maxsize,
+            max(self.db.get_max_tweet_id(), window_since_id or 0)
+        ])
+
+        self.token_reset_ts = [0] * len(self.tokens)
+        self.token_limit_remaining = [0] * len(self.tokens)
+        # calls per window, 0 until a response or poll tells it
+        self.token_limit = [0] * len(self.tokens)
+
+        self.tweets_collected = 0
+        # pages are written from executor threads
+        self.count_lock = threading.Lock()
+        self.pages_collected = 0
+
+        self.executor = ThreadPoolExecutor(max_workers=writers)
+
+    def run(self):
+        """blocking entry point"""
+        return asyncio.run(self.start_collector())
+
+    async def start_collector(self):
+        self.logger.log(logging.INFO, "Starting async collector")
+        connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                         keepalive_timeout=60)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.session = session
+            await self.get_current_rate_limits()
+
+            write_slots = asyncio.Semaphore(self.write_queue_size)
+            try:
+                # every range runs to its end and saves its state before
+                # the first failure is raised
+                results = await asyncio.gather(*[
+                    self.collect_range(next_max_id, since_id, write_slots)
+                    for next_max_id, since_id in self.collect_ids
+                ], return_exceptions=True)
+            finally:
+                self.executor.shutdown(wait=True)
+                if self.seen_ids:
+                    self.seen_ids.save()
+
+        failures = [result for result in results
+                    if isinstance(result, BaseException)]
+        if failures:
+            raise failures[0]
+
+        self.logger.log(logging.INFO,
+                        f"Collected {self.tweets_collected} tweets")
+
+    async def get_current_rate_limits(self):
+        url = f"{self.api_url}/application/rate_limit_status.json"
+        params = {"resources": "search"}
+
+        async def get_limit(token):
+            async with self.session.get(url, params=params,
+                                        headers=get_auth_header(token)) as res:
+                res.raise_for_status()
+                rate_info = (await res.json())["resources"]["search"][
+                    "/search/tweets"]
+                return (rate_info["reset"], rate_info["remaining"],
+                        rate_info["limit"])
+
+        limits = await asyncio.gather(*[get_limit(token)
+                                        for token in self.tokens])
+        self.token_reset_ts = [reset for reset, _, _ in limits]
+        self.token_limit_remaining = [remaining for _, remaining, _ in limits]
+        self.token_limit = [limit for _, _, limit in limits]
+
+    async def acquire_token(self):
+        """Reserve one call on the token with the most calls remaining,
+        sleeping until the earliest reset if all tokens are exhausted. A
+        token whose window reset gets its limit back; rate_limit_status is
+        only polled when the limit of one is unknown."""
+        while True:
+            token_idx = max(range(len(self.tokens)),
+                            key=lambda idx: self.token_limit_remaining[idx])
+            if self.token_limit_remaining[token_idx] > 0:
+                self.token_limit_remaining[token_idx] -= 1
+                return token_idx
+
+            reset_ts = min(self.token_reset_ts)
+            sleep_for = reset_ts - datetime.now().timestamp()
+            if sleep_for > 0:
+                self.logger.info(f"sleeping for: {sleep_for / 60} min")
+                await asyncio.sleep(sleep_for)
+
+            now = datetime.now().timestamp()
+            reset = [idx for idx in range(len(self.tokens))
+                     if self.token_reset_ts[idx] <= now]
+            if all(self.token_limit[idx] for idx in reset):
+                for idx in reset:
+                    self.token_limit_remaining[idx] = self.token_limit[idx]
+                continue
+            await self.get_current_rate_limits()
+            if max(self.token_limit_remaining) == 0:
+                await asyncio.sleep(RESET_POLL_SECONDS)
+
+    async def collect_range(self, next_max_id, since_id, write_slots):
+        """Collect one [next_max_id, since_id] range. Its state is saved
+        when it finishes or fails, once its pending page writes are done;
+        a failed write stops the range and skips the save, so the range is
+        collected again from its last saved state."""
+        loop = asyncio.get_event_loop()
+        num_done = 0
+        writes = RangeWrites(loop, self.executor)
+        checkpoint = RangeCheckpoint(self.db, since_id,
+                                     pages=self.checkpoint_pages,
+                                     seconds=self.checkpoint_seconds,
+                                     logger=self.logger)
+        try:
+            while num_done < MAX_EMPTY_PAGES and not writes.failed:
+                tweets = await self.get_tweets(next_max_id, since_id)
+                if tweets:
+                    num_done = 0
+                    next_max_id = min(tweet["id"] for tweet in tweets) - 1
+                    await write_slots.acquire()
+                    write = writes.submit(self.insert_page, tweets)
+                    write.add_done_callback(lambda _: write_slots.release())
+                    checkpoint.page_queued(next_max_id, writes)
+                else:
+                    num_done += 1
+        finally:
+            done = num_done >= MAX_EMPTY_PAGES
+            errors = await writes.wait()
+            checkpoint.close()
+            if errors:
+                self.logger.log(logging.ERROR,
+                                f"Not saving the state of id range "
+                                f"{[next_max_id, since_id]}: "
+                                f"{len(errors)} page writes failed: "
+                                f"{errors[0]}")
+                raise errors[0]
+            await loop.run_in_executor(self.executor, self.db.flush)
+            await loop.run_in_executor(self.executor,
+                                       self.db.save_collector_state,
+                                       next_max_id, since_id, done)
+            self.logger.log(logging.INFO,
+                            f"Finished collecting for id range "
+                            f"{[next_max_id, since_id]} done: {done}")
+
+    async def get_tweets(self, max_id, since_id):
+        """fetch a single page, retrying overloaded responses with the
+        transport's backoff"""
+        url = f"{self.api_url}/search/tweets.json"
+        params = {**self.params, "max_id": max_id, "since_id": since_id}
+        attempt = 0
+        while True:
+            token_idx = await self.acquire_token()
+            headers = get_auth_header(self.tokens[token_idx])
+            async with self.session.get(url, params=params,
+                                        headers=headers) as res:
+                self.update_limits(token_idx, res.headers)
+                if res.status == RATE_LIMITED_STATUS:
+                    # spent; acquire_token picks another token or waits
+                    self.logger.log(logging.WARN,
+                                    f"Token {token_idx} rate limited")
+                    self.token_limit_remaining[token_idx] = 0
+                    if self.token_reset_ts[token_idx] <= \
+                            datetime.now().timestamp():
+                        # no reset to wait for; poll the next one
+                        self.token_limit[token_idx] = 0
+                    continue
+                if self.transport.should_retry(res.status, attempt):
+                    sleep_for = self.transport.backoff(attempt)
+                    self.logger.log(logging.WARN,
+                                    f"received {res.status} status code; "
+                                    f"retrying in {sleep_for:.2f}s")
+                    await asyncio.sleep(sleep_for)
+                    attempt += 1
+                    continue
+                res.raise_for_status()
+                self.pages_collected += 1
+                tweets, _ = decode_search(await res.read(),
+                                          self.project_statuses)
+                return tweets
+
+    def update_limits(self, token_idx, headers):
+        if "x-rate-limit-remaining" in headers:
+            self.token_limit_remaining[token_idx] = \
+                int(headers["x-rate-limit-remaining"])
+        if "x-rate-limit-reset" in headers:
+            self.token_reset_ts[token_idx] = int(headers["x-rate-limit-reset"])
+        if "x-rate-limit-limit" in headers:
+            self.token_limit[token_idx] = int(headers["x-rate-limit-limit"])
+
+    def insert_page(self, tweets):
+        if self.seen_ids:
+            tweets, stored = self.seen_ids.filter_statuses(tweets)
+        page_tweets, page_retweets = flatten_page(tweets)
+        if self.seen_ids:
+            page_tweets, page_retweets = self.seen_ids.filter_page(
+                page_tweets, page_retweets, stored)
+        if page_tweets or page_retweets:
+            self.db.insert_tweets_batch(page_tweets, page_retweets)
+        if self.seen_ids:
+            self.seen_ids.add([tweet["id"] for tweet, _ in page_tweets] +
+                              [retweet["id"] for retweet, _ in page_retweets])
+        with self.count_lock:
+            self.tweets_collected += len(page_tweets)
+
+
+class RangeWrites(object):
+    """The page writes of one range running on the executor, with the
+    after_pending hook RangeCheckpoint uses"""
+
+    def __init__(self, loop, executor):
+        self.loop = loop
+        self.executor = executor
+        self.pending = []
+        # set once a write failed, so the range stops fetching
+        self.failed = False
+
+    def submit(self, fn, *args):
+        write = self.loop.run_in_executor(self.executor, fn, *args)
+        write.add_done_callback(self.written)
+        self.pending.append(write)
+        return write
+
+    def written(self, write):
+        if not write.cancelled() and write.exception() is not None:
+            self.failed = True
+
+    def after_pending(self, fn, *args):
+        """run fn(*args) on the executor once the writes submitted so far
+        succeeded"""
+        self.pending.append(asyncio.ensure_future(
+            self.run_after(list(self.pending), fn, args)))
+
+    async def run_after(self, writes, fn, args):
+        results = await asyncio.gather(*writes, return_exceptions=True)
+        if not any(isinstance(result, Exception) for result in results):
+            await self.loop.run_in_executor(self.executor, fn, *args)
+
+    async def wait(self):
+        """wait for the writes and checkpoints. Returns their errors."""
+        results = await asyncio.gather(*self.pending,
+                                       return_exceptions=True)
+        return [result for result in results
+                if isinstance(result, Exception)]
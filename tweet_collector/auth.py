@@ -1,14 +1,14 @@
 import os
 import json
-import requests
 import base64
+from tweet_collector.transport import get_transport
 
 DEFAULT_AUTH_FILE = os.path.join(
     os.path.expanduser("~"), ".twitter", "auth.json"
 )
 
 
-def get_bearer(key, secret):
+def get_bearer(key, secret, transport=None):
     cred_str = str.encode(f"{key}:{secret}")
     creds = base64.b64encode(cred_str).decode("utf-8")
     auth_header = {
@@ -16,9 +16,10 @@ def get_bearer(key, secret):
         "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8"
     }
     body = "grant_type=client_credentials"
-    res = requests.post("https://api.twitter.com/oauth2/token",
-                        data=body,
-                        headers=auth_header)
+    transport = transport or get_transport()
+    res = transport.post("https://api.twitter.com/oauth2/token",
+                         data=body,
+                         headers=auth_header)
     json_res = res.json()
     if res.ok:
         return {
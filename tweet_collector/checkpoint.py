@@ -0,0 +1,99 @@
+"""Progress checkpoints of id ranges in the meta collection.
+
+A range used to be saved only when it finished or failed, so a crash lost
+the progress of the whole range. RangeCheckpoint saves the next_max_id of a
+range every few pages or seconds while it is collected. A checkpoint is only
+saved once the pages queued before it are written and the database module
+is flushed. The stored state therefore never skips pages that were not
+written, and a restart refetches at most the pages since the last one."""
+
+import time
+import logging
+import threading
+
+# pages and seconds between checkpoints of a range
+CHECKPOINT_PAGES = 10
+CHECKPOINT_SECONDS = 60
+
+
+def merge_ranges(ranges):
+    """Merge overlapping or adjacent [next_max_id, since_id] ranges.
+
+    Returns:
+        (merged ranges sorted by since_id,
+         list of the input ranges each merged range was made of)
+    """
+    merged = []
+    groups = []
+    for next_max_id, since_id in sorted(ranges, key=lambda r: (r[1], r[0])):
+        if merged and since_id <= merged[-1][0]:
+            merged[-1][0] = max(merged[-1][0], next_max_id)
+            groups[-1].append([next_max_id, since_id])
+        else:
+            merged.append([next_max_id, since_id])
+            groups.append([[next_max_id, since_id]])
+    return merged, groups
+
+
+class RangeCheckpoint(object):
+    """Checkpoints of one id range.
+
+    Args:
+        since_id: since_id of the range, the key of its meta state
+        pages: pages queued between checkpoints
+        seconds: seconds between checkpoints
+    """
+
+    def __init__(self, db, since_id, query=None, pages=CHECKPOINT_PAGES,
+                 seconds=CHECKPOINT_SECONDS, logger=None):
+        self.db = db
+        self.since_id = since_id
+        self.query = query
+        self.pages = pages
+        self.seconds = seconds
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.lock = threading.Lock()
+        self.closed = False
+        # next_max_id of the last checkpoint saved
+        self.next_max_id = None
+        self.pages_queued = 0
+        self.last_checkpoint = time.monotonic()
+
+    @property
+    def saved(self):
+        return self.next_max_id is not None
+
+    def page_queued(self, next_max_id, write_queue=None):
+        """Count a page queued for writing. When a checkpoint is due, save
+        next_max_id once the writes in write_queue (anything with an
+        after_pending method, like WriteQueue or PagePipeline) are done, or
+        right away if the page was written by the caller."""
+        self.pages_queued += 1
+        if self.pages_queued < self.pages and \
+                time.monotonic() - self.last_checkpoint < self.seconds:
+            return
+        self.pages_queued = 0
+        self.last_checkpoint = time.monotonic()
+        if write_queue is None:
+            self.save(next_max_id)
+        else:
+            write_queue.after_pending(self.save, next_max_id)
+
+    def save(self, next_max_id):
+        """Upsert the range state, unless the range was closed or a newer
+        checkpoint is saved already. Checkpoints may finish out of order."""
+        with self.lock:
+            if self.closed or (self.saved and
+                               next_max_id >= self.next_max_id):
+                return
+            self.db.flush()
+            self.db.save_collector_state(next_max_id, self.since_id, False,
+                                         query=self.query)
+            self.next_max_id = next_max_id
+        self.logger.debug(f"Checkpoint {[next_max_id, self.since_id]}")
+
+    def close(self):
+        """stop saving checkpoints, before the final state is saved"""
+        with self.lock:
+            self.closed = True
@@ -1,10 +1,19 @@
 import os
 import sys
 import logging
+from functools import partial
 import click
 from .auth_cli.commands import auth
-from tweet_collector.db.mongo import MongoCollector
+from tweet_collector.db import get_backend
 from tweet_collector.tweet_collector import TweetCollector
+from tweet_collector.supervisor import Supervisor
+from tweet_collector.multi_query import MultiQueryCollector, read_queries
+from tweet_collector.spool import SpoolDb, drain
+from tweet_collector.export import export, exportable, FORMATS
+from tweet_collector.db.DbInterface import READ_BATCH_SIZE
+from tweet_collector.metrics import REGISTRY, MetricsServer, SummaryLogger, \
+    SUMMARY_INTERVAL
+from tweet_collector.profiler import install_profiler_signal
 
 
 @click.group()
@@ -18,39 +27,274 @@ def cli():
 @click.argument("db-address")
 @click.argument("db-name")
 @click.option("--daemon", is_flag=True)
-def collect_tweets(q, db_type, db_address, db_name, daemon):
+@click.option("--engine", type=click.Choice(["threaded", "async"]),
+              default="threaded")
+@click.option("--backfill-workers", type=int, default=1,
+              help="id ranges from unfinished runs to collect concurrently")
+@click.option("--since", type=click.DateTime(),
+              help="only collect tweets created from this utc time")
+@click.option("--until", type=click.DateTime(),
+              help="only collect tweets created before this utc time")
+@click.option("--dedup", is_flag=True,
+              help="skip statuses that are already stored")
+@click.option("--dedup-file", type=click.Path(dir_okay=False),
+              help="file the seen id filter is kept in between runs "
+                   "(implies --dedup)")
+@click.option("--write-queue-depth", type=int, default=8,
+              help="page writes in flight before fetching is throttled")
+@click.option("--workers", type=int, default=1,
+              help="collector processes sharing the tokens and id ranges")
+@click.option("--tail", is_flag=True,
+              help="keep polling for new tweets, timed by their arrival "
+                   "rate")
+@click.option("--spool", type=click.Path(file_okay=False),
+              help="directory pages are spooled to before they are "
+                   "written to the database")
+@click.option("--bulk-load", is_flag=True,
+              help="write to staging collections with only id indexes and "
+                   "build the other indexes once the run finishes")
+@click.option("--metrics-port", type=int,
+              help="serve prometheus metrics on this local port")
+@click.option("--metrics-interval", type=float, default=SUMMARY_INTERVAL,
+              help="seconds between metrics summary log lines (0 disables)")
+@click.option("--profile-file", type=click.Path(dir_okay=False),
+              help="SIGUSR2 starts and stops a sampling profiler writing "
+                   "to this path")
+def collect_tweets(q, db_type, db_address, db_name, daemon, engine,
+                   workers, metrics_port, metrics_interval, profile_file,
+                   **collector_kwargs):
+    single_process = {"tail": collector_kwargs["tail"],
+                      "spool": collector_kwargs["spool"],
+                      "metrics-port": metrics_port}
+    for option, value in single_process.items():
+        if value and (workers > 1 or engine == "async"):
+            raise click.UsageError(f"--{option} runs with the threaded "
+                                   f"engine in one process")
+    if collector_kwargs["bulk_load"]:
+        if not hasattr(get_backend(db_type), "finish_bulk_load"):
+            raise click.UsageError(f"--bulk-load is not supported by "
+                                   f"{db_type}")
+        if collector_kwargs["tail"]:
+            raise click.UsageError("--bulk-load finishes when the run does "
+                                   "and cannot --tail")
+    collector_kwargs["dedup"] = collector_kwargs["dedup"] or \
+        bool(collector_kwargs["dedup_file"])
+    logger = get_logger(db_name)
+    run(partial(instrumented,
+                partial(start_collector, q, db_type, db_address, db_name,
+                        logger, engine, workers, **collector_kwargs),
+                logger, metrics_port, metrics_interval, profile_file), daemon)
+
+
+@cli.command("collect-queries")
+@click.argument("query-file", type=click.Path(exists=True, dir_okay=False))
+@click.argument("db-type")
+@click.argument("db-address")
+@click.argument("db-name")
+@click.option("--daemon", is_flag=True)
+@click.option("--write-queue-depth", type=int, default=8,
+              help="page writes in flight before fetching is throttled")
+@click.option("--tail", is_flag=True,
+              help="keep polling every query, timed by its arrival rate")
+@click.option("--spool", type=click.Path(file_okay=False),
+              help="directory pages are spooled to before they are "
+                   "written to the database")
+@click.option("--metrics-port", type=int,
+              help="serve prometheus metrics on this local port")
+@click.option("--metrics-interval", type=float, default=SUMMARY_INTERVAL,
+              help="seconds between metrics summary log lines (0 disables)")
+@click.option("--profile-file", type=click.Path(dir_okay=False),
+              help="SIGUSR2 starts and stops a sampling profiler writing "
+                   "to this path")
+def collect_queries(query_file, db_type, db_address, db_name, daemon,
+                    write_queue_depth, tail, spool, metrics_port,
+                    metrics_interval, profile_file):
+    """Collect every query of QUERY_FILE (one per line, optionally followed
+    by a tab and a priority) with one shared token budget."""
+    logger = get_logger(db_name)
+    run(partial(instrumented,
+                partial(start_multi_query_collector,
+                        read_queries(query_file), db_type, db_address,
+                        db_name, logger, write_queue_depth=write_queue_depth,
+                        tail=tail, spool=spool),
+                logger, metrics_port, metrics_interval, profile_file), daemon)
+
+
+@cli.command("drain-spool")
+@click.argument("spool", type=click.Path(exists=True, file_okay=False))
+@click.argument("db-type")
+@click.argument("db-address")
+@click.argument("db-name")
+def drain_spool(spool, db_type, db_address, db_name):
+    """Write the pages left in the SPOOL directory to the database, for a
+    spool the collector did not finish draining."""
+    db_factory = get_db_factory(db_type, db_address, db_name)
+    if not db_factory:
+        print(f"No database object associated with {db_type}.")
+        return
+    num_statuses = drain(db_factory(), spool, logger=get_logger(db_name))
+    print(f"Wrote {num_statuses} statuses from {spool}")
+
+
+@cli.command("finish-bulk-load")
+@click.argument("db-address")
+@click.argument("db-name")
+def finish_bulk_load(db_address, db_name):
+    """Build the indexes of the mongo staging collections a collect
+    --bulk-load run left and swap them in."""
+    get_backend("mongo")(db_address, db_name,
+                         bulk_load=True).finish_bulk_load()
+    print(f"Finished the bulk load of {db_name}")
+
+
+@cli.command("export")
+@click.argument("db-type")
+@click.argument("db-address")
+@click.argument("db-name")
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option("--format", "fmt", type=click.Choice(list(FORMATS)),
+              default="jsonl", help="gzip json lines or parquet (needs "
+                                    "pyarrow)")
+@click.option("--shards", type=int, default=4,
+              help="id ranges read and written by parallel processes")
+@click.option("--batch-size", type=int, default=READ_BATCH_SIZE,
+              help="tweets read per query")
+@click.option("--since-id", type=int,
+              help="export the tweets after this id instead of after the "
+                   "saved watermark")
+@click.option("--query", "queries", multiple=True,
+              help="collect-queries query whose unfinished ranges bound "
+                   "the export (repeatable); defaults to the collect state")
+def export_tweets(db_type, db_address, db_name, directory, fmt, shards,
+                  batch_size, since_id, queries):
+    """Export the tweets collected since the last export to DIRECTORY,
+    joined with their users and places, one file per id range shard.
+    Retweets are not exported, only the tweets they retweet."""
+    db_factory = get_db_factory(db_type, db_address, db_name)
+    if not db_factory:
+        print(f"No database object associated with {db_type}.")
+        return
+    if not exportable(get_backend(db_type)):
+        raise click.UsageError(f"{db_type} cannot be exported; its module "
+                               f"does not read tweets back")
+    num_tweets = export(db_factory, directory, shards=shards, fmt=fmt,
+                        batch_size=batch_size, since_id=since_id,
+                        queries=queries or (None,),
+                        logger=get_logger(db_name))
+    print(f"Exported {num_tweets} tweets to {directory}")
+
+
+cli.add_command(auth)
+
+
+def get_logger(db_name):
     formatter = logging.Formatter("[ %(asctime)s ] \t\t %(message)s")
     fileHandle = logging.FileHandler(f"{db_name}.log")
     fileHandle.setFormatter(formatter)
     logger = logging.getLogger(db_name)
     logger.addHandler(fileHandle)
     logger.setLevel(logging.INFO)
+    return logger
 
+
+def run(start, daemon):
+    """call start, in a forked daemon process with daemon set"""
     if daemon:
         print("Forking daemon process")
         pid = os.fork()
         if pid == 0:
-            start_collector(q, db_type, db_address, db_name, logger)
+            start()
         else:
             print(f"Starting collector in daemon pid: {pid}")
             sys.exit(0)
     else:
-        start_collector(q, db_type, db_address, db_name, logger)
+        start()
 
 
-cli.add_command(auth)
+def instrumented(start, logger, metrics_port=None,
+                 metrics_interval=SUMMARY_INTERVAL, profile_file=None):
+    """call start with the metrics endpoint, summary log and profiler signal
+    set up; run in the (daemon) collector process"""
+    if metrics_port:
+        server = MetricsServer(REGISTRY, metrics_port).start()
+        logger.info(f"Serving metrics on "
+                    f"http://127.0.0.1:{server.port}/metrics")
+    if metrics_interval:
+        SummaryLogger(REGISTRY, logger, metrics_interval).start()
+    if profile_file:
+        install_profiler_signal(profile_file, logger=logger)
+    start()
+
+
+def get_db_factory(db_type, db_address, db_name, **db_kwargs):
+    """picklable callable opening a database module, or None"""
+    backend = get_backend(db_type)
+    if backend is None:
+        return None
+    return partial(backend, db_address, db_name, **db_kwargs)
 
 
-def start_collector(q, db_type, db_address, db_name, logger):
-    db_obj = None
-    if db_type == "mongo":
-        db_obj = MongoCollector(db_address, db_name)
+def run_spooled(start, db, spool, logger):
+    """Call start with db, wrapped in a SpoolDb when a spool directory is
+    given. The spool is drained, up to its timeout, before returning."""
+    if not spool:
+        return start(db)
+    spool_db = SpoolDb(db, spool, logger=logger)
+    try:
+        return start(spool_db)
+    finally:
+        spool_db.close()
 
-    if db_obj:
-        collector = TweetCollector(db_obj, q, logger=logger)
-        collector.start_collector()
+
+def start_collector(q, db_type, db_address, db_name, logger,
+                    engine="threaded", workers=1, spool=None,
+                    bulk_load=False, **collector_kwargs):
+    """
+    Args:
+        spool: directory to spool pages to (see spool.py)
+        bulk_load: collect into the database's staging collections and
+            finish the bulk load once the run succeeds
+        collector_kwargs: TweetCollector options (backfill_workers, since,
+            until, dedup, dedup_file, write_queue_depth, tail)
+    """
+    db_kwargs = {"bulk_load": True} if bulk_load else {}
+    db_factory = get_db_factory(db_type, db_address, db_name, **db_kwargs)
+    if not db_factory:
+        print(f"No database object associated with {db_type}.")
+        return
+    if engine == "async":
+        # aiohttp is an optional dependency
+        from tweet_collector.async_collector import AsyncTweetCollector
+        collector = AsyncTweetCollector(
+            db_factory(), q, logger=logger,
+            write_queue_size=collector_kwargs.get("write_queue_depth", 10),
+            **{key: collector_kwargs[key] for key in
+               ("since", "until", "dedup", "dedup_file")
+               if key in collector_kwargs})
+        collector.run()
+    elif workers > 1:
+        supervisor = Supervisor(db_factory, q, workers, logger=logger,
+                                **collector_kwargs)
+        if not supervisor.run():
+            sys.exit(1)
     else:
+        run_spooled(lambda db: TweetCollector(
+            db, q, logger=logger, **collector_kwargs).start_collector(),
+            db_factory(), spool, logger)
+    if bulk_load:
+        logger.info("Building indexes and swapping in the bulk load")
+        db_factory().finish_bulk_load()
+
+
+def start_multi_query_collector(queries, db_type, db_address, db_name,
+                                logger, spool=None, **collector_kwargs):
+    db_factory = get_db_factory(db_type, db_address, db_name)
+    if not db_factory:
         print(f"No database object associated with {db_type}.")
+        return
+    run_spooled(lambda db: MultiQueryCollector(
+        db, queries, logger=logger, **collector_kwargs).start_collector(),
+        db_factory(), spool, logger)
 
 
 if __name__ == "__main__":
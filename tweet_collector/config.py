@@ -1,4 +1,5 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
 # Required attributes to collect from the tweet
 REQUIRED_TWEET_ATTRS = [
@@ -9,6 +10,12 @@ RETWEET_ATTRS = [
     "id", "user_id", "tweet_id", "created_at", "place_id", "timestamp"
 ]
 
+# all tweet attrs to collect, includes required and optional attributes
+COLLECT_TWEET_ATTRS = REQUIRED_TWEET_ATTRS + \
+                      ["coordinates", "place", "in_reply_to_id",
+                       "in_reply_to_status_id", "quoted_id", "is_retweeted",
+                       "is_quoted"]
+
 # Required user attributes to collect
 REQUIRED_USER_ATTRS = [
     "screen_name", "name", "location", "profile_image_url_https", "id",
@@ -21,6 +28,46 @@ REQUIRED_USER_ATTRS = [
 # Tweets created_at filed datetime format for datetime.strptime
 CREATED_AT_DATETIME_FORMAT = "%a %b %d %H:%M:%S %z %Y"
 
+# fixed layout of created_at: "Wed Oct 10 20:19:24 +0000 2018"
+CREATED_AT_LENGTH = 30
+CREATED_AT_MONTHS = {
+    "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+    "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12
+}
+
+# number of distinct created_at strings kept by created_at_to_ts; statuses
+# in a page share seconds and users are seen over and over
+CREATED_AT_CACHE_SIZE = 4096
+
+
+def parse_created_at(created_at):
+    """Parse created_at by its fixed offsets. Falls back to strptime for
+    anything not in the expected layout."""
+    try:
+        if len(created_at) != CREATED_AT_LENGTH or \
+                created_at[3] != " " or created_at[10] != " " or \
+                created_at[13] != ":" or created_at[16] != ":":
+            raise ValueError(created_at)
+
+        offset = created_at[20:25]
+        if offset == "+0000":
+            tz = timezone.utc
+        else:
+            minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+            tz = timezone(timedelta(minutes=minutes if offset[0] == "+"
+                                    else -minutes))
+
+        return datetime(int(created_at[26:30]),
+                        CREATED_AT_MONTHS[created_at[4:7]],
+                        int(created_at[8:10]),
+                        int(created_at[11:13]),
+                        int(created_at[14:16]),
+                        int(created_at[17:19]),
+                        tzinfo=tz)
+    except (ValueError, KeyError):
+        return datetime.strptime(created_at, CREATED_AT_DATETIME_FORMAT)
+
 
+@lru_cache(maxsize=CREATED_AT_CACHE_SIZE)
 def created_at_to_ts(created_at):
-    return datetime.strptime(created_at, CREATED_AT_DATETIME_FORMAT)
+    return parse_created_at(created_at)
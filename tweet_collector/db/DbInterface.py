@@ -5,7 +5,12 @@ The tweet collector is threaded. The order of inserts to the database
 cannot be predicted. """
 
 import abc
-from ..config import REQUIRED_USER_ATTRS, REQUIRED_TWEET_ATTRS
+from sys import maxsize
+from .projection import validate_tweet
+from ..checkpoint import merge_ranges
+
+# tweets read per query by iter_tweet_batches
+READ_BATCH_SIZE = 1000
 
 class DbInterface(abc.ABC):
     @abc.abstractmethod
@@ -18,15 +23,43 @@ class DbInterface(abc.ABC):
         """
 
     @abc.abstractmethod
-    def save_collector_state(self, next_max_id, since_id, done):
+    def save_collector_state(self, next_max_id, since_id, done, query=None):
         """saves the state of the last collector run. the next max id and a 
         boolean to indicate if the run completed are passed. The function 
-        should also record a timestamp."""
+        should also record a timestamp. Collectors tracking several queries
+        pass the query; states are unique per (query, since_id)."""
 
     @abc.abstractmethod
-    def load_collector_state(self):
+    def load_collector_state(self, query=None):
         """return a list of lists [next_max_id, since_id] for collection runs 
-        that were not completed (done flag is false)"""
+        of the query that were not completed (done flag is false)"""
+
+    def load_merged_collector_state(self, query=None):
+        """load_collector_state with overlapping or adjacent ranges merged.
+        The merged range is saved and the ranges it absorbed are marked
+        done, so meta is compacted too. Call this before collection starts;
+        sub ranges being collected concurrently are adjacent."""
+        ranges = self.load_collector_state(query=query)
+        merged, groups = merge_ranges(ranges)
+        for (next_max_id, since_id), group in zip(merged, groups):
+            if len(group) == 1:
+                continue
+            self.save_collector_state(next_max_id, since_id, False,
+                                      query=query)
+            for old_max_id, old_since_id in group:
+                if old_since_id != since_id:
+                    self.save_collector_state(old_max_id, old_since_id,
+                                              True, query=query)
+        return merged
+
+    def load_query_state(self, query):
+        """Return the dict last saved with save_query_state for the query,
+        or an empty dict. The default keeps no query state."""
+        return {}
+
+    def save_query_state(self, query, state):
+        """Save a dict of per query scheduling state (newest id collected,
+        expected tweet rate). The default does nothing."""
 
     @abc.abstractmethod
     def insert_retweet(self, retweet, user):
@@ -61,16 +94,93 @@ class DbInterface(abc.ABC):
         Returns: None
         """
 
-        missing_tweet_attrs = [key for key in REQUIRED_TWEET_ATTRS
-                               if key not in tweet_attrs.keys()
-                               or tweet_attrs[key] is None]
+        validate_tweet(tweet_attrs, user_attrs)
+        return
 
-        missing_user_attrs = [key for key in REQUIRED_USER_ATTRS
-                              if key not in user_attrs.keys()
-                              or user_attrs[key] is None]
+    def insert_tweets_batch(self, tweets, retweets):
+        """Insert one page worth of tweets and retweets. Backends that can
+        batch writes should override this; the default falls back to the
+        per tweet insert methods.
 
-        if missing_user_attrs or missing_tweet_attrs:
-            raise KeyError(f"Missing attributes:\n\tmissing tweet"
-                           f"attributes: {missing_tweet_attrs}\n\t"
-                           f"missing user attributes {missing_user_attrs}")
-        return
+        Args:
+            tweets: list of (tweet_attrs, user_attrs) tuples. Retweeted and
+                quoted originals come before the statuses referencing them.
+            retweets: list of (retweet, user) tuples
+
+        Returns: None
+        """
+        for tweet_attrs, user_attrs in tweets:
+            self.insert_tweet(tweet_attrs, user_attrs)
+
+        for retweet, user in retweets:
+            self.insert_retweet(retweet, user)
+
+    def flush(self):
+        """Write out anything the module buffers. The collector calls this
+        before saving its state. The default does nothing."""
+
+    def close(self):
+        """Release the connections of the module. The default does
+        nothing."""
+
+    def estimate_tweet_count(self):
+        """Rough number of stored tweets and retweets, used to size the seen
+        id filter. The default returns 0."""
+        return 0
+
+    def iter_tweet_ids(self):
+        """Iterate over the ids of the stored tweets and retweets to warm
+        load the seen id filter. The default yields nothing."""
+        return iter(())
+
+    def get_stored_tweet_ids(self, ids):
+        """Return the subset of ids stored as tweets or retweets. The seen id
+        filter only skips statuses confirmed here; the default returns an
+        empty set so nothing is skipped."""
+        return set()
+
+    def get_min_tweet_id(self):
+        """Id of the oldest stored tweet, or sys.maxsize if there are none.
+        The default returns 0."""
+        return 0
+
+    def read_tweets(self, min_id, max_id, limit):
+        """Return up to limit stored tweets with ids in (min_id, max_id] as
+        dicts, in ascending id order. Modules that can be exported override
+        this, get_users and get_places; the default raises
+        NotImplementedError."""
+        raise NotImplementedError(f"{type(self).__name__} cannot read "
+                                  f"tweets")
+
+    def get_users(self, user_ids):
+        """Return {user id: stored user} for the stored users of user_ids"""
+        raise NotImplementedError(f"{type(self).__name__} cannot read "
+                                  f"users")
+
+    def get_places(self, place_ids):
+        """Return {place id: stored place} for the stored places of
+        place_ids"""
+        raise NotImplementedError(f"{type(self).__name__} cannot read "
+                                  f"places")
+
+    def iter_tweet_batches(self, min_id=0, max_id=maxsize,
+                           batch_size=READ_BATCH_SIZE):
+        """Yield lists of up to batch_size tweets with ids in (min_id,
+        max_id], in ascending id order. Each tweet has its stored user, or
+        None, under "user", and tweets with a place_id their place under
+        "place". Users and places are read with one lookup per batch."""
+        while True:
+            tweets = self.read_tweets(min_id, max_id, batch_size)
+            if not tweets:
+                return
+            users = self.get_users({tweet["user_id"] for tweet in tweets})
+            places = self.get_places({tweet["place_id"] for tweet in tweets
+                                      if tweet.get("place_id")})
+            for tweet in tweets:
+                tweet["user"] = users.get(tweet["user_id"])
+                if tweet.get("place_id"):
+                    tweet["place"] = places.get(tweet["place_id"])
+            yield tweets
+            if len(tweets) < batch_size:
+                return
+            min_id = tweets[-1]["id"]
@@ -0,0 +1,28 @@
+"""Registry of the database modules the collector can write to.
+
+Backends are registered by name as "module:Class" paths, imported on first
+use so a backend's driver is only needed when it is selected. A backend
+class is constructed with (address, db_name)."""
+
+from importlib import import_module
+
+BACKENDS = {
+    "mongo": "tweet_collector.db.mongo:MongoCollector",
+    "sqlite": "tweet_collector.db.sqlite:SqliteCollector",
+    "segments": "tweet_collector.db.segments:SegmentCollector",
+}
+
+
+def register_backend(name, backend):
+    """register a DbInterface class, or its "module:Class" path, as name"""
+    BACKENDS[name] = backend
+
+
+def get_backend(name):
+    """the DbInterface class registered as name, or None"""
+    backend = BACKENDS.get(name)
+    if isinstance(backend, str):
+        module_name, _, class_name = backend.partition(":")
+        backend = getattr(import_module(module_name), class_name)
+        BACKENDS[name] = backend
+    return backend
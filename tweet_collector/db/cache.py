@@ -0,0 +1,120 @@
+"""In-process caches in front of the database collections.
+
+The collector is threaded, so every structure here is guarded by a lock."""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class UserCache(object):
+    """Bounded LRU of the newest last_tweet_ts written for each user id.
+
+    Entries expire after ttl seconds so changes made to the users
+    collection by other processes are picked up again.
+    """
+
+    def __init__(self, maxsize=100000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def wins(self, user_id, tweet_ts):
+        """False when a write with tweet_ts cannot win against the last
+        write recorded for the user"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                last_ts, seen_at = entry
+                if now - seen_at <= self.ttl and tweet_ts <= last_ts:
+                    self.entries.move_to_end(user_id)
+                    self.hits += 1
+                    return False
+            return True
+
+    def record(self, user_id, tweet_ts):
+        """remember tweet_ts for user_id once its write is acknowledged"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and now - entry[1] <= self.ttl and \
+                    entry[0] > tweet_ts:
+                tweet_ts = entry[0]
+            self.entries[user_id] = (tweet_ts, now)
+            self.entries.move_to_end(user_id)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def forget(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+
+class UserWriteBuffer(object):
+    """Coalesces user writes: only the newest version of each user is kept
+    until the buffer is drained, at most flush_interval seconds after the
+    first buffered write or once max_pending users are waiting. The owner
+    drains it from a timer started when add() returns True."""
+
+    def __init__(self, flush_interval=5, max_pending=10000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.first_pending_at = None
+        self.lock = threading.Lock()
+
+    def add(self, user):
+        """buffer a user; returns True when the buffer was empty"""
+        with self.lock:
+            current = self.pending.get(user["id"])
+            if current is None or \
+                    current["last_tweet_ts"] < user["last_tweet_ts"]:
+                self.pending[user["id"]] = user
+            if self.first_pending_at is None:
+                self.first_pending_at = time.monotonic()
+                return True
+            return False
+
+    def due(self):
+        with self.lock:
+            return self.first_pending_at is not None and (
+                len(self.pending) >= self.max_pending or
+                time.monotonic() - self.first_pending_at >=
+                self.flush_interval)
+
+    def drain(self):
+        """remove and return the buffered users"""
+        with self.lock:
+            users = list(self.pending.values())
+            self.pending = {}
+            self.first_pending_at = None
+            return users
+
+
+class PlaceCache(object):
+    """Set of place ids known to be stored. Loaded lazily on first use with
+    load(), a callable returning the stored place ids."""
+
+    def __init__(self, load):
+        self.load = load
+        self.ids = None
+        self.lock = threading.Lock()
+
+    def ensure_loaded(self):
+        with self.lock:
+            if self.ids is None:
+                self.ids = set(self.load())
+
+    def unknown(self, places):
+        """the places whose id is not known yet"""
+        self.ensure_loaded()
+        with self.lock:
+            return [place for place in places if place["id"] not in self.ids]
+
+    def add(self, place_ids):
+        self.ensure_loaded()
+        with self.lock:
+            self.ids.update(place_ids)
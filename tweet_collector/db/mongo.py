@@ -1,12 +1,15 @@
+import threading
 from sys import maxsize
-import numpy as np
 from datetime import datetime
+from functools import lru_cache
 import pymongo
-from pymongo.errors import DuplicateKeyError
-from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from pymongo import MongoClient, InsertOne, UpdateOne
 from .DbInterface import DbInterface
-from ..config import created_at_to_ts, REQUIRED_TWEET_ATTRS, \
-    REQUIRED_USER_ATTRS, RETWEET_ATTRS
+from .cache import UserCache, UserWriteBuffer, PlaceCache
+from .projection import normalize_user, normalize_tweet, \
+    normalize_retweet, add_newest_user
+from ..metrics import DB_WRITE_SECONDS, DUPLICATE_KEYS, timed
 
 # collections used
 TWEET_COLLECTION_NAME = "tweets"
@@ -15,104 +18,267 @@ PLACES_COLLECTION_NAME = "places"
 META_COLLECTION_NAME = "meta"
 RETWEET_COLLECTION_NAME = "retweets"
 
-# all tweet attrs to collect, includes required and optional attributes
-COLLECT_TWEET_ATTRS = REQUIRED_TWEET_ATTRS + \
-                      ["coordinates", "place", "in_reply_to_id",
-                       "in_reply_to_status_id", "quoted_id", "is_retweeted",
-                       "is_quoted"]
+# unique since_id index of meta, replaced by (query, since_id)
+LEGACY_META_INDEX = "since_id_1"
+
+# mongo error code for a unique index violation
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+# collections written to during collection, and their bulk load staging
+# collections: the name followed by STAGING_SUFFIX
+DATA_COLLECTIONS = (TWEET_COLLECTION_NAME, USER_COLLECTION_NAME,
+                    PLACES_COLLECTION_NAME, RETWEET_COLLECTION_NAME)
+STAGING_SUFFIX = "_staging"
+
+# indexes of each collection; a staging collection only has the first, the
+# id index
+INDEXES = {
+    TWEET_COLLECTION_NAME: [
+        pymongo.IndexModel([("id", pymongo.ASCENDING)], unique=True),
+        pymongo.IndexModel([("user_id", pymongo.ASCENDING)]),
+        pymongo.IndexModel([("timestamp", pymongo.DESCENDING)]),
+        pymongo.IndexModel([("full_text", pymongo.TEXT)]),
+        pymongo.IndexModel([("coordinates", pymongo.GEOSPHERE)],
+                           sparse=True)
+    ],
+    USER_COLLECTION_NAME: [
+        pymongo.IndexModel([("id", pymongo.ASCENDING)], unique=True),
+        pymongo.IndexModel([("last_tweet_id", pymongo.ASCENDING)],
+                           unique=True),
+        pymongo.IndexModel([("last_tweet_ts", pymongo.DESCENDING)])
+    ],
+    PLACES_COLLECTION_NAME: [
+        pymongo.IndexModel([("id", pymongo.ASCENDING)], unique=True),
+        pymongo.IndexModel([("bounding_box", pymongo.GEOSPHERE)],
+                           sparse=True)
+    ],
+    META_COLLECTION_NAME: [
+        pymongo.IndexModel([("timestamp", pymongo.DESCENDING)]),
+        pymongo.IndexModel([("next_max_id", pymongo.ASCENDING)]),
+        pymongo.IndexModel([("query", pymongo.ASCENDING),
+                            ("since_id", pymongo.ASCENDING)],
+                           unique=True)
+    ],
+    RETWEET_COLLECTION_NAME: [
+        pymongo.IndexModel([("id", pymongo.ASCENDING)]),
+        pymongo.IndexModel([("tweet_id", pymongo.ASCENDING)]),
+        pymongo.IndexModel([("user_id", pymongo.ASCENDING)]),
+        pymongo.IndexModel([("timestamp", pymongo.DESCENDING)])
+    ],
+}
+
+# (host, db name, collection name) of the collections whose indexes this
+# process has checked
+_ensured_indexes = set()
+
+
+def _index_key(collection, host):
+    return repr(host), collection.database.name, collection.name
+
+
+def ensure_indexes(collection, indexes, host=None, drop=()):
+    """Create the indexes missing from the collection's existing index
+    specs, compared by name, after dropping the drop index names. Each
+    collection is checked once per process; forked workers inherit the
+    check."""
+    key = _index_key(collection, host)
+    if key in _ensured_indexes:
+        return
+    existing = collection.index_information()
+    for name in drop:
+        if name in existing:
+            collection.drop_index(name)
+    missing = [index for index in indexes
+               if index.document["name"] not in existing]
+    if missing:
+        collection.create_indexes(missing)
+    _ensured_indexes.add(key)
+
+
+def forget_indexes(collection, host=None):
+    """check the collection's indexes again on the next ensure_indexes"""
+    _ensured_indexes.discard(_index_key(collection, host))
+
+
+def merge_pipeline(name, into):
+    """aggregation merging a staging collection into the live collection
+    into, keeping what the live collection already holds: stored tweets and
+    places win, the newer last_tweet_ts wins for users and retweets already
+    stored (the retweet id index is not unique) are skipped"""
+    if name == RETWEET_COLLECTION_NAME:
+        return [
+            {"$lookup": {"from": into, "localField": "id",
+                         "foreignField": "id", "as": "stored"}},
+            {"$match": {"stored": {"$size": 0}}},
+            {"$unset": "stored"},
+            {"$merge": {"into": into, "on": "_id",
+                        "whenMatched": "keepExisting",
+                        "whenNotMatched": "insert"}}
+        ]
+    when_matched = "keepExisting"
+    if name == USER_COLLECTION_NAME:
+        when_matched = [{"$replaceWith": {"$cond": [
+            {"$gt": ["$$new.last_tweet_ts", "$last_tweet_ts"]},
+            {"$mergeObjects": ["$$new", {"_id": "$_id"}]},
+            "$$ROOT"]}}]
+    return [{"$merge": {"into": into, "on": "id",
+                        "whenMatched": when_matched,
+                        "whenNotMatched": "insert"}}]
+
+
+@lru_cache(maxsize=None)
+def _bulk_write_seconds(collection_name):
+    return DB_WRITE_SECONDS.labels(op=f"bulk_write_{collection_name}")
 
 
 class MongoCollector(DbInterface):
-    def __init__(self, host, db_name):
+    def __init__(self, host, db_name, user_cache_size=100000,
+                 user_cache_ttl=3600, user_flush_interval=5,
+                 bulk_load=False):
+        """
+        Args:
+            user_cache_size: users whose newest last_tweet_ts is remembered
+                to skip writes that cannot win
+            user_cache_ttl: seconds a remembered user is trusted
+            user_flush_interval: seconds user writes are coalesced before
+                one bulk upsert; 0 writes users immediately
+            bulk_load: write tweets, users, places and retweets to staging
+                collections with only an id index until finish_bulk_load
+                builds the other indexes and swaps them in
+        """
+        self.user_cache = UserCache(user_cache_size, user_cache_ttl)
+        self.user_buffer = UserWriteBuffer(user_flush_interval) \
+            if user_flush_interval else None
+
+        self.host = host
         self.mongo = MongoClient(host=host)
         self.db = self.mongo.get_database(db_name)
-        self.tweets = self.db[TWEET_COLLECTION_NAME]
-        self.users = self.db[USER_COLLECTION_NAME]
-        self.places = self.db[PLACES_COLLECTION_NAME]
+        self.live = {name: self.db[name] for name in DATA_COLLECTIONS}
+        self.staging = {name: self.db[name + STAGING_SUFFIX]
+                        for name in DATA_COLLECTIONS}
         self.meta = self.db[META_COLLECTION_NAME]
-        self.retweets = self.db[RETWEET_COLLECTION_NAME]
-
-        self.setup()
-
-    def setup(self):
-        """create indexes"""
-        tweet_indexes = [
-            pymongo.IndexModel([("id", pymongo.ASCENDING)], unique=True),
-            pymongo.IndexModel([("user_id", pymongo.ASCENDING)]),
-            pymongo.IndexModel([("timestamp", pymongo.DESCENDING)]),
-            pymongo.IndexModel([("full_text", pymongo.TEXT)]),
-            pymongo.IndexModel([("coordinates", pymongo.GEOSPHERE)],
-                               sparse=True)
-        ]
-
-        user_indexes = [
-            pymongo.IndexModel([("id", pymongo.ASCENDING)], unique=True),
-            pymongo.IndexModel([("last_tweet_id", pymongo.ASCENDING)],
-                               unique=True),
-            pymongo.IndexModel([("last_tweet_ts", pymongo.DESCENDING)])
-        ]
+        self.bulk_load = bulk_load
+        self.write_to(self.staging if bulk_load else self.live)
 
-        place_indexes = [
-            pymongo.IndexModel([("id", pymongo.ASCENDING)], unique=True),
-            pymongo.IndexModel([("bounding_box", pymongo.GEOSPHERE)],
-                               sparse=True)
-        ]
+        self.place_cache = PlaceCache(self.get_place_ids)
 
-        meta_indexes = [
-            pymongo.IndexModel([("timestamp", pymongo.DESCENDING)]),
-            pymongo.IndexModel([("next_max_id", pymongo.ASCENDING)]),
-            pymongo.IndexModel([("since_id", pymongo.ASCENDING)], unique=True)
-        ]
+        self.setup()
 
-        retweet_indexes = [
-            pymongo.IndexModel([("tweet_id", pymongo.ASCENDING)]),
-            pymongo.IndexModel([("user_id", pymongo.ASCENDING)]),
-            pymongo.IndexModel([("timestamp", pymongo.DESCENDING)])
-        ]
+    def write_to(self, collections):
+        """point the tweet, user, place and retweet writes at collections,
+        a dict of collection name: collection"""
+        self.tweets = collections[TWEET_COLLECTION_NAME]
+        self.users = collections[USER_COLLECTION_NAME]
+        self.places = collections[PLACES_COLLECTION_NAME]
+        self.retweets = collections[RETWEET_COLLECTION_NAME]
+
+    def read_collections(self, name):
+        """the collections holding documents of the name collection: the
+        live one, and its staging collection during a bulk load"""
+        if self.bulk_load:
+            return [self.live[name], self.staging[name]]
+        return [self.live[name]]
+
+    def tweet_id_collections(self):
+        return self.read_collections(TWEET_COLLECTION_NAME) + \
+            self.read_collections(RETWEET_COLLECTION_NAME)
 
-        self.tweets.create_indexes(tweet_indexes)
-        self.users.create_indexes(user_indexes)
-        self.places.create_indexes(place_indexes)
-        self.meta.create_indexes(meta_indexes)
-        self.retweets.create_indexes(retweet_indexes)
+    def setup(self):
+        """create the missing indexes. During a bulk load the staging
+        collections get only their id index; finish_bulk_load builds the
+        rest."""
+        # states were unique by since_id alone before queries were tracked
+        ensure_indexes(self.meta, INDEXES[META_COLLECTION_NAME], self.host,
+                       drop=[LEGACY_META_INDEX])
+        for name in DATA_COLLECTIONS:
+            if self.bulk_load:
+                ensure_indexes(self.staging[name], INDEXES[name][:1],
+                               self.host)
+            else:
+                ensure_indexes(self.live[name], INDEXES[name], self.host)
+
+    def finish_bulk_load(self):
+        """Build the indexes of the staging collections once and swap them
+        in. A staging collection replaces an empty live collection by
+        rename; otherwise it is merged into the live collection (see
+        merge_staging)."""
+        self.flush()
+        for name in DATA_COLLECTIONS:
+            staging, live = self.staging[name], self.live[name]
+            if staging.estimated_document_count():
+                if live.estimated_document_count():
+                    self.merge_staging(name)
+                else:
+                    staging.create_indexes(INDEXES[name][1:])
+                    staging.rename(name, dropTarget=True)
+            staging.drop()
+            forget_indexes(staging, self.host)
+            forget_indexes(live, self.host)
+            ensure_indexes(live, INDEXES[name], self.host)
+        self.bulk_load = False
+        self.write_to(self.live)
+        self.place_cache = PlaceCache(self.get_place_ids)
+
+    def merge_staging(self, name):
+        """Merge a staging collection into its live collection, which keeps
+        its indexes. Every merged document updates them, which is slower
+        than one rebuild for a staging collection as large as the live
+        one, but queries on the live collection keep their text, geo and
+        unique indexes throughout."""
+        self.staging[name].aggregate(merge_pipeline(name, name))
 
     def get_user(self, user_id):
         return self.users.find_one({"id": user_id})
 
+    def get_place_ids(self):
+        return [place["id"] for collection in
+                self.read_collections(PLACES_COLLECTION_NAME)
+                for place in collection.find({}, {"_id": 0, "id": 1})]
+
     def get_place(self, place_id):
-        return self.places.findOne({"id": place_id})
+        return self.places.find_one({"id": place_id})
 
     def get_max_tweet_id(self):
         """Assuming tweet ids are ordered."""
-
-        max_id = list(self.tweets.find({}, {"_id": 0, "id": 1})
-                      .sort("id", -1)
-                      .limit(1))
-        return max_id[0]["id"] if max_id else 0
-
-    def save_collector_state(self, next_max_id, since_id, done):
-        try:
-            self.meta.insert({
+        max_ids = [doc["id"]
+                   for collection in self.read_collections(
+                       TWEET_COLLECTION_NAME)
+                   for doc in collection.find({}, {"_id": 0, "id": 1})
+                   .sort("id", -1)
+                   .limit(1)]
+        return max(max_ids, default=0)
+
+    def save_collector_state(self, next_max_id, since_id, done, query=None):
+        # one upsert per checkpoint
+        self.meta.update_one(
+            {"query": query, "since_id": since_id},
+            {"$set": {
                 "next_max_id": next_max_id,
-                "since_id": since_id,
                 "timestamp": datetime.now().timestamp(),
                 "done": done
-            })
-        except DuplicateKeyError:
-            self.meta.update(
-                {"since_id": since_id},
-                {
-                    "next_max_id": next_max_id,
-                    "since_id": since_id,
-                    "timestamp": datetime.now().timestamp(),
-                    "done": done
-                })
-
-    def load_collector_state(self):
+            }},
+            upsert=True)
+
+    def load_collector_state(self, query=None):
+        # states saved before queries were tracked have no query field,
+        # which matches None
         return [[next_id["next_max_id"], next_id["since_id"]] for next_id in
-                list(self.meta.find({"done": False})
+                list(self.meta.find({"done": False, "query": query})
                      .sort("since_id", pymongo.ASCENDING))]
 
+    def load_query_state(self, query):
+        doc = self.meta.find_one({"query": query, "since_id": None,
+                                  "state": {"$exists": True}})
+        return doc["state"] if doc else {}
+
+    def save_query_state(self, query, state):
+        # one document per query, with no since_id
+        self.meta.update_one(
+            {"query": query, "since_id": None},
+            {"$set": {"state": state,
+                      "timestamp": datetime.now().timestamp()}},
+            upsert=True)
+
     def get_last_tweet_id(self):
 
         # get last tweet that wasn't retweeted or quoted
@@ -137,102 +303,235 @@ class MongoCollector(DbInterface):
         # return min of last retweet and tweet collected
         return min([last_retweet_id, last_tweet_id])
 
+    def estimate_tweet_count(self):
+        return sum(collection.estimated_document_count()
+                   for collection in self.tweet_id_collections())
+
+    def iter_tweet_ids(self):
+        """covered scans of the id indexes"""
+        for collection in self.tweet_id_collections():
+            for doc in collection.find({}, {"_id": 0, "id": 1}).hint(
+                    [("id", pymongo.ASCENDING)]):
+                yield doc["id"]
+
+    def get_stored_tweet_ids(self, ids):
+        stored = set()
+        for collection in self.tweet_id_collections():
+            stored.update(doc["id"] for doc in collection.find(
+                {"id": {"$in": list(ids)}}, {"_id": 0, "id": 1}))
+        return stored
+
     def get_min_tweet_id(self):
 
-        max_id = list(self.tweets.find({}, {"_id": 0, "id": 1})
-                      .sort("id", -1)
+        min_id = list(self.tweets.find({}, {"_id": 0, "id": 1})
+                      .sort("id", 1)
                       .limit(1))
-        return max_id[0]["id"] if max_id else maxsize
+        return min_id[0]["id"] if min_id else maxsize
 
-    def insert_place(self, place_dict):
+    def read_tweets(self, min_id, max_id, limit):
+        """one id index range scan; _id is left out"""
+        return list(self.tweets.find({"id": {"$gt": min_id, "$lte": max_id}},
+                                     {"_id": 0})
+                    .sort("id", pymongo.ASCENDING)
+                    .limit(limit))
+
+    def get_users(self, user_ids):
+        return {user["id"]: user for user in self.users.find(
+            {"id": {"$in": list(user_ids)}}, {"_id": 0})}
+
+    def get_places(self, place_ids):
+        return {place["id"]: place for place in self.places.find(
+            {"id": {"$in": list(place_ids)}}, {"_id": 0})}
 
-        # need to close bounding box for mongo geo index
+    def normalize_place(self, place_dict):
+        """close the place bounding boxes for the mongo geo index"""
         coords = []
 
         # need to connect box with end coord
         for box in place_dict["bounding_box"]["coordinates"]:
 
-            # some boxes have 3 repeated coords; change Polygon to Point
-            if len(np.unique(box)) < len(box):
+            # some boxes have 3 repeated coords; change Polygon to Point.
+            # (fewer distinct coordinate values than corners)
+            if len({value for point in box for value in point}) < len(box):
                 coords = box[0]
                 place_dict["bounding_box"]["type"] = "Point"
                 break
             box.append(box[0])
             coords.append(box)
         place_dict["bounding_box"]["coordinates"] = coords
+        return place_dict
 
-        try:
-            self.places.insert(place_dict)
-        except DuplicateKeyError:
-            return
+    def normalize_user(self, user_dict, tweet_ts, tweet_id):
+        return normalize_user(user_dict, tweet_ts, tweet_id)
 
-    def insert_user(self, user_dict, tweet_ts, tweet_id):
-        # delete all unused attributes
-        del_keys = [key for key, val in user_dict.items() if key not in
-                    REQUIRED_USER_ATTRS or val is None]
+    def normalize_tweet(self, tweet_attrs, user_attrs):
+        return normalize_tweet(tweet_attrs, user_attrs)
 
-        for key in del_keys:
-            del user_dict[key]
+    def normalize_retweet(self, retweet, user_attrs):
+        return normalize_retweet(retweet, user_attrs)
 
-        user_dict["last_tweet_id"] = tweet_id
-        user_dict["last_tweet_ts"] = tweet_ts
+    def insert_place(self, place_dict):
+        """insert a place unless the place cache already knows it"""
+        self.write_places([place_dict])
+
+    def write_places(self, places):
+        """normalize and insert the places not in the place cache with one
+        bulk write"""
+        places = self.place_cache.unknown(places)
+        if places:
+            self._bulk_write(self.places,
+                             [self.insert_op(self.normalize_place(place))
+                              for place in places])
+            self.place_cache.add(place["id"] for place in places)
 
-        # insert if does not exist, else update
+    def insert_user(self, user_dict, tweet_ts, tweet_id):
+        self.write_user(self.normalize_user(user_dict, tweet_ts, tweet_id))
+
+    def write_user(self, user):
+        """upsert a normalized user when its tweet is newer than the stored
+        one"""
+        self.buffer_users([user])
+
+    def buffer_users(self, users):
+        """Upsert normalized users, skipping those the user cache has seen
+        a newer tweet of. When user writes are coalesced they are buffered
+        and written within user_flush_interval seconds."""
+        users = [user for user in users
+                 if self.user_cache.wins(user["id"], user["last_tweet_ts"])]
+        if not self.user_buffer:
+            self.write_users(users)
+            return
+        started = False
+        for user in users:
+            started = self.user_buffer.add(user) or started
+        if self.user_buffer.due():
+            self.flush_users()
+        elif started:
+            timer = threading.Timer(self.user_buffer.flush_interval,
+                                    self.flush_users)
+            timer.daemon = True
+            timer.start()
+
+    def write_users(self, users):
+        """upsert users, recording them in the user cache once the write is
+        acknowledged"""
+        self._bulk_write(self.users, [self.user_upsert(user)
+                                      for user in users])
+        for user in users:
+            self.user_cache.record(user["id"], user["last_tweet_ts"])
+
+    @staticmethod
+    def insert_op(doc):
+        return InsertOne(doc)
+
+    @staticmethod
+    def retweet_upsert(record):
+        """Insert a retweet unless one with its id is stored. The retweet
+        id index is not unique, so a replayed insert would add a copy."""
+        return UpdateOne({"id": record["id"]}, {"$setOnInsert": record},
+                         upsert=True)
+
+    @staticmethod
+    def user_upsert(user):
+        """Upsert guarded on last_tweet_ts. When the stored user is newer
+        the upsert fails with a duplicate key error, which _bulk_write
+        ignores."""
+        return UpdateOne({"id": user["id"],
+                          "last_tweet_ts": {"$lt": user["last_tweet_ts"]}},
+                         {"$set": user}, upsert=True)
+
+    def flush_users(self):
+        """write the buffered users; they are buffered again if the write
+        fails, for the next flush"""
+        if not self.user_buffer:
+            return
+        users = self.user_buffer.drain()
         try:
-            self.users.insert(user_dict)
-        except DuplicateKeyError:
-            if "_id" in user_dict:
-                del user_dict["_id"]
-            self.users.update(
-                {"id": user_dict["id"], "last_tweet_ts": {"$lt": tweet_ts}},
-                user_dict
-            )
+            self.write_users(users)
+        except Exception:
+            for user in users:
+                self.user_buffer.add(user)
+            raise
 
-    def insert_tweet(self, tweet_attrs, user_attrs):
-
-        # interface's method will make sure the required attributes are
-        # present in the arguments.
-        super().insert_tweet(tweet_attrs, user_attrs)
+    def flush(self):
+        self.flush_users()
 
-        # Remove all keys we are not interested in
-        # ie those not in COLLECT_TWEET_ATTRS
-        del_keys = [key for key, val in tweet_attrs.items() if key not in
-                    COLLECT_TWEET_ATTRS or val is None]
-        for key in del_keys:
-            del tweet_attrs[key]
+    def close(self):
+        self.flush_users()
+        self.mongo.close()
 
-        # Set the tweets timestamp parsed from created_at string
-        tweet_timestamp = created_at_to_ts(tweet_attrs["created_at"])
-        tweet_attrs["timestamp"] = tweet_timestamp
-        tweet_attrs["user_id"] = user_attrs["id"]
+    @timed(DB_WRITE_SECONDS, op="insert_tweet")
+    def insert_tweet(self, tweet_attrs, user_attrs):
+        # normalize_tweet validates the required attributes as it projects
+        tweet, user, place = self.normalize_tweet(tweet_attrs, user_attrs)
 
         # insert the user
-        self.insert_user(user_attrs, tweet_timestamp, tweet_attrs["id"])
+        self.write_user(user)
 
-        # set place id and insert into places collection
-        if "place" in tweet_attrs and tweet_attrs["place"]:
-            tweet_attrs["place_id"] = tweet_attrs["place"]["id"]
-            self.insert_place(tweet_attrs["place"])
-            del tweet_attrs["place"]
+        # insert into places collection
+        if place:
+            self.insert_place(place)
 
         try:
-            self.tweets.insert(tweet_attrs)
+            self.tweets.insert_one(tweet)
         except DuplicateKeyError:
+            DUPLICATE_KEYS.inc(collection=TWEET_COLLECTION_NAME)
             return
 
+    @timed(DB_WRITE_SECONDS, op="insert_retweet")
     def insert_retweet(self, retweet, user):
-        retweet["tweet_id"] = retweet["retweeted_status"]["id"]
-        if "place" in retweet and retweet["place"]:
-            retweet["place_id"] = retweet["place"]["id"]
-            self.insert_place(retweet["place"])
-
-        retweet_ts = created_at_to_ts(retweet["created_at"])
-        retweet["timestamp"] = retweet_ts
-
-        self.insert_user(user, retweet_ts, retweet["id"])
-
-        del_keys = [key for key in retweet if key not in RETWEET_ATTRS]
-        for key in del_keys:
-            del retweet[key]
-
-        self.retweets.insert(retweet)
+        record, user, place = self.normalize_retweet(retweet, user)
+        if place:
+            self.insert_place(place)
+
+        self.write_user(user)
+
+        self._bulk_write(self.retweets, [self.retweet_upsert(record)])
+
+    @timed(DB_WRITE_SECONDS, op="insert_tweets_batch")
+    def insert_tweets_batch(self, tweets, retweets):
+        """Write a page of tweets with one unordered bulk_write per
+        collection. Users are upserted only when the tweet is newer than
+        the stored last_tweet_ts; the resulting duplicate key errors (the
+        stored user is newer, or the tweet / place already exists) are
+        expected and ignored. User upserts go through the user cache and
+        write buffer like write_user."""
+        tweet_ops = []
+        retweet_ops = []
+        users = {}
+        places = {}
+
+        for tweet_attrs, user_attrs in tweets:
+            tweet, user, place = self.normalize_tweet(tweet_attrs,
+                                                      user_attrs)
+            if place:
+                places[place["id"]] = place
+            add_newest_user(users, user)
+            tweet_ops.append(self.insert_op(tweet))
+
+        for retweet, user_attrs in retweets:
+            record, user, place = self.normalize_retweet(retweet, user_attrs)
+            if place:
+                places[place["id"]] = place
+            add_newest_user(users, user)
+            retweet_ops.append(self.retweet_upsert(record))
+
+        self.buffer_users(list(users.values()))
+        self.write_places(list(places.values()))
+        self._bulk_write(self.tweets, tweet_ops)
+        self._bulk_write(self.retweets, retweet_ops)
+
+    @staticmethod
+    def _bulk_write(collection, ops):
+        if not ops:
+            return
+        with _bulk_write_seconds(collection.name).time():
+            try:
+                collection.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                errors = [err for err in e.details["writeErrors"]
+                          if err["code"] != DUPLICATE_KEY_ERROR_CODE]
+                DUPLICATE_KEYS.inc(len(e.details["writeErrors"]) -
+                                   len(errors), collection=collection.name)
+                if errors or e.details.get("writeConcernErrors"):
+                    raise
@@ -0,0 +1,137 @@
+"""Projection of api statuses and users onto the attributes we store.
+
+The attribute lists in config.py are compiled once into projector
+functions that copy the wanted keys into a new compact dict with direct
+lookups, instead of scanning every key of the incoming dict against the
+lists and deleting the rest. Validation of the required attributes is done
+on the projected record in the same pass. The functions are shared by all
+database modules, as are the normalize_* functions building the stored
+tweet, retweet and user records."""
+
+from ..config import REQUIRED_TWEET_ATTRS, REQUIRED_USER_ATTRS, \
+    RETWEET_ATTRS, COLLECT_TWEET_ATTRS
+from ..snowflake import status_timestamp
+
+
+def compile_projector(name, keys, skip_none=True):
+    """Generate a function copying keys from a dict into a new dict.
+    Missing keys, and None values when skip_none is set, are left out."""
+    lines = [f"def {name}(src):", "    out = {}", "    get = src.get"]
+    for key in keys:
+        lines.append(f"    val = get({key!r})")
+        if skip_none:
+            lines.append("    if val is not None:")
+        else:
+            lines.append(f"    if val is not None or {key!r} in src:")
+        lines.append(f"        out[{key!r}] = val")
+    lines.append("    return out")
+
+    namespace = {}
+    exec("\n".join(lines), namespace)
+    projector = namespace[name]
+    projector.__doc__ = f"project a dict onto {list(keys)}"
+    return projector
+
+
+project_tweet_attrs = compile_projector("project_tweet_attrs",
+                                        COLLECT_TWEET_ATTRS)
+project_user_attrs = compile_projector("project_user_attrs",
+                                       REQUIRED_USER_ATTRS)
+project_retweet_attrs = compile_projector("project_retweet_attrs",
+                                          RETWEET_ATTRS, skip_none=False)
+
+
+def missing_attrs(record, required_keys):
+    """required keys that are absent or None in a projected record"""
+    return [key for key in required_keys if key not in record]
+
+
+def raise_missing(missing_tweet_attrs, missing_user_attrs):
+    if missing_user_attrs or missing_tweet_attrs:
+        raise KeyError(f"Missing attributes:\n\tmissing tweet"
+                       f"attributes: {missing_tweet_attrs}\n\t"
+                       f"missing user attributes {missing_user_attrs}")
+
+
+def project_tweet(tweet_attrs, user_attrs):
+    """Project and validate a tweet and its user.
+
+    Returns:
+        (tweet, user) new dicts holding COLLECT_TWEET_ATTRS and
+        REQUIRED_USER_ATTRS
+
+    Raises:
+        KeyError if a required attribute is missing or None
+    """
+    tweet = project_tweet_attrs(tweet_attrs)
+    user = project_user_attrs(user_attrs)
+    raise_missing(missing_attrs(tweet, REQUIRED_TWEET_ATTRS),
+                  missing_attrs(user, REQUIRED_USER_ATTRS))
+    return tweet, user
+
+
+def validate_tweet(tweet_attrs, user_attrs):
+    """raise KeyError if a required tweet or user attribute is missing"""
+    raise_missing(
+        [key for key in REQUIRED_TWEET_ATTRS
+         if tweet_attrs.get(key) is None],
+        [key for key in REQUIRED_USER_ATTRS
+         if user_attrs.get(key) is None])
+
+
+def normalize_user(user_dict, tweet_ts, tweet_id):
+    """compact user record with the last tweet fields set"""
+    user = project_user_attrs(user_dict)
+    user["last_tweet_id"] = tweet_id
+    user["last_tweet_ts"] = tweet_ts
+    return user
+
+
+def normalize_tweet(tweet_attrs, user_attrs):
+    """Project and validate a tweet and its user (see
+    DbInterface.insert_tweet) and set the timestamp, user_id and place_id
+    fields. The arguments are not changed.
+
+    Returns:
+        (tweet, user, place) with place None for tweets without one
+    """
+    tweet, user = project_tweet(tweet_attrs, user_attrs)
+
+    # Set the tweets timestamp from its snowflake id
+    tweet["timestamp"] = status_timestamp(tweet)
+    tweet["user_id"] = user["id"]
+    user["last_tweet_id"] = tweet["id"]
+    user["last_tweet_ts"] = tweet["timestamp"]
+
+    place = tweet.pop("place", None)
+    if place:
+        tweet["place_id"] = place["id"]
+    return tweet, user, place
+
+
+def normalize_retweet(retweet, user_attrs):
+    """reduce a retweet to RETWEET_ATTRS.
+
+    Returns:
+        (retweet, user, place) with place None for retweets without one
+    """
+    record = project_retweet_attrs(retweet)
+    record["tweet_id"] = retweet["retweeted_status"]["id"]
+    record["user_id"] = user_attrs["id"]
+    record["timestamp"] = status_timestamp(retweet)
+
+    place = retweet.get("place")
+    if place:
+        record["place_id"] = place["id"]
+
+    user = normalize_user(user_attrs, record["timestamp"], record["id"])
+    return record, user, place
+
+
+def add_newest_user(users, user):
+    """keep the newest version of each user in a dict keyed by user id"""
+    user_id = user["id"]
+    if user_id in users and \
+            users[user_id]["last_tweet_ts"] >= user["last_tweet_ts"]:
+        return
+    users[user_id] = user
@@ -0,0 +1,355 @@
+"""Append-only segment file database module.
+
+Records are normalized like the mongo module's and appended as gzip
+compressed json lines to segment files, one directory per record kind,
+for bulk loading into a database later:
+
+    {address}/{db_name}/tweets/00000001.jsonl.gz
+    {address}/{db_name}/tweets/00000001.ids
+    ...
+    {address}/{db_name}/meta.json
+
+A segment is rotated once it holds max_segment_bytes of json or is
+max_segment_age seconds old. On rotation the sorted ids of its tweets or
+retweets are written to an .ids index next to it (little endian int64), which
+answers the id lookups of the seen id filter and get_max_tweet_id without
+reading the segments. Segments are never appended to after a restart; one
+left open by a crash is indexed from its readable records on startup.
+
+Files are append-only, so a user is written once per page it appears in and
+a tweet collected twice by overlapping ranges is written twice; bulk loads
+keep the newest user by last_tweet_ts and the first copy of a tweet."""
+
+import os
+import gzip
+import time
+import zlib
+import json
+import threading
+from sys import maxsize
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from functools import lru_cache
+from .DbInterface import DbInterface
+from .projection import normalize_tweet, normalize_retweet, add_newest_user
+from ..decode import dumps, loads
+
+SEGMENT_SUFFIX = ".jsonl.gz"
+INDEX_SUFFIX = ".ids"
+ID_SIZE = array("q").itemsize
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_SEGMENT_AGE = 60 * 60
+
+
+@lru_cache(maxsize=16)
+def load_index(path):
+    """sorted ids of a closed segment"""
+    ids = array("q")
+    with open(path, "rb") as fp:
+        ids.frombytes(fp.read())
+    return ids
+
+
+def read_segment(path):
+    """records of a segment, stopping at a truncated end"""
+    records = []
+    try:
+        with gzip.open(path, "rb") as fp:
+            for line in fp:
+                records.append(loads(line))
+    except (EOFError, zlib.error, ValueError):
+        pass
+    return records
+
+
+class SegmentWriter(object):
+    """Segments of one record kind.
+
+    Args:
+        indexed: keep the .ids index of the record ids
+    """
+
+    def __init__(self, directory, indexed=True,
+                 max_segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 max_segment_age=DEFAULT_SEGMENT_AGE):
+        self.directory = directory
+        self.indexed = indexed
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.lock = threading.Lock()
+
+        # (min id, max id, number of ids, index path) of closed segments
+        self.segments = []
+        self.fp = None
+        self.ids = set()
+        self.size = 0
+        self.opened_at = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.seq = 0
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                self.seq = max(self.seq,
+                               int(name[:-len(SEGMENT_SUFFIX)]))
+                if indexed:
+                    self.recover(os.path.join(directory, name))
+
+    def path(self, seq, suffix):
+        return os.path.join(self.directory, f"{seq:08d}{suffix}")
+
+    def recover(self, segment_path):
+        """register the index of a segment, writing it first if the
+        segment was left open"""
+        index_path = segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        if not os.path.exists(index_path):
+            self.write_index(index_path, (record["id"] for record in
+                                          read_segment(segment_path)))
+        self.add_index(index_path)
+
+    @staticmethod
+    def write_index(index_path, ids):
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "wb") as fp:
+            array("q", sorted(set(ids))).tofile(fp)
+        os.replace(tmp_path, index_path)
+
+    def add_index(self, index_path):
+        num_ids = os.path.getsize(index_path) // ID_SIZE
+        if not num_ids:
+            return
+        with open(index_path, "rb") as fp:
+            first = array("q", fp.read(ID_SIZE))
+            fp.seek(-ID_SIZE, os.SEEK_END)
+            last = array("q", fp.read(ID_SIZE))
+        self.segments.append((first[0], last[0], num_ids, index_path))
+
+    def write(self, records):
+        """append records, skipping ids already in the open segment"""
+        with self.lock:
+            if self.indexed:
+                records = [record for record in records
+                           if record["id"] not in self.ids]
+            if not records:
+                return
+            if self.fp is None:
+                self.seq += 1
+                self.fp = gzip.open(self.path(self.seq, SEGMENT_SUFFIX), "wb")
+                self.opened_at = time.monotonic()
+
+            data = b"".join(dumps(record) + b"\n" for record in records)
+            self.fp.write(data)
+            self.size += len(data)
+            if self.indexed:
+                self.ids.update(record["id"] for record in records)
+            if self.rotation_due():
+                self.rotate()
+
+    def rotation_due(self):
+        return self.fp is not None and (
+            self.size >= self.max_segment_bytes or
+            time.monotonic() - self.opened_at >= self.max_segment_age)
+
+    def rotate(self):
+        """close the open segment and write its index; call with the lock"""
+        if self.fp is None:
+            return
+        self.fp.close()
+        if self.indexed:
+            index_path = self.path(self.seq, INDEX_SUFFIX)
+            self.write_index(index_path, self.ids)
+            self.add_index(index_path)
+        self.fp = None
+        self.ids = set()
+        self.size = 0
+
+    def flush(self):
+        """make the written records readable by a later recovery"""
+        with self.lock:
+            if self.rotation_due():
+                self.rotate()
+            elif self.fp is not None:
+                self.fp.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        with self.lock:
+            self.rotate()
+
+    def max_id(self):
+        with self.lock:
+            return max([segment[1] for segment in self.segments] +
+                       list(self.ids), default=None)
+
+    def min_id(self):
+        with self.lock:
+            return min([segment[0] for segment in self.segments] +
+                       list(self.ids), default=None)
+
+    def count(self):
+        with self.lock:
+            return sum(segment[2] for segment in self.segments) + \
+                len(self.ids)
+
+    def iter_ids(self):
+        with self.lock:
+            segments = list(self.segments)
+            open_ids = list(self.ids)
+        for _, _, _, index_path in segments:
+            yield from load_index(index_path)
+        yield from open_ids
+
+    def stored(self, ids):
+        """the ids found in the segments"""
+        with self.lock:
+            segments = list(self.segments)
+            stored = {record_id for record_id in ids
+                      if record_id in self.ids}
+        for min_id, max_id, _, index_path in segments:
+            candidates = [record_id for record_id in ids
+                          if min_id <= record_id <= max_id and
+                          record_id not in stored]
+            if not candidates:
+                continue
+            index = load_index(index_path)
+            for record_id in candidates:
+                pos = bisect_left(index, record_id)
+                if pos < len(index) and index[pos] == record_id:
+                    stored.add(record_id)
+        return stored
+
+
+class SegmentCollector(DbInterface):
+    def __init__(self, address, db_name,
+                 max_segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 max_segment_age=DEFAULT_SEGMENT_AGE):
+        """
+        Args:
+            address: directory holding the databases
+            db_name: the segments are kept in {address}/{db_name}
+            max_segment_bytes: uncompressed json bytes per segment
+            max_segment_age: seconds before a segment is rotated
+        """
+        self.directory = os.path.join(address, db_name)
+
+        def writer(kind, indexed):
+            return SegmentWriter(os.path.join(self.directory, kind), indexed,
+                                 max_segment_bytes, max_segment_age)
+
+        self.tweets = writer("tweets", True)
+        self.retweets = writer("retweets", True)
+        self.users = writer("users", False)
+        self.places = writer("places", False)
+        self.writers = [self.tweets, self.retweets, self.users, self.places]
+
+        # place ids written by this process
+        self.place_ids = set()
+        self.place_lock = threading.Lock()
+
+        self.meta_path = os.path.join(self.directory, "meta.json")
+        self.meta_lock = threading.Lock()
+        self.meta = {"states": {}, "queries": {}}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as fp:
+                self.meta = json.load(fp)
+
+    def save_meta(self):
+        """rewrite meta.json atomically; call with the meta lock"""
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(self.meta, fp)
+        os.replace(tmp_path, self.meta_path)
+
+    def get_max_tweet_id(self):
+        return self.tweets.max_id() or 0
+
+    def get_min_tweet_id(self):
+        min_id = self.tweets.min_id()
+        return maxsize if min_id is None else min_id
+
+    def save_collector_state(self, next_max_id, since_id, done, query=None):
+        with self.meta_lock:
+            # json object keys are strings
+            self.meta["states"][json.dumps([query, since_id])] = {
+                "next_max_id": next_max_id,
+                "since_id": since_id,
+                "query": query,
+                "timestamp": datetime.now().timestamp(),
+                "done": done
+            }
+            self.save_meta()
+
+    def load_collector_state(self, query=None):
+        with self.meta_lock:
+            states = list(self.meta["states"].values())
+        return sorted(([state["next_max_id"], state["since_id"]]
+                       for state in states
+                       if state["query"] == query and not state["done"]),
+                      key=lambda id_range: id_range[1])
+
+    def load_query_state(self, query):
+        with self.meta_lock:
+            return dict(self.meta["queries"].get(query, {}))
+
+    def save_query_state(self, query, state):
+        with self.meta_lock:
+            self.meta["queries"][query] = dict(state)
+            self.save_meta()
+
+    def estimate_tweet_count(self):
+        return self.tweets.count() + self.retweets.count()
+
+    def iter_tweet_ids(self):
+        yield from self.tweets.iter_ids()
+        yield from self.retweets.iter_ids()
+
+    def get_stored_tweet_ids(self, ids):
+        ids = list(ids)
+        return self.tweets.stored(ids) | self.retweets.stored(ids)
+
+    def insert_tweet(self, tweet_attrs, user_attrs):
+        self.insert_tweets_batch([(tweet_attrs, user_attrs)], [])
+
+    def insert_retweet(self, retweet, user):
+        self.insert_tweets_batch([], [(retweet, user)])
+
+    def insert_tweets_batch(self, tweets, retweets):
+        """append a page: the newest version of each user, the places not
+        written by this process yet, then the tweets and retweets"""
+        tweet_records = []
+        retweet_records = []
+        users = {}
+        places = {}
+
+        for tweet_attrs, user_attrs in tweets:
+            tweet, user, place = normalize_tweet(tweet_attrs, user_attrs)
+            if place:
+                places[place["id"]] = place
+            add_newest_user(users, user)
+            tweet_records.append(tweet)
+
+        for retweet, user_attrs in retweets:
+            record, user, place = normalize_retweet(retweet, user_attrs)
+            if place:
+                places[place["id"]] = place
+            add_newest_user(users, user)
+            retweet_records.append(record)
+
+        with self.place_lock:
+            places = [place for place_id, place in places.items()
+                      if place_id not in self.place_ids]
+            self.place_ids.update(place["id"] for place in places)
+
+        self.users.write(list(users.values()))
+        self.places.write(places)
+        self.tweets.write(tweet_records)
+        self.retweets.write(retweet_records)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self):
+        """close the open segments, writing their indexes"""
+        for writer in self.writers:
+            writer.close()
@@ -0,0 +1,268 @@
+"""SQLite database module for collecting without a database server.
+
+Records are normalized like the mongo module's and stored as json documents
+next to the columns they are queried by. The database runs in WAL mode and
+every page is written in one transaction. Needs SQLite 3.24 or newer for
+upserts."""
+
+import os
+import sqlite3
+import threading
+from sys import maxsize
+from datetime import datetime
+from .DbInterface import DbInterface
+from .projection import normalize_tweet, normalize_retweet, add_newest_user
+from ..decode import dumps, loads
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tweets (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tweets_user_id ON tweets (user_id);
+CREATE INDEX IF NOT EXISTS tweets_timestamp ON tweets (timestamp);
+
+CREATE TABLE IF NOT EXISTS retweets (
+    id INTEGER PRIMARY KEY,
+    tweet_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS retweets_tweet_id ON retweets (tweet_id);
+CREATE INDEX IF NOT EXISTS retweets_user_id ON retweets (user_id);
+CREATE INDEX IF NOT EXISTS retweets_timestamp ON retweets (timestamp);
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    last_tweet_id INTEGER NOT NULL,
+    last_tweet_ts REAL NOT NULL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_last_tweet_ts ON users (last_tweet_ts);
+
+CREATE TABLE IF NOT EXISTS places (
+    id TEXT PRIMARY KEY,
+    doc TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    query TEXT NOT NULL,
+    since_id INTEGER NOT NULL,
+    next_max_id INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    done INTEGER NOT NULL,
+    PRIMARY KEY (query, since_id)
+);
+
+CREATE TABLE IF NOT EXISTS query_state (
+    query TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+"""
+
+INSERT_TWEET = "INSERT OR IGNORE INTO tweets (id, user_id, timestamp, doc) " \
+               "VALUES (?, ?, ?, ?)"
+INSERT_RETWEET = "INSERT OR IGNORE INTO retweets (id, tweet_id, user_id, " \
+                 "timestamp, doc) VALUES (?, ?, ?, ?, ?)"
+INSERT_PLACE = "INSERT OR IGNORE INTO places (id, doc) VALUES (?, ?)"
+# the stored user is only replaced by a newer version
+UPSERT_USER = """
+INSERT INTO users (id, last_tweet_id, last_tweet_ts, doc) VALUES (?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    last_tweet_id = excluded.last_tweet_id,
+    last_tweet_ts = excluded.last_tweet_ts,
+    doc = excluded.doc
+WHERE excluded.last_tweet_ts > users.last_tweet_ts
+"""
+UPSERT_STATE = """
+INSERT INTO meta (query, since_id, next_max_id, timestamp, done)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (query, since_id) DO UPDATE SET
+    next_max_id = excluded.next_max_id,
+    timestamp = excluded.timestamp,
+    done = excluded.done
+"""
+
+# ids per IN (...) lookup, below the SQLite variable limit
+LOOKUP_CHUNK = 500
+
+
+def _query_key(query):
+    # the primary key cannot hold NULL; states without a query use ""
+    return "" if query is None else query
+
+
+def _doc(record):
+    return dumps(record).decode()
+
+
+class SqliteCollector(DbInterface):
+    def __init__(self, address, db_name):
+        """
+        Args:
+            address: directory holding the database file
+            db_name: the database file is {db_name}.sqlite
+        """
+        os.makedirs(address, exist_ok=True)
+        self.path = os.path.join(address, f"{db_name}.sqlite")
+
+        # one connection shared by the writer threads; SQLite serializes
+        # writes anyway
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False,
+                                    isolation_level=None)
+        self.setup()
+
+    def setup(self):
+        """set WAL mode and create the tables and indexes"""
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+
+    def transaction(self, statements):
+        """run (sql, rows) executemany statements in one transaction"""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                for sql, rows in statements:
+                    if rows:
+                        self.conn.executemany(sql, rows)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get_max_tweet_id(self):
+        return self.query("SELECT max(id) FROM tweets")[0][0] or 0
+
+    def get_min_tweet_id(self):
+        min_id = self.query("SELECT min(id) FROM tweets")[0][0]
+        return maxsize if min_id is None else min_id
+
+    def save_collector_state(self, next_max_id, since_id, done, query=None):
+        self.transaction([(UPSERT_STATE, [
+            (_query_key(query), since_id, next_max_id,
+             datetime.now().timestamp(), int(done))])])
+
+    def load_collector_state(self, query=None):
+        return [[next_max_id, since_id] for next_max_id, since_id in
+                self.query("SELECT next_max_id, since_id FROM meta "
+                           "WHERE query = ? AND done = 0 ORDER BY since_id",
+                           (_query_key(query),))]
+
+    def load_query_state(self, query):
+        rows = self.query("SELECT state FROM query_state WHERE query = ?",
+                          (query,))
+        return loads(rows[0][0]) if rows else {}
+
+    def save_query_state(self, query, state):
+        self.transaction([(
+            "INSERT OR REPLACE INTO query_state (query, state, timestamp) "
+            "VALUES (?, ?, ?)",
+            [(query, _doc(state), datetime.now().timestamp())])])
+
+    def estimate_tweet_count(self):
+        return self.query("SELECT (SELECT count(*) FROM tweets) + "
+                          "(SELECT count(*) FROM retweets)")[0][0]
+
+    def iter_tweet_ids(self):
+        """ids in chunks so the lock is not held between yields"""
+        for table in ("tweets", "retweets"):
+            last_id = -1
+            while True:
+                rows = self.query(f"SELECT id FROM {table} WHERE id > ? "
+                                  f"ORDER BY id LIMIT 10000", (last_id,))
+                if not rows:
+                    break
+                for (tweet_id,) in rows:
+                    yield tweet_id
+                last_id = rows[-1][0]
+
+    def get_stored_tweet_ids(self, ids):
+        ids = list(ids)
+        stored = set()
+        for start in range(0, len(ids), LOOKUP_CHUNK):
+            chunk = ids[start:start + LOOKUP_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            stored.update(tweet_id for (tweet_id,) in self.query(
+                f"SELECT id FROM tweets WHERE id IN ({marks}) UNION "
+                f"SELECT id FROM retweets WHERE id IN ({marks})",
+                chunk + chunk))
+        return stored
+
+    def read_tweets(self, min_id, max_id, limit):
+        return [loads(doc) for (doc,) in self.query(
+            "SELECT doc FROM tweets WHERE id > ? AND id <= ? ORDER BY id "
+            "LIMIT ?", (min_id, max_id, limit))]
+
+    def get_docs(self, table, ids):
+        """{id: doc} of the rows of table with the given ids"""
+        ids = list(ids)
+        docs = {}
+        for start in range(0, len(ids), LOOKUP_CHUNK):
+            chunk = ids[start:start + LOOKUP_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            docs.update((row_id, loads(doc)) for row_id, doc in self.query(
+                f"SELECT id, doc FROM {table} WHERE id IN ({marks})", chunk))
+        return docs
+
+    def get_users(self, user_ids):
+        return self.get_docs("users", user_ids)
+
+    def get_places(self, place_ids):
+        return self.get_docs("places", place_ids)
+
+    def insert_tweet(self, tweet_attrs, user_attrs):
+        self.insert_tweets_batch([(tweet_attrs, user_attrs)], [])
+
+    def insert_retweet(self, retweet, user):
+        self.insert_tweets_batch([], [(retweet, user)])
+
+    def insert_tweets_batch(self, tweets, retweets):
+        """write a page in one transaction; existing tweets, retweets and
+        places are ignored and users are only replaced by newer versions"""
+        tweet_rows = []
+        retweet_rows = []
+        users = {}
+        places = {}
+
+        for tweet_attrs, user_attrs in tweets:
+            tweet, user, place = normalize_tweet(tweet_attrs, user_attrs)
+            if place:
+                places[place["id"]] = place
+            add_newest_user(users, user)
+            tweet_rows.append((tweet["id"], tweet["user_id"],
+                               tweet["timestamp"].timestamp(), _doc(tweet)))
+
+        for retweet, user_attrs in retweets:
+            record, user, place = normalize_retweet(retweet, user_attrs)
+            if place:
+                places[place["id"]] = place
+            add_newest_user(users, user)
+            retweet_rows.append((record["id"], record["tweet_id"],
+                                 record["user_id"],
+                                 record["timestamp"].timestamp(),
+                                 _doc(record)))
+
+        self.transaction([
+            (UPSERT_USER, [(user["id"], user["last_tweet_id"],
+                            user["last_tweet_ts"].timestamp(), _doc(user))
+                           for user in users.values()]),
+            (INSERT_PLACE, [(place_id, _doc(place))
+                            for place_id, place in places.items()]),
+            (INSERT_TWEET, tweet_rows),
+            (INSERT_RETWEET, retweet_rows),
+        ])
@@ -0,0 +1,73 @@
+"""Decoding of search api responses.
+
+Each response body is parsed exactly once, with orjson when it is installed
+and the standard json module otherwise. Statuses can be projected down to
+the attributes the database modules store while decoding, so the nested
+retweeted_status, quoted_status and user objects do not carry every api
+field through the collector."""
+
+import json
+from datetime import datetime
+from .config import COLLECT_TWEET_ATTRS, RETWEET_ATTRS
+from .db.projection import compile_projector, project_user_attrs
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# status keys kept by project_status; nested statuses and the user are
+# projected recursively
+STATUS_ATTRS = sorted(set(COLLECT_TWEET_ATTRS + RETWEET_ATTRS))
+NESTED_STATUS_KEYS = ("retweeted_status", "quoted_status")
+
+project_status_attrs = compile_projector("project_status_attrs",
+                                         STATUS_ATTRS, skip_none=False)
+
+
+def loads(content):
+    """parse a json document from bytes or str"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"{type(obj).__name__} is not json serializable")
+
+
+def dumps(obj):
+    """serialize to compact json bytes; datetimes become iso strings"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(obj, default=_default,
+                      separators=(",", ":")).encode()
+
+
+def project_status(status):
+    """copy of a status holding only the attributes that are stored"""
+    projected = project_status_attrs(status)
+    projected["user"] = project_user_attrs(status["user"])
+    for key in NESTED_STATUS_KEYS:
+        if key in status:
+            projected[key] = project_status(status[key])
+    return projected
+
+
+def decode_search(content, project=False):
+    """Parse a search/tweets.json body once.
+
+    Args:
+        content: response body (bytes or str)
+        project: reduce each status with project_status
+
+    Returns:
+        (statuses, search_metadata)
+    """
+    body = loads(content)
+    statuses = body["statuses"]
+    if project:
+        statuses = [project_status(status) for status in statuses]
+    return statuses, body.get("search_metadata", {})
@@ -0,0 +1,185 @@
+"""Seen tweet id filter.
+
+A bloom filter over the ids of stored tweets and retweets lets the collector
+drop statuses it already has before normalizing or writing them. A bloom
+filter can report an id it never saw, so positives are confirmed with the
+database (one lookup per page) before a status is skipped; negatives are
+certain and cost nothing."""
+
+import os
+import math
+import struct
+import threading
+
+# file header: capacity, error rate, bits, hashes, ids added
+HEADER = struct.Struct("<QdQQQ")
+MASK_64 = (1 << 64) - 1
+
+
+def _mix64(value):
+    """splitmix64 finalizer"""
+    value = (value + 0x9E3779B97F4A7C15) & MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return value ^ (value >> 31)
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.num_bits = max(int(-self.capacity * math.log(error_rate) /
+                                math.log(2) ** 2), 8)
+        self.num_hashes = max(int(round(self.num_bits / self.capacity *
+                                        math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, value):
+        # double hashing: h1 + i * h2
+        h1 = _mix64(value & MASK_64)
+        h2 = _mix64(h1) | 1
+        return [(h1 + i * h2) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, value):
+        for pos in self.positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self.positions(value))
+
+    def save(self, path):
+        """write atomically to path"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(HEADER.pack(self.capacity, self.error_rate,
+                                 self.num_bits, self.num_hashes, self.count))
+            fp.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fp:
+            capacity, error_rate, num_bits, num_hashes, count = \
+                HEADER.unpack(fp.read(HEADER.size))
+            bloom = cls.__new__(cls)
+            bloom.capacity = capacity
+            bloom.error_rate = error_rate
+            bloom.num_bits = num_bits
+            bloom.num_hashes = num_hashes
+            bloom.count = count
+            bloom.bits = bytearray(fp.read())
+        if len(bloom.bits) != (num_bits + 7) // 8:
+            raise ValueError(f"corrupt bloom filter file {path}")
+        return bloom
+
+
+class SeenIds(object):
+    """Thread safe seen id filter backed by a db module.
+
+    Args:
+        db: DbInterface used to warm load the filter (iter_tweet_ids) and
+            to confirm positives (get_stored_tweet_ids)
+        path: file the filter is loaded from and saved to (optional)
+        min_capacity: smallest number of ids the filter is sized for; it
+            is sized for twice the stored ids when built from the db, and
+            rebuilt when a loaded or saved filter holds more ids than its
+            capacity
+    """
+
+    def __init__(self, db, path=None, error_rate=0.001,
+                 min_capacity=1000000):
+        self.db = db
+        self.path = path
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+        self.bloom = None
+        if path and os.path.exists(path):
+            self.bloom = BloomFilter.load(path)
+        if self.bloom is None or self.overfull():
+            self.bloom = self.build()
+
+    def build(self):
+        """a filter of the stored ids, sized for twice their number"""
+        capacity = max(2 * self.db.estimate_tweet_count(), self.min_capacity)
+        bloom = BloomFilter(capacity, self.error_rate)
+        for tweet_id in self.db.iter_tweet_ids():
+            bloom.add(tweet_id)
+        return bloom
+
+    def overfull(self):
+        """past capacity the false positive rate climbs towards 1 and every
+        page needs a db lookup"""
+        capacity = self.bloom.capacity
+        return self.bloom.count > capacity or \
+            self.db.estimate_tweet_count() > capacity
+
+    def stored(self, ids):
+        """the subset of ids that are already stored"""
+        with self.lock:
+            maybe = [tweet_id for tweet_id in ids if tweet_id in self.bloom]
+        if not maybe:
+            return set()
+        return set(self.db.get_stored_tweet_ids(maybe))
+
+    def add(self, ids):
+        with self.lock:
+            for tweet_id in ids:
+                self.bloom.add(tweet_id)
+
+    def filter_statuses(self, statuses):
+        """Drop the api statuses of a page that are already stored, before
+        they are flattened. Their nested originals are looked up in the
+        same query. Returns the statuses left and the stored ids, for
+        filter_page."""
+        ids = []
+        stack = list(statuses)
+        while stack:
+            status = stack.pop()
+            ids.append(status["id"])
+            stack.extend(status[key]
+                         for key in ("retweeted_status", "quoted_status")
+                         if key in status)
+        stored = self.stored(ids)
+        if not stored:
+            return statuses, stored
+
+        left = [status for status in statuses if status["id"] not in stored]
+        with self.lock:
+            self.skipped += len(statuses) - len(left)
+        return left, stored
+
+    def filter_page(self, page_tweets, page_retweets, stored=None):
+        """drop the (status, user) tuples whose status is already stored;
+        stored is the result of filter_statuses, or looked up"""
+        if stored is None:
+            stored = self.stored(
+                [tweet["id"] for tweet, _ in page_tweets] +
+                [retweet["id"] for retweet, _ in page_retweets])
+        if not stored:
+            return page_tweets, page_retweets
+
+        left = ([(tweet, user) for tweet, user in page_tweets
+                 if tweet["id"] not in stored],
+                [(retweet, user) for retweet, user in page_retweets
+                 if retweet["id"] not in stored])
+        with self.lock:
+            self.skipped += len(page_tweets) + len(page_retweets) - \
+                len(left[0]) - len(left[1])
+        return left
+
+    def save(self):
+        if self.path:
+            if self.overfull():
+                bloom = self.build()
+                with self.lock:
+                    self.bloom = bloom
+            with self.lock:
+                self.bloom.save(self.path)
@@ -0,0 +1,235 @@
+"""Export of the collected tweets.
+
+Tweets are read with DbInterface.iter_tweet_batches, joined with their user
+and place, and written to gzip compressed json lines or Parquet files in an
+export directory. The id range to export is split into shards of equal id
+span (equal tweet time, ids being snowflakes) read by parallel processes,
+each with its own database connection, into one file per shard:
+
+    {directory}/tweets-{low id}-{high id}.jsonl.gz
+    {directory}/watermark.json
+
+The watermark is the newest tweet id exported. It is saved once every shard
+is written, and the next export starts above it. Exports stop below the
+oldest unfinished id range of the collector state, whose tweets may still
+arrive, so an incremental export does not miss them. Retweeted and quoted
+originals are stored with their own, older ids, and those stored after an
+export below its watermark are only exported by a full export (since_id 0).
+Retweets are not exported: only their retweeted originals are, with
+is_retweeted set. Shard files above the watermark are left by an export
+that did not finish and are replaced."""
+
+import os
+import re
+import gzip
+import json
+import logging
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from .db.DbInterface import DbInterface, READ_BATCH_SIZE
+from .decode import dumps
+
+WATERMARK_FILE = "watermark.json"
+SHARD_FILE = re.compile(r"tweets-(\d+)-(\d+)\.")
+
+FORMATS = {"jsonl": ".jsonl.gz", "parquet": ".parquet"}
+
+# Parquet column types; dicts and lists are stored as json strings
+PARQUET_COLUMNS = {
+    "id": "int64",
+    "created_at": "string",
+    "timestamp": "timestamp",
+    "full_text": "string",
+    "user_id": "int64",
+    "place_id": "string",
+    "coordinates": "json",
+    "in_reply_to_id": "int64",
+    "in_reply_to_status_id": "int64",
+    "quoted_id": "int64",
+    "is_retweeted": "bool",
+    "is_quoted": "bool",
+    "user": "json",
+    "place": "json",
+}
+
+
+# DbInterface read methods a module needs to be exported
+READ_METHODS = ("read_tweets", "get_users", "get_places")
+
+
+def exportable(backend):
+    """whether the DbInterface class implements the read methods"""
+    return all(getattr(backend, name) is not getattr(DbInterface, name)
+               for name in READ_METHODS)
+
+
+def shard_ranges(min_id, max_id, shards):
+    """split the ids (min_id, max_id] into up to shards (low, high] ranges
+    of equal span"""
+    span = max(-(-(max_id - min_id) // shards), 1)
+    return [(low, min(low + span, max_id))
+            for low in range(min_id, max_id, span)]
+
+
+def export_max_id(db, queries=(None,)):
+    """Newest tweet id that can be exported: the newest stored id, or the
+    since_id of the oldest unfinished range of the queries when it is
+    lower"""
+    max_id = db.get_max_tweet_id()
+    for query in queries:
+        for next_max_id, since_id in db.load_collector_state(query=query):
+            max_id = min(max_id, since_id)
+    return max_id
+
+
+def load_watermark(directory):
+    try:
+        with open(os.path.join(directory, WATERMARK_FILE), "r") as fp:
+            return json.load(fp)["max_id"]
+    except FileNotFoundError:
+        return 0
+
+
+def save_watermark(directory, max_id):
+    path = os.path.join(directory, WATERMARK_FILE)
+    with open(path + ".tmp", "w") as fp:
+        json.dump({"max_id": max_id,
+                   "timestamp": datetime.now().timestamp()}, fp)
+    os.replace(path + ".tmp", path)
+
+
+def remove_unfinished(directory, watermark):
+    """remove shard files an unfinished export left above the watermark"""
+    for name in os.listdir(directory):
+        match = SHARD_FILE.match(name)
+        if match and int(match.group(1)) >= watermark:
+            os.remove(os.path.join(directory, name))
+
+
+class JsonLinesWriter(object):
+    def __init__(self, path):
+        self.fp = gzip.open(path, "wb")
+
+    def write(self, tweets):
+        self.fp.write(b"".join(dumps(tweet) + b"\n" for tweet in tweets))
+
+    def close(self):
+        self.fp.close()
+
+
+def _parquet_value(kind, value):
+    if value is None:
+        return None
+    if kind == "json":
+        return dumps(value).decode()
+    if kind == "timestamp" and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+class ParquetWriter(object):
+    """one row group per batch, with the PARQUET_COLUMNS schema"""
+
+    def __init__(self, path):
+        # pyarrow is an optional dependency
+        import pyarrow
+        import pyarrow.parquet
+        types = {"int64": pyarrow.int64(), "string": pyarrow.string(),
+                 "json": pyarrow.string(), "bool": pyarrow.bool_(),
+                 "timestamp": pyarrow.timestamp("ms", tz="UTC")}
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind
+                                      in PARQUET_COLUMNS.items()])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema,
+                                                    compression="zstd")
+
+    def write(self, tweets):
+        columns = {name: [_parquet_value(kind, tweet.get(name))
+                          for tweet in tweets]
+                   for name, kind in PARQUET_COLUMNS.items()}
+        self.writer.write_table(
+            self.pyarrow.table(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {"jsonl": JsonLinesWriter, "parquet": ParquetWriter}
+
+
+def shard_path(directory, low, high, fmt):
+    return os.path.join(directory, f"tweets-{low}-{high}{FORMATS[fmt]}")
+
+
+def export_shard(db_factory, directory, low, high, fmt="jsonl",
+                 batch_size=READ_BATCH_SIZE):
+    """Write the tweets with ids in (low, high] to one shard file, renamed
+    into place once complete. Returns the number of tweets written."""
+    db = db_factory()
+    path = shard_path(directory, low, high, fmt)
+    writer = WRITERS[fmt](path + ".tmp")
+    num_tweets = 0
+    try:
+        for tweets in db.iter_tweet_batches(low, high, batch_size):
+            writer.write(tweets)
+            num_tweets += len(tweets)
+    finally:
+        writer.close()
+        db.close()
+    os.replace(path + ".tmp", path)
+    return num_tweets
+
+
+def export(db_factory, directory, shards=4, fmt="jsonl",
+           batch_size=READ_BATCH_SIZE, since_id=None, queries=(None,),
+           logger=None):
+    """Export the tweets above since_id, or the saved watermark, to
+    directory, reading shards id ranges in parallel processes.
+
+    Args:
+        db_factory: picklable callable returning a new DbInterface, called
+            once here and once per shard
+        queries: queries whose unfinished ranges bound the export (see
+            export_max_id)
+
+    Returns:
+        number of tweets exported
+    """
+    logger = logger or logging.getLogger(__name__)
+    os.makedirs(directory, exist_ok=True)
+    watermark = load_watermark(directory)
+    remove_unfinished(directory, watermark)
+    if since_id is None:
+        since_id = watermark
+
+    # closed before forking: pymongo clients are not fork safe
+    db = db_factory()
+    try:
+        max_id = export_max_id(db, queries)
+        # no empty shards below the oldest stored tweet
+        min_id = max(since_id, db.get_min_tweet_id() - 1)
+    finally:
+        db.close()
+    if max_id <= min_id:
+        logger.log(logging.INFO, f"No tweets to export above {since_id}")
+        return 0
+
+    ranges = shard_ranges(min_id, max_id, shards)
+    logger.log(logging.INFO, f"Exporting tweets {min_id}-{max_id} in "
+                             f"{len(ranges)} shards to {directory}")
+    if len(ranges) == 1:
+        num_tweets = export_shard(db_factory, directory, *ranges[0],
+                                  fmt=fmt, batch_size=batch_size)
+    else:
+        with ProcessPoolExecutor(
+                len(ranges),
+                mp_context=multiprocessing.get_context("fork")) as pool:
+            futures = [pool.submit(export_shard, db_factory, directory,
+                                   low, high, fmt, batch_size)
+                       for low, high in ranges]
+            num_tweets = sum(future.result() for future in futures)
+
+    save_watermark(directory, max(max_id, watermark))
+    logger.log(logging.INFO, f"Exported {num_tweets} tweets")
+    return num_tweets
@@ -0,0 +1,360 @@
+"""Counters, gauges and latency histograms of the collector.
+
+The metrics live in one process wide Registry, REGISTRY, and are updated by
+the collector stages (http, decode, normalize, write), the mongo module, the
+token pool and the write queue. They can be served in the Prometheus text
+format by a MetricsServer and logged periodically by a SummaryLogger.
+Nothing is exported unless one of them is started; updating a metric costs
+a lock and a dict update."""
+
+import time
+import bisect
+import logging
+import threading
+from functools import wraps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# seconds between summary log lines
+SUMMARY_INTERVAL = 300
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        # label tuple -> value
+        self.values = {}
+
+    def samples(self):
+        """(name suffix, label tuple, value) tuples to export"""
+        with self.lock:
+            return [("", labels, value)
+                    for labels, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} "
+                         f"{_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(_labels(labels), 0)
+
+
+class Gauge(Metric):
+    """A gauge is set, or read from a function returning the value, or a
+    dict of {label dict as a tuple of pairs: value}, when exported."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self.function = None
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_labels(labels)] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        value = self.function()
+        if isinstance(value, dict):
+            return [("", labels, val) for labels, val in value.items()]
+        return [("", (), value)]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def labels(self, **labels):
+        """the series of the labels, to observe without building the label
+        key on every call"""
+        key = _labels(labels)
+        with self.lock:
+            if key not in self.values:
+                # one count per bucket and +Inf, then the sum
+                self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            return HistogramSeries(self, self.values[key])
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+    def time(self, **labels):
+        return self.labels(**labels).time()
+
+    def count(self, **labels):
+        with self.lock:
+            counts = self.values.get(_labels(labels))
+            return sum(counts[:-1]) if counts else 0
+
+    def quantile(self, q, counts):
+        """upper bound of the bucket holding the q quantile"""
+        rank = q * sum(counts[:-1])
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        with self.lock:
+            values = {labels: list(counts)
+                      for labels, counts in self.values.items()}
+        samples = []
+        for labels, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append(("_bucket",
+                                labels + (("le", bound),), cumulative))
+            samples.append(("_sum", labels, counts[-1]))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+
+class HistogramSeries(object):
+    __slots__ = ("buckets", "lock", "counts")
+
+    def __init__(self, histogram, counts):
+        self.buckets = histogram.buckets
+        self.lock = histogram.lock
+        self.counts = counts
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.counts[-1] += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer(object):
+    __slots__ = ("series", "start")
+
+    def __init__(self, series):
+        self.series = series
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.series.observe(time.perf_counter() - self.start)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric_class, name, help, **kwargs):
+        """the metric called name, created on first use"""
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, help, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self.register(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self.register(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram, name, help, buckets=buckets)
+
+    def render(self):
+        """all metrics in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+    def summary(self):
+        """one line: counters and gauges, and the count, mean and p99
+        bucket of each histogram series observed at least once"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        parts = []
+        for metric in metrics:
+            short = metric.name.replace("tweet_collector_", "")
+            if isinstance(metric, Histogram):
+                with metric.lock:
+                    values = {labels: list(counts) for labels, counts
+                              in metric.values.items()}
+                for labels, counts in sorted(values.items()):
+                    count = sum(counts[:-1])
+                    # series created ahead, like those of @timed
+                    if not count:
+                        continue
+                    parts.append(
+                        f"{short}{_format_labels(labels)} n={count} "
+                        f"mean={counts[-1] / count * 1000:.1f}ms "
+                        f"p99<={metric.quantile(0.99, counts) * 1000:g}ms")
+            else:
+                for _, labels, value in metric.samples():
+                    parts.append(f"{short}{_format_labels(labels)}="
+                                 f"{value:g}")
+        return " ".join(parts)
+
+
+def timed(histogram, **labels):
+    """decorator observing the seconds each call takes"""
+    series = histogram.labels(**labels)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                series.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class MetricsServer(object):
+    """Serves a registry at /metrics from a daemon thread"""
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                payload = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                return
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class SummaryLogger(object):
+    """Logs registry.summary() every interval seconds from a daemon
+    thread"""
+
+    def __init__(self, registry, logger, interval=SUMMARY_INTERVAL):
+        self.registry = registry
+        self.logger = logger
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                summary = self.registry.summary()
+            except Exception as e:
+                # a broken metric must not stop the summaries
+                self.logger.log(logging.ERROR, f"Metrics summary failed: {e}")
+                continue
+            if summary:
+                self.logger.log(logging.INFO, f"Metrics: {summary}")
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "tweet_collector_stage_seconds",
+    "Seconds per page spent in each collector stage (http, decode, "
+    "normalize, write)")
+GET_TWEETS_SECONDS = REGISTRY.histogram(
+    "tweet_collector_get_tweets_seconds",
+    "Seconds per get_tweets call: request, decode and queueing the page")
+STATUSES_WRITTEN = REGISTRY.counter(
+    "tweet_collector_statuses_written_total",
+    "Tweets and retweets written to the database")
+DB_WRITE_SECONDS = REGISTRY.histogram(
+    "tweet_collector_db_write_seconds",
+    "Seconds per mongo write by operation")
+DUPLICATE_KEYS = REGISTRY.counter(
+    "tweet_collector_duplicate_keys_total",
+    "Writes ignored by mongo as duplicate keys, by collection")
+WRITE_QUEUE_DEPTH = REGISTRY.gauge(
+    "tweet_collector_write_queue_depth",
+    "Page writes in flight on the executor")
+TOKEN_LIMIT_REMAINING = REGISTRY.gauge(
+    "tweet_collector_token_limit_remaining",
+    "Search calls left in the current window, by token")
+TOKEN_SLEEP_SECONDS = REGISTRY.counter(
+    "tweet_collector_token_sleep_seconds_total",
+    "Seconds spent waiting for a token with calls left")
@@ -0,0 +1,176 @@
+"""Collection of several queries sharing one token budget.
+
+Every query gets a TweetCollector keeping its id ranges in the meta
+collection under the query. The collectors share the tokens through one
+TokenPool, the transport and the database module, and write through one
+WriteQueue, so the rate limits are fetched once and all writes go through
+one connection pool.
+
+Pages are scheduled by stride scheduling: each query advances by 1 / weight
+per page requested and the query furthest behind is served next, so over a
+run each query gets calls in proportion to its weight, priority times the
+expected tweets per page. The expected rate is a moving average of the
+page sizes and is kept in meta between runs; busy queries get more of the
+budget and quiet ones are still polled.
+
+With tail, every query is then polled on its own timer, set from its
+arrival rate (see tail.py) so each poll finds about a page of new tweets."""
+
+import time
+import heapq
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from tweet_collector.auth import DEFAULT_AUTH_FILE, get_tokens
+from tweet_collector.tokens import TokenPool
+from tweet_collector.pipeline import WriteQueue
+from tweet_collector.transport import get_transport
+from tweet_collector.tail import ArrivalRate
+from tweet_collector.tweet_collector import TweetCollector, API_URL, \
+    null_logger, get_rate_limits
+
+# expected tweets per page of a query with no history (a full page)
+DEFAULT_RATE = 100
+# added to the expected rate so quiet queries are still polled
+RATE_FLOOR = 1
+# weight of the newest page in the moving average of the rate
+RATE_ALPHA = 0.2
+
+
+def read_queries(query_file):
+    """Read a query file: one query per line, optionally followed by a tab
+    and a priority (default 1). Blank lines and lines starting with # are
+    skipped.
+
+    Returns:
+        list of (query, priority) tuples
+    """
+    queries = []
+    with open(query_file, "r") as fp:
+        for line in fp:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            query, _, priority = line.partition("\t")
+            queries.append((query.strip(), float(priority or 1)))
+    return queries
+
+
+class MultiQueryCollector(object):
+    """
+    Args:
+        queries: list of queries or (query, priority) tuples
+        collector_kwargs: passed on to every TweetCollector
+    """
+
+    def __init__(self, db_obj, queries, auth_file=DEFAULT_AUTH_FILE,
+                 logger=null_logger, api_url=API_URL, transport=None,
+                 write_queue_depth=8, tail=False, **collector_kwargs):
+        self.db = db_obj
+        self.logger = logger
+        self.tail = tail
+        self.queries = [(query, 1) if isinstance(query, str) else query
+                        for query in queries]
+
+        tokens = get_tokens(auth_file=auth_file)
+        if not tokens:
+            raise ValueError("twitter api tokens not set. Use cli tool "
+                             "to set tokens")
+        transport = transport or get_transport()
+        self.token_pool = TokenPool(partial(get_rate_limits, tokens,
+                                            transport, api_url))
+        self.executor = ThreadPoolExecutor()
+        self.write_queue = WriteQueue(self.executor, write_queue_depth,
+                                      logger)
+
+        states = [db_obj.load_query_state(query)
+                  for query, _ in self.queries]
+        self.collectors = [
+            TweetCollector(db_obj, query, auth_file=auth_file, logger=logger,
+                           api_url=api_url, transport=transport,
+                           tokens=tokens, token_pool=self.token_pool,
+                           write_queue=self.write_queue, track_query=True,
+                           arrival_rate=ArrivalRate(
+                               rate=state.get("arrival_rate")),
+                           **collector_kwargs)
+            for (query, _), state in zip(self.queries, states)]
+        self.rates = [state.get("rate", DEFAULT_RATE) for state in states]
+
+    def weight(self, idx):
+        return self.queries[idx][1] * (self.rates[idx] + RATE_FLOOR)
+
+    def save_query_state(self, idx):
+        query = self.queries[idx][0]
+        state = self.db.load_query_state(query)
+        state["rate"] = self.rates[idx]
+        state["arrival_rate"] = self.collectors[idx].arrival_rate.rate
+        state["max_id"] = max(state.get("max_id", 0),
+                              self.collectors[idx].newest_id)
+        self.db.save_query_state(query, state)
+
+    def start_collector(self):
+        """collect every query until its most recent range is done, then
+        keep polling them with tail"""
+        self.collect_ranges()
+        if self.tail:
+            self.poll()
+
+    def collect_ranges(self):
+        pages = [collector.iter_pages() for collector in self.collectors]
+        # (pass, query index); ties go to the earlier query
+        schedule = [(0.0, idx) for idx in range(len(pages))]
+        heapq.heapify(schedule)
+        finished = set()
+        try:
+            while schedule:
+                pass_value, idx = heapq.heappop(schedule)
+                try:
+                    num_tweets = next(pages[idx])
+                except StopIteration:
+                    finished.add(idx)
+                    self.save_query_state(idx)
+                    self.logger.log(logging.INFO,
+                                    f"Finished query {self.queries[idx][0]}")
+                    continue
+
+                self.rates[idx] += RATE_ALPHA * (num_tweets - self.rates[idx])
+                heapq.heappush(schedule,
+                               (pass_value + 1 / self.weight(idx), idx))
+        finally:
+            # closing a collector saves the state of its current range.
+            # The queries share the write queue, so after a failed write
+            # no query knows its pages are stored and none saves its state
+            for idx in range(len(pages)):
+                if idx not in finished:
+                    pages[idx].close()
+                    if not self.write_queue.failed:
+                        self.save_query_state(idx)
+            self.write_queue.drain()
+            if not self.tail:
+                self.executor.shutdown(wait=True)
+
+    def poll(self):
+        """run tail passes, each query when its next page should be full"""
+        now = time.monotonic()
+        polls = [(now + collector.arrival_rate.next_interval(), idx)
+                 for idx, collector in enumerate(self.collectors)]
+        heapq.heapify(polls)
+        tail_pass = None
+        try:
+            while True:
+                poll_at, idx = heapq.heappop(polls)
+                time.sleep(max(poll_at - time.monotonic(), 0))
+                collector = self.collectors[idx]
+                tail_pass = collector.tail_pass()
+                for _ in tail_pass:
+                    pass
+                self.save_query_state(idx)
+                heapq.heappush(polls, (time.monotonic() +
+                                       collector.arrival_rate.next_interval(),
+                                       idx))
+        finally:
+            # closing an interrupted pass saves the state of its range
+            if tail_pass:
+                tail_pass.close()
+            self.write_queue.drain()
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,276 @@
+"""Staged page pipeline for the threaded collector.
+
+The fetching thread requests a page, decodes it and derives the next max_id
+straight away, then hands the statuses to the pipeline and sends the next
+request. Normalizing (flattening a page into tweets and retweets) and
+writing run in their own threads, linked by bounded queues. When the
+database falls behind the queues fill up and put() blocks the fetcher,
+which is the backpressure.
+
+Fetching and decoding stay in one stage: the next request needs the
+max_id of the decoded page, so they cannot overlap.
+
+Without the pipeline, pages are written on the collector's executor through
+a WriteQueue, which bounds the writes in flight the same way."""
+
+import queue
+import logging
+import threading
+from concurrent.futures import Future, wait
+
+# marks the end of the stream on a queue
+_STOP = object()
+
+
+class PagePipeline(object):
+    """
+    Args:
+        normalize: callable(statuses) -> page passed to write
+        write: callable(page) run by the writer threads
+        depth: maximum pages waiting in each queue
+        writers: number of writer threads
+    """
+
+    def __init__(self, normalize, write, depth=4, writers=2, logger=None):
+        self.normalize = normalize
+        self.write = write
+        self.writers = writers
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.normalize_queue = queue.Queue(maxsize=depth)
+        self.write_queue = queue.Queue(maxsize=depth)
+        self.errors = []
+        self.threads = []
+
+        # pages are numbered as they are put; written is the number of
+        # pages written in order, done holds those written ahead of it
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.written = 0
+        self.done = set()
+        # (pages queued, fn, args) waiting for after_pending
+        self.callbacks = []
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.run_normalize,
+                                         daemon=True)]
+        self.threads += [threading.Thread(target=self.run_write, daemon=True)
+                         for _ in range(self.writers)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def put(self, statuses):
+        """queue a decoded page, blocking while the pipeline is full"""
+        if self.errors:
+            raise self.errors[0]
+        with self.lock:
+            seq = self.queued
+            self.queued += 1
+        self.normalize_queue.put((seq, statuses))
+
+    def after_pending(self, fn, *args):
+        """Call fn(*args) once the pages put so far are written, from the
+        writer thread finishing the last of them. It is not called once a
+        page failed; an error raised by fn is raised like a stage error."""
+        with self.lock:
+            if self.written < self.queued:
+                self.callbacks.append((self.queued, fn, args))
+                return
+        self.call(fn, args)
+
+    def call(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            self.fail(e)
+
+    def page_done(self, seq):
+        with self.lock:
+            self.done.add(seq)
+            while self.written in self.done:
+                self.done.remove(self.written)
+                self.written += 1
+            due = [callback for callback in self.callbacks
+                   if callback[0] <= self.written]
+            self.callbacks = [callback for callback in self.callbacks
+                              if callback[0] > self.written]
+        for _, fn, args in due:
+            self.call(fn, args)
+
+    def run_normalize(self):
+        while True:
+            item = self.normalize_queue.get()
+            if item is _STOP:
+                break
+            seq, statuses = item
+            try:
+                self.write_queue.put((seq, self.normalize(statuses)))
+            except Exception as e:
+                self.fail(e)
+        for _ in range(self.writers):
+            self.write_queue.put(_STOP)
+
+    def run_write(self):
+        while True:
+            item = self.write_queue.get()
+            if item is _STOP:
+                break
+            seq, page = item
+            try:
+                self.write(page)
+            except Exception as e:
+                self.fail(e)
+                continue
+            self.page_done(seq)
+
+    def fail(self, e):
+        self.logger.log(logging.ERROR, e)
+        self.errors.append(e)
+
+    def close(self):
+        """wait for every queued page to be written. Raises the first error
+        raised by a stage."""
+        self.normalize_queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, trace):
+        self.close()
+
+
+class WriteQueue(object):
+    """Bounded set of writes running on an executor.
+
+    submit() blocks while depth writes are in flight, which throttles the
+    fetching thread when the database falls behind. Writes are released as
+    soon as they finish. The first error raised by a write is raised by the
+    next submit() or drain(). Every error is also kept in failed, which the
+    owners of the writes compare to tell whether any of theirs failed,
+    whichever call raised it.
+    """
+
+    def __init__(self, executor, depth=8, logger=None):
+        self.executor = executor
+        self.depth = depth
+        self.logger = logger or logging.getLogger(__name__)
+        self.slots = threading.BoundedSemaphore(depth)
+        self.pending = set()
+        # futures of the after_pending calls not made yet
+        self.callbacks = set()
+        self.errors = []
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        self.raise_errors()
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.release)
+        return future
+
+    def release(self, future):
+        # recorded before the write leaves pending, for after_pending
+        error = future.exception()
+        if error:
+            self.fail(error)
+        with self.lock:
+            self.pending.discard(future)
+        self.slots.release()
+
+    def fail(self, error):
+        self.logger.log(logging.ERROR, error)
+        with self.lock:
+            self.errors.append(error)
+            self.failed.append(error)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def after_pending(self, fn, *args):
+        """Call fn(*args) once the writes in flight now are done, from the
+        thread finishing the last of them, without waiting for it. fn is
+        not called once any write of the queue failed; an error raised by
+        fn is raised like a write error. drain() waits for the call."""
+        called = Future()
+        with self.lock:
+            pending = list(self.pending)
+            self.callbacks.add(called)
+        remaining = [len(pending)]
+        failed = []
+        lock = threading.Lock()
+
+        def call():
+            try:
+                if not failed and not self.failed:
+                    fn(*args)
+            except Exception as e:
+                self.fail(e)
+            finally:
+                with self.lock:
+                    self.callbacks.discard(called)
+                called.set_result(None)
+
+        def finished(future):
+            with lock:
+                if future.exception():
+                    failed.append(future)
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                call()
+
+        if not pending:
+            call()
+        for future in pending:
+            future.add_done_callback(finished)
+
+    def drain(self):
+        """wait for the writes in flight and their after_pending calls"""
+        with self.lock:
+            pending = list(self.pending) + list(self.callbacks)
+        wait(pending)
+        self.raise_errors()
+
+    def raise_errors(self):
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+
+class WriteStats(object):
+    """Counters of the page writes (flushes) made to the database"""
+
+    def __init__(self):
+        self.writes = 0
+        self.statuses = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, statuses, seconds):
+        with self.lock:
+            self.writes += 1
+            self.statuses += statuses
+            self.seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def __str__(self):
+        with self.lock:
+            avg_ms = self.seconds / self.writes * 1000 if self.writes else 0
+            return (f"{self.writes} writes of {self.statuses} statuses, "
+                    f"avg {avg_ms:.1f} ms, max "
+                    f"{self.max_seconds * 1000:.1f} ms")
@@ -0,0 +1,91 @@
+"""Opt-in sampling profiler for a running collector.
+
+While it runs, a background thread samples the stack of every other thread
+every interval seconds. Each stop writes the sample counts in collapsed
+stack format ("outer;inner count" per line), which flamegraph.pl and
+speedscope read. install_profiler_signal lets a signal (SIGUSR2 by
+default) start and stop the profiler on a running daemon:
+
+    kill -USR2 <pid>    # start sampling
+    kill -USR2 <pid>    # stop and write {path}.{unix time}"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+from collections import Counter
+
+DEFAULT_INTERVAL = 0.005
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:" \
+           f"{code.co_firstlineno})"
+
+
+class SamplingProfiler(object):
+    def __init__(self, path, interval=DEFAULT_INTERVAL, logger=None):
+        self.path = path
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.counts = Counter()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        self.counts = Counter()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="sampling-profiler")
+        self.thread.start()
+        self.logger.log(logging.INFO, "Profiler started")
+
+    def stop(self):
+        """stop sampling and write the samples; returns the file written"""
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        path = f"{self.path}.{int(time.time())}"
+        self.write(path)
+        self.logger.log(logging.INFO, f"Profiler wrote "
+                                      f"{sum(self.counts.values())} "
+                                      f"samples to {path}")
+        return path
+
+    def toggle(self, signum=None, frame=None):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                self.counts[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as fp:
+            for stack, count in self.counts.most_common():
+                fp.write(f"{stack} {count}\n")
+
+
+def install_profiler_signal(path, signum=signal.SIGUSR2,
+                            interval=DEFAULT_INTERVAL, logger=None):
+    """toggle a SamplingProfiler writing to path.* on signum"""
+    profiler = SamplingProfiler(path, interval, logger)
+    signal.signal(signum, profiler.toggle)
+    return profiler
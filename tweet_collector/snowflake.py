@@ -0,0 +1,67 @@
+"""Conversions between tweet ids and time.
+
+Tweet ids are snowflakes: the bits above the lowest 22 hold the creation
+time in ms since TWITTER_EPOCH_MS. The timestamp of a status can be read
+from its id without parsing created_at, and time windows can be turned
+into since_id / max_id bounds for the search api."""
+
+from datetime import datetime, timezone
+from .config import created_at_to_ts
+
+TWITTER_EPOCH_MS = 1288834974657
+TIMESTAMP_SHIFT = 22
+
+# ids from before snowflakes (Nov 2010) were sequential and stayed far below
+# this; every snowflake id is above it
+SNOWFLAKE_MIN_ID = 10 ** 15
+
+
+def is_snowflake(tweet_id):
+    return tweet_id >= SNOWFLAKE_MIN_ID
+
+
+def id_to_ms(tweet_id):
+    """unix time in ms the id was created"""
+    return (tweet_id >> TIMESTAMP_SHIFT) + TWITTER_EPOCH_MS
+
+
+def id_to_datetime(tweet_id):
+    """utc datetime the id was created, with ms precision"""
+    return datetime.fromtimestamp(id_to_ms(tweet_id) / 1000, timezone.utc)
+
+
+def ms_to_id(ms):
+    """smallest id that can be created at unix time ms"""
+    return max(int(ms) - TWITTER_EPOCH_MS, 0) << TIMESTAMP_SHIFT
+
+
+def datetime_to_id(dt):
+    """smallest id that can be created at dt (naive datetimes are utc)"""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return ms_to_id(dt.timestamp() * 1000)
+
+
+def ms_to_id_span(ms):
+    """number of ids covering ms milliseconds"""
+    return int(ms) << TIMESTAMP_SHIFT
+
+
+def time_window_to_ids(since=None, until=None):
+    """Turn a [since, until) datetime window into search api bounds.
+
+    Returns:
+        (since_id, max_id) where since_id is exclusive and max_id inclusive.
+        Open ends are None.
+    """
+    since_id = datetime_to_id(since) - 1 if since else None
+    max_id = datetime_to_id(until) - 1 if until else None
+    return since_id, max_id
+
+
+def status_timestamp(status):
+    """timestamp of a status from its snowflake id, parsing created_at
+    only for pre-snowflake ids"""
+    if is_snowflake(status["id"]):
+        return id_to_datetime(status["id"])
+    return created_at_to_ts(status["created_at"])
@@ -0,0 +1,358 @@
+"""Write-ahead spool between the collector and its database module.
+
+SpoolDb wraps a DbInterface. Pages and collector state are appended in order
+to a segmented log on local disk and the call returns, so fetching never
+waits on the database. A drainer thread replays the log into the wrapped
+module: consecutive pages are merged into one insert_tweets_batch call, and
+each state entry is applied once the pages before it are written, so the
+saved state never runs ahead of the stored tweets. When the database is
+unavailable the drainer retries with backoff while collection continues.
+
+The drained position is saved after every batch. Replaying an entry twice
+after a crash is harmless: the database modules ignore duplicate tweets and
+retweets (mongo upserts retweets on id, its retweet id index not being
+unique), only replace users by newer versions and upsert the collector
+state.
+
+Reads (get_max_tweet_id, load_collector_state, ...) go to the wrapped module
+and do not see entries still in the spool, so a range may be collected
+again after a restart; the duplicates are ignored on write. One drainer
+runs per spool directory at a time, guarded by a lock file."""
+
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from .db.DbInterface import DbInterface
+from .decode import dumps, loads
+
+LOG_SUFFIX = ".log"
+POSITION_FILE = "position.json"
+LOCK_FILE = "drain.lock"
+
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+# statuses per insert_tweets_batch call made by the drainer
+DRAIN_BATCH_STATUSES = 2000
+DRAIN_POLL_INTERVAL = 0.5
+DRAIN_BACKOFF_MAX = 60
+# seconds close() waits for the spool to drain
+DRAIN_TIMEOUT = 300
+
+
+class CorruptEntry(ValueError):
+    """A complete spool line that does not decode. position is the one
+    after it."""
+
+    def __init__(self, message, position):
+        super().__init__(message)
+        self.position = position
+
+
+class Spool(object):
+    """Segmented append-only log of json entries in a directory."""
+
+    def __init__(self, directory, max_segment_bytes=DEFAULT_SEGMENT_BYTES):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # always start a new segment; an old one may end in a partial line
+        self.seq = max(self.segments(), default=0) + 1
+        self.fp = self.open_segment(self.seq)
+
+    def path(self, seq):
+        return os.path.join(self.directory, f"{seq:08d}{LOG_SUFFIX}")
+
+    def segments(self):
+        return sorted(int(name[:-len(LOG_SUFFIX)])
+                      for name in os.listdir(self.directory)
+                      if name.endswith(LOG_SUFFIX))
+
+    def open_segment(self, seq):
+        """create a segment, syncing its directory entry"""
+        fp = open(self.path(seq), "ab")
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return fp
+
+    def close_segment(self):
+        """sync and close the open segment; call with the lock"""
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+
+    def append(self, entry, sync=False):
+        """Append an entry; with sync it is on disk when this returns,
+        together with every entry before it. Segments are synced when they
+        are rotated, so a synced entry never gets ahead of the pages
+        spooled before it."""
+        line = dumps(entry) + b"\n"
+        with self.lock:
+            if self.fp.tell() >= self.max_segment_bytes:
+                self.close_segment()
+                self.seq += 1
+                self.fp = self.open_segment(self.seq)
+            self.fp.write(line)
+            self.fp.flush()
+            if sync:
+                os.fsync(self.fp.fileno())
+
+    def close(self):
+        with self.lock:
+            self.close_segment()
+
+    def read(self, position, max_statuses=DRAIN_BATCH_STATUSES):
+        """Read complete entries from position, a (seq, offset) pair. The
+        entries before a line that does not decode are returned first; a
+        read starting at that line raises CorruptEntry.
+
+        Returns:
+            (entries, next position)
+        """
+        seq, offset = position
+        entries = []
+        statuses = 0
+        while statuses < max_statuses:
+            segments = [s for s in self.segments() if s >= seq]
+            if not segments:
+                break
+            if segments[0] != seq:
+                # the segment was drained and removed
+                seq, offset = segments[0], 0
+            with open(self.path(seq), "rb") as fp:
+                fp.seek(offset)
+                for line in fp:
+                    # the last line may still be being written
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entry = loads(line)
+                    except ValueError as e:
+                        if entries:
+                            return entries, (seq, offset)
+                        raise CorruptEntry(
+                            f"corrupt entry at {self.path(seq)}:{offset}: "
+                            f"{e}", (seq, offset + len(line)))
+                    entries.append(entry)
+                    offset += len(line)
+                    statuses += len(entry.get("tweets", ())) + \
+                        len(entry.get("retweets", ()))
+                    if statuses >= max_statuses:
+                        break
+            if statuses >= max_statuses or len(segments) == 1:
+                break
+            # the segment is complete once a newer one exists
+            seq, offset = segments[1], 0
+        return entries, (seq, offset)
+
+    def remove_before(self, seq):
+        """delete the segments drained completely"""
+        for old_seq in self.segments():
+            if old_seq < seq:
+                os.remove(self.path(old_seq))
+
+
+class SpoolDb(DbInterface):
+    """
+    Args:
+        db: the DbInterface pages are drained into
+        directory: spool directory
+        drain: run the drainer thread in this process
+    """
+
+    def __init__(self, db, directory, drain=True, logger=None,
+                 max_segment_bytes=DEFAULT_SEGMENT_BYTES):
+        self.db = db
+        self.directory = directory
+        self.logger = logger or logging.getLogger(__name__)
+        self.spool = Spool(directory, max_segment_bytes)
+        self.drainer = Drainer(db, self.spool, self.logger) if drain \
+            else None
+        if self.drainer:
+            self.drainer.start()
+
+    # writes go to the spool
+
+    def insert_tweet(self, tweet_attrs, user_attrs):
+        # validate before spooling so bad statuses fail in the collector
+        super().insert_tweet(tweet_attrs, user_attrs)
+        self.insert_tweets_batch([(tweet_attrs, user_attrs)], [])
+
+    def insert_retweet(self, retweet, user):
+        self.insert_tweets_batch([], [(retweet, user)])
+
+    def insert_tweets_batch(self, tweets, retweets):
+        if tweets or retweets:
+            self.spool.append({"op": "page", "tweets": tweets,
+                               "retweets": retweets})
+
+    def save_collector_state(self, next_max_id, since_id, done, query=None):
+        self.spool.append({"op": "state", "next_max_id": next_max_id,
+                           "since_id": since_id, "done": done,
+                           "query": query}, sync=True)
+
+    def save_query_state(self, query, state):
+        self.spool.append({"op": "query_state", "query": query,
+                           "state": state}, sync=True)
+
+    def flush(self):
+        """pages are on the spool once appended"""
+
+    def close(self, timeout=DRAIN_TIMEOUT):
+        """stop the drainer once the spool is drained, or after timeout
+        seconds, leaving the rest for the next drainer"""
+        if self.drainer:
+            self.drainer.stop(timeout)
+        self.spool.close()
+
+    # reads go to the database
+
+    def get_max_tweet_id(self):
+        return self.db.get_max_tweet_id()
+
+    def get_min_tweet_id(self):
+        return self.db.get_min_tweet_id()
+
+    def load_collector_state(self, query=None):
+        return self.db.load_collector_state(query=query)
+
+    def load_query_state(self, query):
+        return self.db.load_query_state(query)
+
+    def estimate_tweet_count(self):
+        return self.db.estimate_tweet_count()
+
+    def iter_tweet_ids(self):
+        return self.db.iter_tweet_ids()
+
+    def get_stored_tweet_ids(self, ids):
+        return self.db.get_stored_tweet_ids(ids)
+
+
+class Drainer(object):
+    """Replays a spool into a DbInterface from a background thread."""
+
+    def __init__(self, db, spool, logger=None):
+        self.db = db
+        self.spool = spool
+        self.logger = logger or logging.getLogger(__name__)
+        self.position_path = os.path.join(spool.directory, POSITION_FILE)
+        self.stopping = threading.Event()
+        self.deadline = None
+        self.thread = None
+        self.lock_fp = None
+        self.drained = 0
+
+    def load_position(self):
+        if os.path.exists(self.position_path):
+            with open(self.position_path, "r") as fp:
+                return tuple(json.load(fp))
+        return (min(self.spool.segments(), default=1), 0)
+
+    def save_position(self, position):
+        tmp_path = f"{self.position_path}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(list(position), fp)
+        os.replace(tmp_path, self.position_path)
+
+    def start(self):
+        self.lock_fp = open(os.path.join(self.spool.directory, LOCK_FILE),
+                            "w")
+        try:
+            fcntl.flock(self.lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_fp.close()
+            raise RuntimeError(f"another process drains "
+                               f"{self.spool.directory}")
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=DRAIN_TIMEOUT):
+        """Let the drainer finish the spool, for at most timeout seconds.
+        A write still running at the deadline is left to the daemon
+        thread; its entries are replayed by the next drainer."""
+        self.deadline = time.monotonic() + timeout
+        self.stopping.set()
+        self.thread.join(None if timeout == float("inf") else timeout)
+        if self.thread.is_alive():
+            self.logger.error(f"Spool not drained in {timeout} s")
+        self.lock_fp.close()
+
+    def past_deadline(self):
+        return self.stopping.is_set() and time.monotonic() >= self.deadline
+
+    def run(self):
+        position = self.load_position()
+        backoff = 1
+        while not self.past_deadline():
+            try:
+                entries, next_position = self.spool.read(position)
+                if not entries:
+                    if self.stopping.is_set():
+                        return
+                    time.sleep(DRAIN_POLL_INTERVAL)
+                    continue
+                self.apply(entries)
+            except CorruptEntry as e:
+                # retrying cannot decode the line, so it is skipped
+                self.logger.error(f"Skipping spool entry: {e}")
+                position = e.position
+                self.save_position(position)
+                continue
+            except Exception as e:
+                self.logger.warning(f"Drain failed, retrying in "
+                                    f"{backoff} s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, DRAIN_BACKOFF_MAX)
+                continue
+
+            backoff = 1
+            position = next_position
+            self.save_position(position)
+            self.spool.remove_before(position[0])
+        self.logger.error(f"Spool not drained, stopped at {position}")
+
+    def apply(self, entries):
+        """write consecutive pages as one batch, then each state entry"""
+        tweets = []
+        retweets = []
+        for entry in entries:
+            if entry["op"] == "page":
+                tweets += entry["tweets"]
+                retweets += entry["retweets"]
+                continue
+
+            self.write(tweets, retweets)
+            tweets, retweets = [], []
+            # the state is saved after its pages are written
+            self.db.flush()
+            if entry["op"] == "state":
+                self.db.save_collector_state(entry["next_max_id"],
+                                             entry["since_id"],
+                                             entry["done"],
+                                             query=entry["query"])
+            elif entry["op"] == "query_state":
+                self.db.save_query_state(entry["query"], entry["state"])
+        self.write(tweets, retweets)
+        self.db.flush()
+
+    def write(self, tweets, retweets):
+        if tweets or retweets:
+            self.db.insert_tweets_batch(tweets, retweets)
+            self.drained += len(tweets) + len(retweets)
+
+
+def drain(db, directory, logger=None):
+    """replay a spool into db until it is empty"""
+    spool = Spool(directory)
+    drainer = Drainer(db, spool, logger).start()
+    drainer.stop(timeout=float("inf"))
+    spool.close()
+    return drainer.drained
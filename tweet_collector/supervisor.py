@@ -0,0 +1,184 @@
+"""Multi process collection.
+
+One process decodes and normalizes pages under a single GIL. The supervisor
+closes the most recent id range at the current time, splits it and the
+unfinished ranges from the meta collection into sub ranges and records them
+in meta. The sub ranges and the api tokens are dealt out to worker
+processes, each running a TweetCollector over its share with its own
+database connection. Workers save their progress in meta as they go, so a
+crashed worker is restarted on the ranges meta says it has left."""
+
+import sys
+import time
+import signal
+import multiprocessing
+from multiprocessing.connection import wait
+from tweet_collector.auth import DEFAULT_AUTH_FILE, get_tokens
+from tweet_collector.snowflake import ms_to_id, time_window_to_ids
+from tweet_collector.tweet_collector import TweetCollector, null_logger, \
+    split_range, BACKFILL_SPLIT_MS, BACKFILL_MAX_SPLITS
+
+# the standard search api serves the last 7 days of tweets
+SEARCH_WINDOW_MS = 7 * 24 * 60 * 60 * 1000
+
+# seconds to wait before restarting a crashed worker
+RESTART_DELAY = 5
+
+
+def shard(items, num_shards):
+    """deal items round robin into num_shards lists"""
+    return [items[idx::num_shards] for idx in range(num_shards)]
+
+
+def run_worker(db_factory, q, tokens, collect_ids, logger, collector_kwargs):
+    """worker process entry point"""
+    collector = TweetCollector(db_factory(), q, logger=logger, tokens=tokens,
+                               collect_ids=collect_ids, **collector_kwargs)
+    collector.start_collector()
+
+
+class Supervisor(object):
+    """
+    Args:
+        db_factory: picklable callable returning a new DbInterface. Called
+            in the supervisor, which closes the database before forking,
+            and once in every worker process.
+        workers: number of worker processes, at most one per token
+        max_restarts: times a crashed worker is restarted
+        split_ms: ms of tweet time per sub range (see split_range)
+        collector_kwargs: passed on to every TweetCollector. A dedup_file
+            gets the worker number appended.
+    """
+
+    def __init__(self, db_factory, q, workers, auth_file=DEFAULT_AUTH_FILE,
+                 logger=null_logger, max_restarts=3,
+                 split_ms=BACKFILL_SPLIT_MS, since=None, until=None,
+                 **collector_kwargs):
+        self.db_factory = db_factory
+        self.q = q
+        self.logger = logger
+        self.max_restarts = max_restarts
+        self.split_ms = split_ms
+        self.since = since
+        self.until = until
+        self.collector_kwargs = collector_kwargs
+
+        tokens = get_tokens(auth_file=auth_file)
+        if not tokens:
+            raise ValueError("twitter api tokens not set. Use cli tool "
+                             "to set tokens")
+        self.workers = min(workers, len(tokens))
+        self.tokens = shard(tokens, self.workers)
+
+        # forked workers inherit the configured logger
+        self.context = multiprocessing.get_context("fork")
+        self.processes = {}
+        self.restarts = [0] * self.workers
+        self.since_ids = [set() for _ in range(self.workers)]
+
+    def plan(self, db):
+        """Split the ranges left to collect into sub ranges, record them in
+        meta and return them newest first"""
+        now_ms = time.time() * 1000
+        window_since_id, window_max_id = time_window_to_ids(self.since,
+                                                            self.until)
+        head_max_id = window_max_id or ms_to_id(now_ms)
+        ranges = sorted(db.load_merged_collector_state())
+        ranges.append([head_max_id,
+                       max(db.get_max_tweet_id(), window_since_id or 0,
+                           ms_to_id(now_ms - SEARCH_WINDOW_MS))])
+
+        sub_ranges = []
+        for next_max_id, since_id in ranges:
+            # open ended ranges left by single process runs end now
+            if next_max_id >= sys.maxsize:
+                next_max_id = head_max_id
+            for sub_max_id, sub_since_id in split_range(
+                    next_max_id, since_id, self.split_ms,
+                    BACKFILL_MAX_SPLITS):
+                db.save_collector_state(sub_max_id, sub_since_id, False)
+                sub_ranges.append([sub_max_id, sub_since_id])
+        return sorted(sub_ranges, reverse=True)
+
+    def start_worker(self, worker, collect_ids):
+        collector_kwargs = dict(self.collector_kwargs)
+        if collector_kwargs.get("dedup_file"):
+            collector_kwargs["dedup_file"] += f".{worker}"
+
+        process = self.context.Process(
+            target=run_worker, name=f"collector-{worker}",
+            args=(self.db_factory, self.q, self.tokens[worker], collect_ids,
+                  self.logger, collector_kwargs))
+        process.start()
+        self.processes[process.sentinel] = (worker, process)
+        self.logger.info(f"Started worker {worker} pid {process.pid} with "
+                         f"{len(collect_ids)} id ranges")
+
+    def remaining(self, worker):
+        """unfinished ranges of a worker according to meta"""
+        db = self.db_factory()
+        try:
+            return [[next_max_id, since_id]
+                    for next_max_id, since_id in db.load_collector_state()
+                    if since_id in self.since_ids[worker]]
+        finally:
+            db.close()
+
+    def run(self):
+        """Collect with the worker processes until every range is done or
+        a worker runs out of restarts. Returns True when all succeeded."""
+        signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+
+        # pymongo clients are not fork safe, so no database stays open in
+        # the supervisor while it forks workers
+        db = self.db_factory()
+        try:
+            shards = shard(self.plan(db), self.workers)
+        finally:
+            db.close()
+        succeeded = True
+        try:
+            for worker, collect_ids in enumerate(shards):
+                self.since_ids[worker] = {since_id
+                                          for _, since_id in collect_ids}
+                if collect_ids:
+                    self.start_worker(worker, collect_ids)
+
+            while self.processes:
+                for sentinel in wait(list(self.processes)):
+                    worker, process = self.processes.pop(sentinel)
+                    process.join()
+                    if process.exitcode == 0:
+                        self.logger.info(f"Worker {worker} finished")
+                        continue
+
+                    collect_ids = self.remaining(worker)
+                    if not collect_ids:
+                        continue
+                    if self.restarts[worker] >= self.max_restarts:
+                        self.logger.error(
+                            f"Worker {worker} exited with "
+                            f"{process.exitcode}, giving up on "
+                            f"{len(collect_ids)} id ranges")
+                        succeeded = False
+                        continue
+
+                    self.restarts[worker] += 1
+                    self.logger.warning(
+                        f"Worker {worker} exited with {process.exitcode}, "
+                        f"restart {self.restarts[worker]} of "
+                        f"{self.max_restarts}")
+                    time.sleep(RESTART_DELAY)
+                    self.start_worker(worker, collect_ids)
+        finally:
+            # workers save their state on SIGTERM
+            for _, process in self.processes.values():
+                process.terminate()
+            for _, process in self.processes.values():
+                process.join()
+            self.processes = {}
+        return succeeded
+
+    def handle_signal(self, signal, frame):
+        raise InterruptedError(f"Terminated with signal {signal}")
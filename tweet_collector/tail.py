@@ -0,0 +1,54 @@
+"""Poll timing for collectors tailing a query.
+
+Every tail pass collects the tweets newer than the newest one collected, so
+it covers the time from that tweet's snowflake timestamp to the poll. The
+tweets it returns over that window give the arrival rate of the query, and
+the next poll is timed so that about target tweets have arrived, filling
+one page with a single call."""
+
+import time
+from .snowflake import id_to_ms
+
+# tweets a poll aims to find: most of a 100 status page
+TAIL_TARGET = 90
+TAIL_MIN_INTERVAL = 5
+TAIL_MAX_INTERVAL = 15 * 60
+
+
+class ArrivalRate(object):
+    """Moving average of the tweets per second matching a query.
+
+    Args:
+        target: tweets the next poll should find
+        min_interval, max_interval: bounds of the poll interval in seconds
+        alpha: weight of the newest pass in the moving average
+    """
+
+    def __init__(self, target=TAIL_TARGET, min_interval=TAIL_MIN_INTERVAL,
+                 max_interval=TAIL_MAX_INTERVAL, alpha=0.3, rate=None):
+        self.target = target
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.alpha = alpha
+        self.rate = rate
+
+    def observe(self, num_tweets, since_id, now_ms=None):
+        """record a pass that found num_tweets newer than since_id"""
+        now_ms = time.time() * 1000 if now_ms is None else now_ms
+        window = (now_ms - id_to_ms(since_id)) / 1000
+        if window <= 0:
+            return
+        sample = num_tweets / window
+        if self.rate is None:
+            self.rate = sample
+        else:
+            self.rate += self.alpha * (sample - self.rate)
+
+    def next_interval(self):
+        """seconds to wait before the next poll"""
+        if self.rate is None:
+            return self.min_interval
+        if self.rate <= 0:
+            return self.max_interval
+        return min(max(self.target / self.rate, self.min_interval),
+                   self.max_interval)
@@ -0,0 +1,133 @@
+"""Rate limit bookkeeping for the search api tokens"""
+
+import time
+import heapq
+import threading
+from datetime import datetime
+from .metrics import TOKEN_LIMIT_REMAINING, TOKEN_SLEEP_SECONDS
+
+# status of a response to a token with no calls left
+RATE_LIMITED_STATUS = 429
+
+
+class RateLimited(Exception):
+    """A request was refused for the token's rate limit. reset is the
+    x-rate-limit-reset timestamp, or None when the header is missing."""
+
+    def __init__(self, reset):
+        super().__init__(f"rate limited until {reset}")
+        self.reset = reset
+
+
+class TokenPool(object):
+    """Thread safe scheduler of the search api tokens.
+
+    The pool is fed from the x-rate-limit headers of each response through
+    update(). Tokens are kept in a heap: tokens with calls left come first,
+    most calls left on top, followed by spent tokens ordered by reset time.
+    When a spent token's reset time passes its remaining calls are restored
+    to its limit without asking the api. refresh is only called at startup
+    and when the pool loses track of a token (a response without rate limit
+    headers, or an unknown limit); it takes no arguments and returns
+    (token_reset_ts, token_limit_remaining, token_limits) lists.
+    """
+
+    def __init__(self, refresh, token_reset_ts=None,
+                 token_limit_remaining=None, token_limits=None):
+        self.refresh = refresh
+        self.lock = threading.Condition()
+        self.refreshes = 0
+        if token_reset_ts is None:
+            self.reload()
+        else:
+            self.set_limits(token_reset_ts, token_limit_remaining,
+                            token_limits)
+        TOKEN_LIMIT_REMAINING.set_function(self.limits_by_token)
+
+    def set_limits(self, token_reset_ts, token_limit_remaining,
+                   token_limits=None):
+        self.token_reset_ts = list(token_reset_ts)
+        self.token_limit_remaining = list(token_limit_remaining)
+        self.token_limits = list(token_limits) if token_limits \
+            else [None] * len(self.token_reset_ts)
+        self.lost_track = False
+        self.versions = [0] * len(self.token_reset_ts)
+        self.heap = []
+        for token_idx in range(len(self.token_reset_ts)):
+            self.push(token_idx)
+
+    def reload(self):
+        self.refreshes += 1
+        self.set_limits(*self.refresh())
+
+    def push(self, token_idx):
+        """(re)insert a token, invalidating its previous heap entry"""
+        if len(self.heap) > 4 * len(self.versions):
+            # drop the invalidated entries
+            self.heap = [entry for entry in self.heap
+                         if entry[2] == self.versions[entry[1]]]
+            heapq.heapify(self.heap)
+        self.versions[token_idx] += 1
+        remaining = self.token_limit_remaining[token_idx]
+        if remaining > 0:
+            key = (0, -remaining)
+        else:
+            key = (1, self.token_reset_ts[token_idx])
+        heapq.heappush(self.heap,
+                       (key, token_idx, self.versions[token_idx]))
+
+    def acquire(self, before_sleep=None):
+        """Reserve one call and return the index of the token to use. Blocks
+        until the earliest reset when every token is spent, calling
+        before_sleep(sleep_for) first if given."""
+        with self.lock:
+            while True:
+                if self.lost_track:
+                    self.reload()
+
+                key, token_idx, version = self.heap[0]
+                if version != self.versions[token_idx]:
+                    heapq.heappop(self.heap)
+                    continue
+
+                if self.token_limit_remaining[token_idx] > 0:
+                    self.token_limit_remaining[token_idx] -= 1
+                    self.push(token_idx)
+                    return token_idx
+
+                sleep_for = self.token_reset_ts[token_idx] - \
+                    datetime.now().timestamp()
+                if sleep_for <= 0:
+                    limit = self.token_limits[token_idx]
+                    if limit:
+                        self.token_limit_remaining[token_idx] = limit
+                        self.push(token_idx)
+                    else:
+                        self.lost_track = True
+                    continue
+
+                if before_sleep:
+                    before_sleep(sleep_for)
+                start = time.monotonic()
+                self.lock.wait(sleep_for)
+                TOKEN_SLEEP_SECONDS.inc(time.monotonic() - start)
+
+    def limits_by_token(self):
+        """remaining calls by token label, for the metrics gauge"""
+        return {(("token", str(token_idx)),): remaining for token_idx,
+                remaining in enumerate(self.token_limit_remaining)}
+
+    def update(self, token_idx, limit_remaining, limit_reset,
+               limit=None):
+        """record the rate limit headers of a response. Missing headers
+        (None) make the pool reload all limits on the next acquire."""
+        with self.lock:
+            if limit_remaining is None or limit_reset is None:
+                self.lost_track = True
+            else:
+                self.token_limit_remaining[token_idx] = limit_remaining
+                self.token_reset_ts[token_idx] = limit_reset
+                if limit is not None:
+                    self.token_limits[token_idx] = limit
+                self.push(token_idx)
+            self.lock.notify_all()
@@ -0,0 +1,101 @@
+"""Shared http transport for the twitter api.
+
+One requests.Session is reused for every call so connections (and their
+TLS sessions) are pooled and kept alive. Overloaded (5xx) responses and
+connection errors of idempotent requests are retried with capped
+exponential backoff and jitter. Rate limited (429) responses are returned
+to the caller, whose token pool switches tokens or waits for the reset."""
+
+import time
+import random
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeout in seconds
+DEFAULT_TIMEOUT = (5, 30)
+
+RETRY_STATUSES = [500, 502, 503, 504]
+
+# methods retried; a POST (token auth) is sent once
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class Transport(object):
+    def __init__(self, pool_size=10, timeout=DEFAULT_TIMEOUT, max_retries=8,
+                 backoff_base=1, backoff_max=60, logger=None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive"
+        })
+
+    def backoff(self, attempt):
+        """full jitter: a random wait up to the capped exponential delay"""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return random.uniform(0, delay)
+
+    def should_retry(self, status, attempt):
+        """whether a response with status is retried after attempt
+        retries"""
+        return status in RETRY_STATUSES and attempt < self.max_retries
+
+    def request(self, method, url, **kwargs):
+        """Send a request, retrying RETRY_STATUSES and connection errors of
+        IDEMPOTENT_METHODS up to max_retries times. The last response is
+        returned, so callers should still call raise_for_status."""
+        kwargs.setdefault("timeout", self.timeout)
+        retry = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                if not retry or attempt >= self.max_retries:
+                    raise
+                reason = e
+            else:
+                if not retry or not self.should_retry(res.status_code,
+                                                      attempt):
+                    return res
+                reason = f"received {res.status_code} status code"
+
+            sleep_for = self.backoff(attempt)
+            self.logger.log(logging.WARN,
+                            f"{reason}; retrying in {sleep_for:.2f}s")
+            time.sleep(sleep_for)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """the process wide transport used when none is passed in"""
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = Transport()
+        return _default_transport
@@ -1,24 +1,154 @@
 import os
 import sys
 import signal
-import asyncio
+import threading
+import time
 import logging
-import json
-import requests
-import numpy as np
 from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
-from datetime import datetime
-import time
 from tweet_collector.auth import DEFAULT_AUTH_FILE, get_auth_header, get_tokens
+from tweet_collector.tokens import TokenPool, RateLimited, \
+    RATE_LIMITED_STATUS
+from tweet_collector.pipeline import PagePipeline, WriteQueue, WriteStats
+from tweet_collector.transport import get_transport
+from tweet_collector.decode import decode_search
+from tweet_collector.dedup import SeenIds
+from tweet_collector.snowflake import ms_to_id_span, time_window_to_ids
+from tweet_collector.tail import ArrivalRate
+from tweet_collector.metrics import STAGE_SECONDS, GET_TWEETS_SECONDS, \
+    STATUSES_WRITTEN, WRITE_QUEUE_DEPTH
+from tweet_collector.checkpoint import RangeCheckpoint, CHECKPOINT_PAGES, \
+    CHECKPOINT_SECONDS
+
+null_logger = logging.getLogger("null")
+null_logger.addHandler(logging.NullHandler())
+
+API_URL = "https://api.twitter.com/1.1"
+
+# consecutive empty pages before an id range is considered exhausted
+MAX_EMPTY_PAGES = 4
+
+# backfill ranges wider than this many ms of snowflake time are split, into
+# no more than BACKFILL_MAX_SPLITS sub ranges
+BACKFILL_SPLIT_MS = 60 * 60 * 1000
+BACKFILL_MAX_SPLITS = 64
+
+
+def split_range(next_max_id, since_id, split_ms=BACKFILL_SPLIT_MS,
+                max_splits=BACKFILL_MAX_SPLITS):
+    """Split a [next_max_id, since_id] range into sub ranges spanning at
+    least split_ms of tweet time each. Tweet ids are snowflakes with the ms
+    timestamp in the bits above 22, so an even split by id is an even split
+    by time. Open ended ranges (next_max_id of sys.maxsize) are not split.
+    Sub ranges are returned newest first."""
+    if next_max_id >= sys.maxsize:
+        return [[next_max_id, since_id]]
+
+    span = max(ms_to_id_span(split_ms),
+               -(-(next_max_id - since_id) // max_splits))
+    ranges = []
+    upper = next_max_id
+    while upper - since_id > span:
+        ranges.append([upper, upper - span])
+        upper -= span
+    ranges.append([upper, since_id])
+    return ranges
+
+
+def flatten_page(tweets):
+    """Split a page of api statuses into the tweets and retweets lists used
+    by DbInterface.insert_tweets_batch, in one iterative pass.
+
+    Retweeted and quoted originals come before the statuses referencing
+    them. Every status is emitted once, keyed by id, however many statuses
+    on the page reference it. Tweets are shallow copies carrying the
+    is_retweeted, is_quoted and quoted_id flags so the api dicts are left
+    untouched, and all statuses of a user share the user dict of that
+    user's newest status on the page.
+
+    Returns:
+        (page_tweets, page_retweets) lists of (status, user) tuples
+    """
+    page_tweets = {}
+    page_retweets = {}
+    users = {}
+
+    # (status, flag set on it, children pushed)
+    stack = [(tweet, None, False) for tweet in reversed(tweets)]
+    while stack:
+        status, flag, expanded = stack.pop()
+        status_id = status["id"]
+        if status_id in page_retweets:
+            continue
+        if status_id in page_tweets:
+            if flag:
+                page_tweets[status_id][flag] = True
+            continue
+
+        if not expanded:
+            stack.append((status, flag, True))
+            if "retweeted_status" in status:
+                stack.append((status["retweeted_status"], "is_retweeted",
+                              False))
+            elif "quoted_status" in status:
+                stack.append((status["quoted_status"], "is_quoted", False))
+            continue
+
+        user = status["user"]
+        newest = users.get(user["id"])
+        if newest is None or newest[0] < status_id:
+            users[user["id"]] = (status_id, user)
+
+        if "retweeted_status" in status:
+            page_retweets[status_id] = status
+        else:
+            tweet = dict(status)
+            if flag:
+                tweet[flag] = True
+            if "quoted_status" in status:
+                tweet["quoted_id"] = status["quoted_status"]["id"]
+            page_tweets[status_id] = tweet
+
+    return ([(tweet, users[tweet["user"]["id"]][1])
+             for tweet in page_tweets.values()],
+            [(retweet, users[retweet["user"]["id"]][1])
+             for retweet in page_retweets.values()])
+
+
+def get_rate_limits(tokens, transport, api_url=API_URL):
+    """Search rate limits of each token from the api.
+
+    Returns:
+        (reset timestamps, calls remaining, call limits) lists in token order
+    """
+    url = f"{api_url}/application/rate_limit_status.json?resources=search"
+    token_reset_ts = []
+    token_limit_remaining = []
+    token_limits = []
+    for token in tokens:
+        res = transport.get(url, headers=get_auth_header(token))
+        res.raise_for_status()
+        res = res.json()
+        rate_info = res["resources"]["search"]["/search/tweets"]
+        token_reset_ts.append(rate_info["reset"])
+        token_limit_remaining.append(rate_info["remaining"])
+        token_limits.append(rate_info["limit"])
 
-null_logger = logging.getLogger("null") \
-    .addHandler(logging.NullHandler())
+    return token_reset_ts, token_limit_remaining, token_limits
 
 
 class TweetCollector(object):
     def __init__(self, db_obj, q, auth_file=DEFAULT_AUTH_FILE,
-                 logger=null_logger, **kwargs):
+                 logger=null_logger, batch_writes=True, api_url=API_URL,
+                 backfill_workers=1, backfill_split_ms=BACKFILL_SPLIT_MS,
+                 transport=None, write_queue_depth=8, pipeline_depth=0,
+                 pipeline_writers=2,
+                 project_statuses=True, since=None, until=None, dedup=False,
+                 dedup_file=None, tokens=None, collect_ids=None,
+                 token_pool=None, write_queue=None, track_query=False,
+                 tail=False, arrival_rate=None,
+                 checkpoint_pages=CHECKPOINT_PAGES,
+                 checkpoint_seconds=CHECKPOINT_SECONDS, **kwargs):
 
         # set signal handlers to exit gracefully on process kill command
         signal.signal(signal.SIGINT, self.handle_signal)
@@ -26,20 +156,62 @@ class TweetCollector(object):
         signal.signal(signal.SIGQUIT, self.handle_signal)
         signal.signal(signal.SIGTERM, self.handle_signal)
 
-        # get auth tokens from file set by auth cli
-        self.tokens = get_tokens(auth_file=auth_file)
+        # get auth tokens from file set by auth cli, unless a supervisor
+        # handed this collector its share
+        self.tokens = tokens or get_tokens(auth_file=auth_file)
         if not self.tokens:
             raise ValueError("twitter api tokens not set. Use cli tool "
                              "to set tokens")
 
-        # get remaining search limits from twitter api
-        self.token_reset_ts, self.token_limit_remaining = \
-            self.get_current_rate_limits()
+        self.api_url = api_url
+
+        # pooled keep-alive session with retries shared by all requests
+        self.transport = transport or get_transport()
+
+        # get remaining search limits from twitter api once; afterwards the
+        # pool is kept up to date from the response headers. Collectors of
+        # several queries share one pool over the same tokens.
+        self.token_pool = token_pool or \
+            TokenPool(self.get_current_rate_limits)
 
         self.db = db_obj
         self.logger = logger
 
-        self.current_tasks = []
+        # write each page with db.insert_tweets_batch instead of one
+        # executor task per tweet
+        self.batch_writes = batch_writes
+
+        # with pipeline_depth > 0 pages are normalized and written by a
+        # PagePipeline holding at most pipeline_depth pages per stage;
+        # fetching blocks while it is full
+        self.pipeline_depth = pipeline_depth
+        self.pipeline_writers = pipeline_writers
+        self.pipeline = None
+
+        # drop the status and user attributes no database module stores
+        # while decoding
+        self.project_statuses = project_statuses
+
+        # skip statuses that are already stored before normalizing or
+        # writing them. The filter is loaded from dedup_file when it exists,
+        # otherwise built from the ids in the database, and saved back to
+        # dedup_file with the collector state.
+        self.seen_ids = SeenIds(db_obj, dedup_file) if dedup else None
+
+        # with tail, keep polling for new tweets once the ranges are
+        # collected, timed by the arrival rate of the query
+        self.tail = tail
+        self.arrival_rate = arrival_rate or ArrivalRate()
+
+        # save the progress of a range every checkpoint_pages pages or
+        # checkpoint_seconds seconds, once the pages before are written.
+        self.checkpoint_pages = checkpoint_pages
+        self.checkpoint_seconds = checkpoint_seconds
+
+        # number of unfinished id ranges collected concurrently before the
+        # most recent tweets. 1 keeps the sequential behaviour.
+        self.backfill_workers = backfill_workers
+        self.backfill_split_ms = backfill_split_ms
 
         # parse input search params (passed through kwargs); restrict to
         # following
@@ -53,12 +225,33 @@ class TweetCollector(object):
             del kwargs[key]
 
         # set up url and parameters
-        self.host = f"https://api.twitter.com/1.1/search/tweets.json?q={q}"
+        self.q = q
+        self.host = f"{self.api_url}/search/tweets.json?q={q}"
         self.count = 100
 
         # set the next_max_id to collect the most recent tweets
-        self.__collect_ids = sorted(self.db.load_collector_state())
-        self.__collect_ids.append([sys.maxsize, self.db.get_max_tweet_id()])
+        # an optional [since, until) datetime window bounds the most recent
+        # range through the snowflake ids. A supervisor passes the ranges
+        # to collect in collect_ids instead.
+        # With track_query the state is kept per query: meta rows carry q
+        # and the most recent range starts after the newest id collected
+        # for q rather than the newest stored tweet.
+        self.state_query = q if track_query else None
+        self.newest_id = 0
+        if collect_ids is not None:
+            self.__collect_ids = [list(id_range) for id_range in collect_ids]
+        else:
+            window_since_id, window_max_id = time_window_to_ids(since, until)
+            if track_query:
+                newest_id = self.db.load_query_state(q).get("max_id", 0)
+            else:
+                newest_id = self.db.get_max_tweet_id()
+            self.__collect_ids = sorted(
+                self.db.load_merged_collector_state(query=self.state_query))
+            self.__collect_ids.append([
+                window_max_id or sys.maxsize,
+                max(newest_id, window_since_id or 0)
+            ])
 
         self.__next_max_id = self.__collect_ids[0][0]
         self.since_id = self.__collect_ids[0][1]
@@ -73,31 +266,36 @@ class TweetCollector(object):
         }
 
         self.tweets_collected = 0
+        # pages are written from executor threads
+        self.count_lock = threading.Lock()
 
-        # set the executor for the event loop run_in_executor
+        # executor the pages are written on. At most write_queue_depth
+        # writes are in flight; fetching blocks while the queue is full.
         cpus = multiprocessing.cpu_count()
         max_workers = (cpus - 2) if cpus > 2 else 1
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # an empty WriteQueue is falsy, so a shared one is tested for None
+        if write_queue is None:
+            write_queue = WriteQueue(self.executor, write_queue_depth,
+                                     self.logger)
+        self.write_queue = write_queue
+        self.write_stats = WriteStats()
+        WRITE_QUEUE_DEPTH.set_function(lambda: len(self.write_queue))
 
     def get_current_rate_limits(self):
         """Get the tokens current rate limits to help __init__ class vals"""
-        url = "https://api.twitter.com/1.1/application/rate_limit_status.json" \
-              "?resources=search"
-        token_reset_ts = []
-        token_limit_remaining = []
-        for token in self.tokens:
-            res = requests.get(url, headers=get_auth_header(token)).json()
-            rate_info = res["resources"]["search"]["/search/tweets"]
-            token_reset_ts.append(rate_info["reset"])
-            token_limit_remaining.append(rate_info["remaining"])
-
-        return token_reset_ts, token_limit_remaining
+        return get_rate_limits(self.tokens, self.transport, self.api_url)
 
     def get_next_url(self):
         self.params["max_id"] = self.__next_max_id
         self.params["since_id"] = self.since_id
+        return self.get_range_url(self.__next_max_id, self.since_id)
+
+    def get_range_url(self, max_id, since_id):
+        """search url for an id range; safe to call from any thread"""
+        params = {**self.params, "max_id": max_id, "since_id": since_id}
         next_url = self.host
-        for param, value in self.params.items():
+        for param, value in params.items():
             next_url += f"&{param}={value}"
         return next_url
 
@@ -107,166 +305,369 @@ class TweetCollector(object):
 
     def get_next_token(self):
         """get the next token that is ready for use or wait for the next 
-        token to be ready"""
+        token to be ready. Each yield reserves one call."""
         while True:
-            self.token_reset_ts, self.token_limit_remaining = \
-                self.get_current_rate_limits()
-            if max(self.token_limit_remaining) > 0:
-                token_idx = np.argmax(self.token_limit_remaining)
-
-            else:
-                token_idx = np.argmin(self.token_reset_ts)
-                token_reset_ts = self.token_reset_ts[token_idx]
-                sleep_for = token_reset_ts - datetime.now().timestamp()
-                if sleep_for > 0:
-                    self.block_for_futures(self.current_tasks)
-                    self.logger.info(f"sleeping for: {sleep_for/60} min")
-                    time.sleep(sleep_for)
-                    self.token_reset_ts, self.token_limit_remaining = \
-                        self.get_current_rate_limits()
+            token_idx = self.token_pool.acquire(
+                before_sleep=self.before_token_sleep)
             yield self.tokens[token_idx], token_idx
 
+    def before_token_sleep(self, sleep_for):
+        self.write_queue.drain()
+        self.logger.info(f"sleeping for: {sleep_for/60} min")
+
     def start_collector(self):
         """start collecting tweets"""
-        self.logger.log(logging.INFO, "Starting collector")
+        for _ in self.iter_pages():
+            pass
+
+    def iter_pages(self):
+        """Collect the id ranges, yielding the number of statuses on each
+        page after it is queued for writing. The state of a range is saved
+        when it finishes, fails or the generator is closed."""
+        self.logger.log(logging.INFO, f"Starting collector for {self.q}")
+        collect_ids = self.__collect_ids
+        if self.backfill_workers > 1 and len(collect_ids) > 1:
+            self.backfill(collect_ids[:-1])
+            collect_ids = collect_ids[-1:]
+
         # loop through all gaps in tweets from meta table before collecting
         # most recent tweets.
-        for id_range in self.__collect_ids:
-            self.__next_max_id, self.since_id = id_range
-            num_done = 0
-            try:
-                for token, token_idx in self.get_next_token():
-                    # initialize rate limit info for this token
-                    limit_remaining = self.token_limit_remaining[token_idx]
+        for id_range in collect_ids:
+            yield from self.iter_range(id_range)
+
+        # keep polling for new tweets, timed by their arrival rate
+        while self.tail:
+            interval = self.arrival_rate.next_interval()
+            self.logger.debug(f"Next poll for {self.q} in {interval:.1f} s")
+            time.sleep(interval)
+            yield from self.tail_pass()
+
+    def tail_pass(self):
+        """Collect the tweets newer than the newest one collected, ending at
+        the first empty page or at the newest one, and update the arrival
+        rate. The search api can answer with short pages before the end of
+        a range, so they only time the next poll through the arrival rate.
+        The state is only saved if the pass does not finish."""
+        since_id = self.newest_id or self.since_id
+        num_collected = 0
+        for num_tweets in self.iter_range([sys.maxsize, since_id],
+                                          end_on_empty_page=True):
+            num_collected += num_tweets
+            yield num_tweets
+        self.arrival_rate.observe(num_collected, since_id)
+
+    def iter_range(self, id_range, end_on_empty_page=False):
+        """Collect one id range, yielding the number of statuses on each
+        page after it is queued for writing. The range ends after
+        MAX_EMPTY_PAGES empty pages, at the first one with
+        end_on_empty_page, or once its since_id is reached."""
+        self.__next_max_id, self.since_id = id_range
+        num_done = 0
+        done = False
+        last_token_idx = None
+        checkpoint = self.range_checkpoint(self.since_id)
+        # write errors are raised by whichever drain or submit comes first,
+        # possibly before the finally below, so failures are counted too
+        num_failed = len(self.write_queue.failed)
+        if self.pipeline_depth:
+            self.pipeline = PagePipeline(self.normalize_page,
+                                         self.write_page,
+                                         self.pipeline_depth,
+                                         self.pipeline_writers,
+                                         self.logger).start()
+        try:
+            for token, token_idx in self.get_next_token():
+                if token_idx != last_token_idx:
+                    limit_remaining = \
+                        self.token_pool.token_limit_remaining[token_idx]
                     self.logger.log(logging.INFO,
                                     f"Switching Token: {token_idx} "
                                     f"Limit Remaining: {limit_remaining} ")
                     self.logger.info(f"Collected {self.tweets_collected} "
                                      f"tweets")
-
-                    # loop while the token is not over the rate limit
-                    while limit_remaining > 0 and not num_done <= 3:
-                        # get the next url using __next_max_id set in the
-                        # previous iter
-                        next_url = self.get_next_url()
-                        limit_remaining, limit_reset, tasks, done = \
-                            self.get_tweets(next_url, token)
-
-                        num_done = num_done + 1 if done else 0
-
-                        if limit_remaining is None:
-                            self.logger.log(logging.DEBUG,
-                                            "Didn't Received limit_remaining. "
-                                            "Acquiring rate limit from api")
-                            self.token_reset_ts, self.token_limit_remaining = \
-                                self.get_current_rate_limits()
-                            limit_remaining = self. \
-                                token_limit_remaining[token_idx]
-
-                        self.current_tasks += tasks
-
-                    self.token_reset_ts[token_idx] = limit_reset
-                    self.token_limit_remaining[token_idx] = limit_remaining
-                    if num_done > 3:
-                        break
-
-                # handle insert_tweet_tasks
-                self.block_for_futures(self.current_tasks)
-            finally:
+                    last_token_idx = token_idx
+
+                # get the next url using __next_max_id set in the
+                # previous iter
+                next_url = self.get_next_url()
+                try:
+                    limit_remaining, limit_reset, num_tweets = \
+                        self.get_tweets(next_url, token)
+                except RateLimited as e:
+                    self.rate_limited(token_idx, e)
+                    continue
+                done = num_tweets == 0 or \
+                    self.__next_max_id <= self.since_id
+
+                if limit_remaining is None:
+                    self.logger.log(logging.DEBUG,
+                                    "Didn't Received limit_remaining. "
+                                    "Acquiring rate limit from api")
+                self.token_pool.update(token_idx, limit_remaining,
+                                       limit_reset)
+
+                num_done = num_done + 1 if num_tweets == 0 else 0
+                if num_tweets:
+                    checkpoint.page_queued(self.__next_max_id,
+                                           self.pipeline or self.write_queue)
+                yield num_tweets
+                if num_done >= MAX_EMPTY_PAGES or \
+                        (done and (end_on_empty_page or num_tweets)):
+                    break
+        finally:
+            # wait for queued pages to be written before saving the
+            # state; a failed write propagates and skips the save
+            try:
+                try:
+                    self.write_queue.drain()
+                finally:
+                    if self.pipeline:
+                        pipeline, self.pipeline = self.pipeline, None
+                        pipeline.close()
+                self.db.flush()
+                failed = self.write_queue.failed[num_failed:]
+                if failed and not sys.exc_info()[1]:
+                    raise failed[0]
+            except BaseException as e:
+                checkpoint.close()
+                self.logger.log(logging.ERROR,
+                                f"Not saving the state of id range "
+                                f"{id_range}: writing its pages failed: "
+                                f"{e}")
+                raise
+            checkpoint.close()
+            if failed:
+                # the error was raised already, by an earlier drain or
+                # submit, and is propagating or was handled by the caller
+                self.logger.log(logging.ERROR,
+                                f"Not saving the state of id range "
+                                f"{id_range}: writing its pages failed: "
+                                f"{failed[0]}")
+                raise sys.exc_info()[1]
+            # a finished tail pass leaves no state, unless it checkpointed
+            if not (done and end_on_empty_page) or checkpoint.saved:
                 self.db.save_collector_state(
                     self.__next_max_id,
                     self.since_id,
-                    done)
-                self.logger.log(logging.INFO,
-                                f"Finished collecting for id range with "
-                                f"{id_range} "
-                                f"Collected {self.tweets_collected} tweets")
-
-                exc_type, exc_obj, trace = sys.exc_info()
-                if exc_obj:
+                    done,
+                    query=self.state_query)
+            self.save_seen_ids()
+            self.logger.log(logging.DEBUG if end_on_empty_page
+                            else logging.INFO,
+                            f"Finished collecting for id range with "
+                            f"{id_range} "
+                            f"Collected {self.tweets_collected} tweets "
+                            f"Writes: {self.write_stats}")
+
+            exc_type, exc_obj, trace = sys.exc_info()
+            if exc_obj:
+                # GeneratorExit: the generator was closed early
+                if not isinstance(exc_obj, GeneratorExit):
                     self.logger.log(logging.ERROR, exc_obj)
-                    raise (exc_obj)
+                raise (exc_obj)
+            else:
+                assert done
+
+    def backfill(self, collect_ids):
+        """Collect unfinished id ranges concurrently. Ranges are split by
+        snowflake time and every sub range is recorded in the meta
+        collection before collection starts, so each one checkpoints its
+        own progress. Calls are spread over the tokens by a shared
+        TokenPool."""
+        sub_ranges = []
+        for next_max_id, since_id in collect_ids:
+            split = split_range(next_max_id, since_id, self.backfill_split_ms)
+            for sub_max_id, sub_since_id in split:
+                self.db.save_collector_state(sub_max_id, sub_since_id, False,
+                                             query=self.state_query)
+            sub_ranges += split
+
+        self.logger.log(logging.INFO,
+                        f"Backfilling {len(collect_ids)} id ranges as "
+                        f"{len(sub_ranges)} sub ranges with "
+                        f"{self.backfill_workers} workers")
+
+        with ThreadPoolExecutor(max_workers=self.backfill_workers) as pool:
+            futures = [pool.submit(self.collect_range, sub_max_id,
+                                   sub_since_id)
+                       for sub_max_id, sub_since_id in sub_ranges]
+            for future in futures:
+                future.result()
+
+    def collect_range(self, next_max_id, since_id):
+        """collect a single id range in the calling thread, saving its
+        state when finished or on error. The range ends once its since_id
+        is reached, or after MAX_EMPTY_PAGES empty pages."""
+        num_done = 0
+        reached = False
+        checkpoint = self.range_checkpoint(since_id)
+        try:
+            while num_done < MAX_EMPTY_PAGES and not reached:
+                token_idx = self.token_pool.acquire()
+                url = self.get_range_url(next_max_id, since_id)
+                try:
+                    tweets, limit_remaining, limit_reset = \
+                        self.fetch_page(url, self.tokens[token_idx])
+                except RateLimited as e:
+                    self.rate_limited(token_idx, e)
+                    continue
+                self.token_pool.update(token_idx, limit_remaining,
+                                       limit_reset)
+
+                if tweets:
+                    num_done = 0
+                    # only move past the page once it is written, so a
+                    # failed write is collected again
+                    page_min_id = self.get_min_id(tweets)
+                    self.insert_page(tweets)
+                    next_max_id = page_min_id
+                    checkpoint.page_queued(next_max_id)
+                    reached = next_max_id <= since_id
                 else:
-                    assert done
-
-    def get_tweets(self, url, token):
-        """get the tweets in an async manner"""
-        auth_header = get_auth_header(token)
+                    num_done += 1
+        finally:
+            done = reached or num_done >= MAX_EMPTY_PAGES
+            self.db.flush()
+            checkpoint.close()
+            self.db.save_collector_state(next_max_id, since_id, done,
+                                         query=self.state_query)
+            self.logger.log(logging.INFO,
+                            f"Finished collecting for id range "
+                            f"{[next_max_id, since_id]} done: {done}")
+
+    def rate_limited(self, token_idx, error):
+        """mark a token refused by the api as spent until its reset, so the
+        pool switches tokens or waits"""
+        self.logger.log(logging.WARN, f"Token {token_idx} {error}")
+        self.token_pool.update(token_idx, 0, error.reset)
+
+    def range_checkpoint(self, since_id):
+        return RangeCheckpoint(self.db, since_id, self.state_query,
+                               self.checkpoint_pages,
+                               self.checkpoint_seconds, self.logger)
+
+    def fetch_page(self, url, token):
+        """request a page of statuses. Returns the statuses and the rate
+        limit remaining and reset from the headers (None if missing)"""
+        # twitter servers return 503 code when overloaded; the transport
+        # retries those with backoff
+        with STAGE_SECONDS.time(stage="http"):
+            res = self.transport.get(url, headers=get_auth_header(token))
 
-        # twitter servers return 503 code when overloaded
-        # need to retry code
-        while True:
-            res = requests.get(url, headers=auth_header)
-            if res.status_code in [503, 500]:
-                self.logger.log(logging.WARN,
-                                "received 503 status code; retrying")
-                time.sleep(1)
-            else:
-                break
+        limit_reset = int(res.headers["x-rate-limit-reset"]) if \
+            "x-rate-limit-reset" in res.headers else None
+        if res.status_code == RATE_LIMITED_STATUS:
+            raise RateLimited(limit_reset)
 
         # if the request fails, raise an error
         res.raise_for_status()
-        tweets = res.json()["statuses"]
-
-        # get next max id before insert_tweet changes the tweets
-
-        # insert tweets into db
-        insert_tasks = self.insert_tweets(tweets)
-
-        # if the api returned less then the number of tweets requested,
-        # it has no more tweets for us.
+        with STAGE_SECONDS.time(stage="decode"):
+            tweets, search_metadata = decode_search(res.content,
+                                                    self.project_statuses)
         if len(tweets) == 0:
-            self.logger.info(f"Received no tweets: "
-                             f"{json.dumps(res.json(), indent=4)}")
-            done = True
-        else:
-            self.__next_max_id = self.get_min_id(tweets)
-            done = False
-            # set the max_id param for the next api call (used by get_next_url)
+            self.logger.info(f"Received no tweets: {search_metadata}")
 
         # get the rate limiting information from the header
         limit_remaining = int(res.headers["x-rate-limit-remaining"]) if \
             "x-rate-limit-remaining" in res.headers else None
-        limit_reset = int(res.headers["x-rate-limit-reset"]) if \
-            "x-rate-limit-reset" in res.headers else None
 
-        return limit_remaining, limit_reset, insert_tasks, done
+        return tweets, limit_remaining, limit_reset
 
-    async def await_futures(self, futures):
-        completed, pending = await asyncio.wait(futures)
-        return [task.result() for task in completed]
+    def get_tweets(self, url, token):
+        """get the tweets in an async manner"""
+        with GET_TWEETS_SECONDS.time():
+            return self._get_tweets(url, token)
 
-    def block_for_futures(self, futures):
-        if futures:
-            loop = asyncio.get_event_loop()
-            return loop.run_until_complete(self.await_futures(futures))
-        return []
+    def _get_tweets(self, url, token):
+        tweets, limit_remaining, limit_reset = self.fetch_page(url, token)
 
-    def insert_tweets(self, tweets):
-        loop = asyncio.get_event_loop()
-        tasks = [
-            loop.run_in_executor(self.executor, self.insert_tweet, tweet)
-            for tweet in tweets
-        ]
-        return tasks
+        # get next max id before insert_tweet changes the tweets
 
-    def insert_tweet(self, tweet):
-        if "retweeted_status" in tweet:
-            retweet = tweet["retweeted_status"]
-            retweet["is_retweeted"] = True
-            self.insert_tweet(retweet)
-            self.db.insert_retweet(tweet, tweet["user"])
+        # queue the tweets for writing
+        self.insert_tweets(tweets)
 
-        else:
-            if "quoted_status" in tweet:
-                quoted_tweet = tweet["quoted_status"]
-                quoted_tweet["is_quoted"] = True
-                tweet["quoted_id"] = quoted_tweet["id"]
-                self.insert_tweet(quoted_tweet)
+        # an empty page means the api has no more tweets for us in the range
+        if tweets:
+            # set the max_id param for the next api call (used by
+            # get_next_url)
+            self.__next_max_id = self.get_min_id(tweets)
+            self.newest_id = max(self.newest_id,
+                                 max(tweet["id"] for tweet in tweets))
 
-            self.db.insert_tweet(tweet, tweet["user"])
-            self.tweets_collected += 1
+        return limit_remaining, limit_reset, len(tweets)
 
+    def insert_tweets(self, tweets):
+        """queue a page of statuses for writing, blocking while the write
+        queue (or pipeline) is full"""
+        if not tweets:
+            return
+        if self.pipeline:
+            self.pipeline.put(tweets)
+        elif self.batch_writes:
+            self.write_queue.submit(self.insert_page, tweets)
+        else:
+            for tweet in tweets:
+                self.write_queue.submit(self.insert_tweet, tweet)
+
+    def insert_tweet(self, tweet):
+        """write one api status, and the statuses it references, with the
+        per tweet db calls"""
+        page_tweets, page_retweets = self.normalize_page([tweet])
+        start = time.perf_counter()
+        for tweet_attrs, user_attrs in page_tweets:
+            self.db.insert_tweet(tweet_attrs, user_attrs)
+        for retweet, user in page_retweets:
+            self.db.insert_retweet(retweet, user)
+        self.page_written(page_tweets, page_retweets,
+                          time.perf_counter() - start)
+
+    def insert_page(self, tweets):
+        """insert a page of tweets with a single batched db call"""
+        self.write_page(self.normalize_page(tweets))
+
+    def normalize_page(self, tweets):
+        """flatten_page, dropping the statuses that are already stored.
+        Stored statuses are dropped before flattening, their nested
+        originals after."""
+        with STAGE_SECONDS.time(stage="normalize"):
+            if self.seen_ids:
+                tweets, stored = self.seen_ids.filter_statuses(tweets)
+            page_tweets, page_retweets = flatten_page(tweets)
+            if self.seen_ids:
+                page_tweets, page_retweets = self.seen_ids.filter_page(
+                    page_tweets, page_retweets, stored)
+        return page_tweets, page_retweets
+
+    def write_page(self, page):
+        """write a page returned by normalize_page"""
+        page_tweets, page_retweets = page
+        if not page_tweets and not page_retweets:
+            return
+        start = time.perf_counter()
+        self.db.insert_tweets_batch(page_tweets, page_retweets)
+        self.page_written(page_tweets, page_retweets,
+                          time.perf_counter() - start)
+
+    def page_written(self, page_tweets, page_retweets, seconds):
+        """update the counters and per write metrics after a write"""
+        with self.count_lock:
+            self.tweets_collected += len(page_tweets)
+        statuses = len(page_tweets) + len(page_retweets)
+        self.write_stats.record(statuses, seconds)
+        STAGE_SECONDS.observe(seconds, stage="write")
+        STATUSES_WRITTEN.inc(statuses)
+        self.logger.debug(f"Wrote {statuses} statuses in "
+                          f"{seconds * 1000:.1f} ms, "
+                          f"{len(self.write_queue)} writes queued")
+        if self.seen_ids:
+            self.seen_ids.add([tweet["id"] for tweet, _ in page_tweets] +
+                              [retweet["id"] for retweet, _ in page_retweets])
+
+    def save_seen_ids(self):
+        if self.seen_ids:
+            self.seen_ids.save()
+            self.logger.debug(f"Seen id filter skipped "
+                              f"{self.seen_ids.skipped} stored statuses")
 
     def handle_signal(self, signal, frame):
         raise InterruptedError(f"Terminated with signal {signal}")